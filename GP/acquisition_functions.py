@@ -4,11 +4,15 @@
 This module contains acquisition functions for Bayesian Optimisation.
 """
 
+import copy
+import os
+
 import numpy as np
 from scipy.optimize import minimize
-from scipy.stats import norm
+from scipy.stats import norm, qmc
 
-from bo_gp_fit_predict import bo_fit_homo_gp, bo_predict_homo_gp, bo_fit_hetero_gp, bo_predict_hetero_gp
+from bo_gp_fit_predict import bo_fit_homo_gp, bo_predict_homo_gp, bo_hetero_em, bo_hetero_posterior
+from gp_posterior import GPPosterior
 
 
 def expected_improvement(X, X_sample, gpr, xi=0.01):
@@ -40,22 +44,42 @@ def expected_improvement(X, X_sample, gpr, xi=0.01):
     return ei
 
 
-def my_expected_improvement(X, X_sample, Y_sample, noise, l_opt, sigma_f_opt, mu_sample_opt):
+def expected_improvement_grad(Z, std, dmu, dvar):
+    """
+    Gradient of the expected improvement imp * Phi(Z) + std * phi(Z) with respect to the test locations. Uses
+    dEI/dmu = Phi(Z) and dEI/dstd = phi(Z).
+
+    :param Z: standardised improvement (n x 1)
+    :param std: predictive standard deviation (n x 1)
+    :param dmu: gradient of the predictive mean with respect to the test locations (n x d)
+    :param dvar: gradient of the predictive variance with respect to the test locations (n x d)
+    :return: gradient of the EI (n x d) and gradient of the predictive standard deviation (n x d)
+    """
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dstd = dvar / (2 * std)
+        dei = norm.cdf(Z) * dmu + norm.pdf(Z) * dstd
+    dei[np.ravel(std == 0.0)] = 0.0
+
+    return dei, dstd
+
+
+def my_expected_improvement(X, posterior, mu_sample_opt, return_grad=False):
     """
     Computes the EI using a homoscedastic GP.
 
     :param X: Test locations (n x d)
-    :param X_sample: Sample locations (m x d).
-    :param Y_sample:  Noise-corrupted values at the sample locations (m x 1).
-    :param noise: noise level in the latent function.
-    :param l_opt: optimised lengthscale(s) of the GP kernel.
-    :param sigma_f_opt: optimised vertical lengthscale of the GP kernel.
+    :param posterior: GPPosterior fitted to the samples.
     :param mu_sample_opt: incumbent eta
+    :param return_grad: whether to also return the gradient of the EI with respect to X (n x d)
     :return: Expected improvements at points X.
     """
 
-    mu, var = bo_predict_homo_gp(X_sample, Y_sample, X, noise, l_opt, sigma_f_opt)
-    std = np.sqrt(np.diag(var))
+    if return_grad:
+        mu, var, dmu, dvar = posterior.predict_with_grad(X)
+    else:
+        mu, var = posterior.predict(X, full_cov=False)
+    std = np.sqrt(var)
 
     with np.errstate(divide='warn'):
         imp = mu - mu_sample_opt
@@ -63,86 +87,97 @@ def my_expected_improvement(X, X_sample, Y_sample, noise, l_opt, sigma_f_opt, mu
         ei = imp * norm.cdf(Z) + std * norm.pdf(Z)
         ei[std == 0.0] = 0.0
 
+    if return_grad:
+        dei, _ = expected_improvement_grad(Z, std, dmu, dvar)
+        return ei, dei
+
     return ei
 
 
-def augmented_expected_improvement(X, X_sample, Y_sample, noise, l_opt, sigma_f_opt, mu_sample_opt):
+def augmented_expected_improvement(X, posterior, mu_sample_opt, return_grad=False):
     """
     Computes the AEI using a homoscedastic GP.
 
     :param X: Test locations (n x d)
-    :param X_sample: Sample locations (m x d).
-    :param Y_sample:  Noise-corrupted values at the sample locations (m x 1).
-    :param noise: noise level in the latent function.
-    :param l_opt: optimised lengthscale(s) of the GP kernel.
-    :param sigma_f_opt: optimised vertical lengthscale of the GP kernel.
+    :param posterior: GPPosterior fitted to the samples.
     :param mu_sample_opt: incumbent eta
+    :param return_grad: whether to also return the gradient of the AEI with respect to X (n x d)
     :return: Expected improvements at points X.
     """
 
-    mu, var = bo_predict_homo_gp(X_sample, Y_sample, X, noise, l_opt, sigma_f_opt)
-    std = np.sqrt(np.diag(var))
+    if return_grad:
+        mu, var, dmu, dvar = posterior.predict_with_grad(X)
+    else:
+        mu, var = posterior.predict(X, full_cov=False)
+    std = np.sqrt(var)
 
     with np.errstate(divide='warn'):
         imp = mu - mu_sample_opt
         Z = imp / std
         ei = imp * norm.cdf(Z) + std * norm.pdf(Z)
         ei[std == 0.0] = 0.0
-        aei = ei*(1 - noise/np.sqrt(noise**2 + var**2))
+        aei = ei*(1 - posterior.noise/np.sqrt(posterior.noise**2 + var**2))
+
+    if return_grad:
+        dei, _ = expected_improvement_grad(Z, std, dmu, dvar)
+        r = np.sqrt(posterior.noise**2 + var**2)
+        daei = dei*(1 - posterior.noise/r) + ei*(posterior.noise*var/r**3)*dvar
+        return aei, daei
 
     return aei
 
 
-def augmented_one_off_expected_improvement(X, X_sample, Y_sample, noise, l_opt, sigma_f_opt, mu_sample_opt):
+def augmented_one_off_expected_improvement(X, posterior, mu_sample_opt, return_grad=False):
     """
     Computes the AEI using a homoscedastic GP with one-off noise-seeking behaviour.
 
     :param X: Test locations (n x d)
-    :param X_sample: Sample locations (m x d).
-    :param Y_sample:  Noise-corrupted values at the sample locations (m x 1).
-    :param noise: noise level in the latent function.
-    :param l_opt: optimised lengthscale(s) of the GP kernel.
-    :param sigma_f_opt: optimised vertical lengthscale of the GP kernel.
+    :param posterior: GPPosterior fitted to the samples.
     :param mu_sample_opt: incumbent eta
+    :param return_grad: whether to also return the gradient of the AEI with respect to X (n x d)
     :return: Expected improvements at points X.
     """
 
-    mu, var = bo_predict_homo_gp(X_sample, Y_sample, X, noise, l_opt, sigma_f_opt)
-    std = np.sqrt(np.diag(var))
+    if return_grad:
+        mu, var, dmu, dvar = posterior.predict_with_grad(X)
+    else:
+        mu, var = posterior.predict(X, full_cov=False)
+    std = np.sqrt(var)
 
     with np.errstate(divide='warn'):
         imp = mu - mu_sample_opt
         Z = imp / std
         ei = imp * norm.cdf(Z) + std * norm.pdf(Z)
         ei[std == 0.0] = 0.0
-        aei = ei*(1 - np.sqrt(noise**2 + var**2)/noise)
+        aei = ei*(1 - np.sqrt(posterior.noise**2 + var**2)/posterior.noise)
+
+    if return_grad:
+        dei, _ = expected_improvement_grad(Z, std, dmu, dvar)
+        r = np.sqrt(posterior.noise**2 + var**2)
+        daei = dei*(1 - r/posterior.noise) - ei*(var/(r*posterior.noise))*dvar
+        return aei, daei
 
     return aei
 
 
-def heteroscedastic_expected_improvement(X, X_sample, Y_sample, variance_estimator, noise_func, gp1_l_opt,
-                                         gp1_sigma_f_opt, gp2_l_opt, gp2_sigma_f_opt, gp2_noise, mu_sample_opt,
-                                         hetero_ei=True):
+def heteroscedastic_expected_improvement(X, posterior, mu_sample_opt, hetero_ei=True, return_grad=False):
     """
     Computes the EI using a heteroscedastic GP.
 
     :param X: Test locations (n x d)
-    :param X_sample: Sample locations (m x d)
-    :param Y_sample: Sample labels (m x 1)
-    :param variance_estimator: estimated variance at sample locations (m x 1)
-    :param noise_func: learned noise function
-    :param gp1_l_opt: optimised lengthscale for GP1
-    :param gp1_sigma_f_opt: optimised lengthscale for GP1
-    :param gp2_l_opt: optimised lengthscale for GP2
-    :param gp2_sigma_f_opt: optimised signal amplitude for GP2
-    :param gp2_noise: GP2 noise level
+    :param posterior: HeteroscedasticGPPosterior fitted to the samples.
     :param mu_sample_opt: incumbent eta
     :param hetero_ei: whether to use the ei minus one standard deviation as acquisition function
+    :param return_grad: whether to also return the gradient of the acquisition with respect to X (n x d)
     :return: expected improvement at the test locations.
     """
 
-    mu, var, aleatoric_std = bo_predict_hetero_gp(X_sample, Y_sample, variance_estimator, X, noise_func, gp1_l_opt, gp1_sigma_f_opt, gp2_noise, gp2_l_opt, gp2_sigma_f_opt)
-    std = np.sqrt(np.diag(var))
+    if return_grad:
+        mu, var, aleatoric_std, dmu, dvar, daleatoric_std = posterior.predict_with_grad(X)
+    else:
+        mu, var, aleatoric_std = posterior.predict(X)
+    var, aleatoric_std = var.reshape(mu.shape), aleatoric_std.reshape(mu.shape)
+    std = np.sqrt(var)
 
     if hetero_ei:
 
@@ -160,31 +195,33 @@ def heteroscedastic_expected_improvement(X, X_sample, Y_sample, variance_estimat
             ei = imp * norm.cdf(Z) + std * norm.pdf(Z)
             ei[std == 0.0] = 0.0
 
+    if return_grad:
+        dei, _ = expected_improvement_grad(Z, std, dmu, dvar)
+        if hetero_ei:
+            dei -= daleatoric_std
+            dei[np.ravel(std == 0.0)] = 0.0
+        return ei, dei
+
     return ei
 
-def heteroscedastic_one_off_expected_improvement(X, X_sample, Y_sample, variance_estimator, noise_func, gp1_l_opt,
-                                         gp1_sigma_f_opt, gp2_l_opt, gp2_sigma_f_opt, gp2_noise, mu_sample_opt,
-                                         hetero_ei=True):
+def heteroscedastic_one_off_expected_improvement(X, posterior, mu_sample_opt, hetero_ei=True, return_grad=False):
     """
     Computes the EI using a heteroscedastic GP.
 
     :param X: Test locations (n x d)
-    :param X_sample: Sample locations (m x d)
-    :param Y_sample: Sample labels (m x 1)
-    :param variance_estimator: estimated variance at sample locations (m x 1)
-    :param noise_func: learned noise function
-    :param gp1_l_opt: optimised lengthscale for GP1
-    :param gp1_sigma_f_opt: optimised lengthscale for GP1
-    :param gp2_l_opt: optimised lengthscale for GP2
-    :param gp2_sigma_f_opt: optimised signal amplitude for GP2
-    :param gp2_noise: GP2 noise level
+    :param posterior: HeteroscedasticGPPosterior fitted to the samples.
     :param mu_sample_opt: incumbent eta
     :param hetero_ei: whether to use the ei minus one standard deviation as acquisition function
+    :param return_grad: whether to also return the gradient of the acquisition with respect to X (n x d)
     :return: expected improvement at the test locations.
     """
 
-    mu, var, aleatoric_std = bo_predict_hetero_gp(X_sample, Y_sample, variance_estimator, X, noise_func, gp1_l_opt, gp1_sigma_f_opt, gp2_noise, gp2_l_opt, gp2_sigma_f_opt)
-    std = np.sqrt(np.diag(var))
+    if return_grad:
+        mu, var, aleatoric_std, dmu, dvar, daleatoric_std = posterior.predict_with_grad(X)
+    else:
+        mu, var, aleatoric_std = posterior.predict(X)
+    var, aleatoric_std = var.reshape(mu.shape), aleatoric_std.reshape(mu.shape)
+    std = np.sqrt(var)
 
     if hetero_ei:
 
@@ -202,35 +239,37 @@ def heteroscedastic_one_off_expected_improvement(X, X_sample, Y_sample, variance
             ei = imp * norm.cdf(Z) + std * norm.pdf(Z)
             ei[std == 0.0] = 0.0
 
+    if return_grad:
+        dei, _ = expected_improvement_grad(Z, std, dmu, dvar)
+        if hetero_ei:
+            dei += daleatoric_std
+            dei[np.ravel(std == 0.0)] = 0.0
+        return ei, dei
+
     return ei
 
 
-def heteroscedastic_augmented_expected_improvement(X, X_sample, Y_sample, variance_estimator, noise_func, gp1_l_opt,
-                                                   gp1_sigma_f_opt, gp2_l_opt, gp2_sigma_f_opt, gp2_noise, mu_sample_opt,
-                                                   hetero_ei=True):
+def heteroscedastic_augmented_expected_improvement(X, posterior, mu_sample_opt, hetero_ei=True, return_grad=False):
     """
     Computes the AEI using a heteroscedastic GP.
 
     :param X: Test locations (n x d)
-    :param X_sample: Sample locations (m x d)
-    :param Y_sample: Sample labels (m x 1)
-    :param variance_estimator: estimated variance at sample locations (m x 1)
-    :param noise_func: learned noise function
-    :param gp1_l_opt: optimised lengthscale for GP1
-    :param gp1_sigma_f_opt: optimised lengthscale for GP1
-    :param gp2_l_opt: optimised lengthscale for GP2
-    :param gp2_sigma_f_opt: optimised signal amplitude for GP2
-    :param gp2_noise: GP2 noise level
+    :param posterior: HeteroscedasticGPPosterior fitted to the samples.
     :param mu_sample_opt: incumbent eta
     :param hetero_ei: whether to use the ei minus one standard deviation as acquisition function
+    :param return_grad: whether to also return the gradient of the acquisition with respect to X (n x d)
     :return: expected improvement at the test locations.
     """
 
     # var is epistemic + aleatoric uncertainty
 
-    mu, var, aleatoric_std = bo_predict_hetero_gp(X_sample, Y_sample, variance_estimator, X, noise_func, gp1_l_opt, gp1_sigma_f_opt, gp2_noise, gp2_l_opt, gp2_sigma_f_opt)
+    if return_grad:
+        mu, var, aleatoric_std, dmu, dvar, daleatoric_std = posterior.predict_with_grad(X)
+    else:
+        mu, var, aleatoric_std = posterior.predict(X)
+    var, aleatoric_std = var.reshape(mu.shape), aleatoric_std.reshape(mu.shape)
     epistemic_unc = var - aleatoric_std
-    std = np.sqrt(np.diag(var))
+    std = np.sqrt(var)
     #std = np.sqrt(np.diag(epistemic_unc))
 
 
@@ -243,6 +282,15 @@ def heteroscedastic_augmented_expected_improvement(X, X_sample, Y_sample, varian
             ei[std == 0.0] = 0.0
             aei = ei*(1 - aleatoric_std/np.sqrt(aleatoric_std**2 + std**2))
 
+        if return_grad:
+
+            # The augmentation factor is f = 1 - s/r with r = sqrt(s^2 + std^2) where s is the aleatoric std.
+
+            dei, dstd = expected_improvement_grad(Z, std, dmu, dvar)
+            r = np.sqrt(aleatoric_std**2 + std**2)
+            df = -(std**2/r**3)*daleatoric_std + (aleatoric_std*std/r**3)*dstd
+            return aei, dei*(1 - aleatoric_std/r) + ei*df
+
         return aei
 
     else:
@@ -253,34 +301,33 @@ def heteroscedastic_augmented_expected_improvement(X, X_sample, Y_sample, varian
             ei = imp * norm.cdf(Z) + std * norm.pdf(Z)
             ei[std == 0.0] = 0.0
 
+        if return_grad:
+            dei, _ = expected_improvement_grad(Z, std, dmu, dvar)
+            return ei, dei
+
         return ei
 
 
-def heteroscedastic_one_off_augmented_expected_improvement(X, X_sample, Y_sample, variance_estimator, noise_func, gp1_l_opt,
-                                                   gp1_sigma_f_opt, gp2_l_opt, gp2_sigma_f_opt, gp2_noise, mu_sample_opt,
-                                                   hetero_ei=True):
+def heteroscedastic_one_off_augmented_expected_improvement(X, posterior, mu_sample_opt, hetero_ei=True, return_grad=False):
     """
     Computes the AEI using a heteroscedastic GP.
 
     :param X: Test locations (n x d)
-    :param X_sample: Sample locations (m x d)
-    :param Y_sample: Sample labels (m x 1)
-    :param variance_estimator: estimated variance at sample locations (m x 1)
-    :param noise_func: learned noise function
-    :param gp1_l_opt: optimised lengthscale for GP1
-    :param gp1_sigma_f_opt: optimised lengthscale for GP1
-    :param gp2_l_opt: optimised lengthscale for GP2
-    :param gp2_sigma_f_opt: optimised signal amplitude for GP2
-    :param gp2_noise: GP2 noise level
+    :param posterior: HeteroscedasticGPPosterior fitted to the samples.
     :param mu_sample_opt: incumbent eta
     :param hetero_ei: whether to use the ei plus one standard deviation as acquisition function
+    :param return_grad: whether to also return the gradient of the acquisition with respect to X (n x d)
     :return: expected improvement at the test locations.
     """
 
     # var is epistemic + aleatoric uncertainty
 
-    mu, var, aleatoric_std = bo_predict_hetero_gp(X_sample, Y_sample, variance_estimator, X, noise_func, gp1_l_opt, gp1_sigma_f_opt, gp2_noise, gp2_l_opt, gp2_sigma_f_opt)
-    std = np.sqrt(np.diag(var))
+    if return_grad:
+        mu, var, aleatoric_std, dmu, dvar, daleatoric_std = posterior.predict_with_grad(X)
+    else:
+        mu, var, aleatoric_std = posterior.predict(X)
+    var, aleatoric_std = var.reshape(mu.shape), aleatoric_std.reshape(mu.shape)
+    std = np.sqrt(var)
 
     if hetero_ei:
 
@@ -291,6 +338,15 @@ def heteroscedastic_one_off_augmented_expected_improvement(X, X_sample, Y_sample
             ei[std == 0.0] = 0.0
             aei = ei*(1 - np.sqrt(aleatoric_std**2 + std**2)/aleatoric_std)
 
+        if return_grad:
+
+            # The augmentation factor is f = 1 - r/s with r = sqrt(s^2 + std^2) where s is the aleatoric std.
+
+            dei, dstd = expected_improvement_grad(Z, std, dmu, dvar)
+            r = np.sqrt(aleatoric_std**2 + std**2)
+            df = (std**2/(r*aleatoric_std**2))*daleatoric_std - (std/(r*aleatoric_std))*dstd
+            return aei, dei*(1 - r/aleatoric_std) + ei*df
+
         return aei
 
     else:
@@ -301,11 +357,182 @@ def heteroscedastic_one_off_augmented_expected_improvement(X, X_sample, Y_sample
             ei = imp * norm.cdf(Z) + std * norm.pdf(Z)
             ei[std == 0.0] = 0.0
 
+        if return_grad:
+            dei, _ = expected_improvement_grad(Z, std, dmu, dvar)
+            return ei, dei
+
         return ei
 
 
+def refine_acquisition(acquisition, posterior, mu_sample_opt, starts, bounds, acquisition_kwargs):
+    """
+    Maximise an acquisition function with L-BFGS-B from each of a chunk of starting points. Defined at module level so
+    that it can be run on a worker process; the fitted posterior is pickled once per chunk rather than once per start.
+
+    :param acquisition: acquisition function supporting return_grad.
+    :param posterior: GPPosterior or HeteroscedasticGPPosterior fitted to the samples.
+    :param mu_sample_opt: incumbent eta
+    :param starts: starting points (k x d)
+    :param bounds: bounds of the BO problem (d x 2)
+    :param acquisition_kwargs: dictionary of extra arguments passed to the acquisition.
+    :return: list of per-restart diagnostics, dictionaries holding the start x0, the optimum x, the acquisition value
+             there, the number of iterations nit, the number of acquisition evaluations nfev and the optimiser's
+             success flag.
+    """
+
+    def min_obj(X):
+        """
+        Minimisation objective is the negative acquisition function.
+
+        :param X: points at which objective is evaluated.
+        :return: minimisation objective and its gradient.
+        """
+
+        value, grad = acquisition(X.reshape(1, -1), posterior, mu_sample_opt, return_grad=True, **acquisition_kwargs)
+
+        return -value.item(), -grad.ravel()
+
+    diagnostics = []
+
+    for x0 in starts:
+        res = minimize(min_obj, x0=x0, bounds=bounds, method='L-BFGS-B', jac=True)
+        diagnostics.append({'x0': x0, 'x': res.x, 'value': -float(res.fun), 'nit': res.nit, 'nfev': res.nfev,
+                            'success': res.success})
+
+    return diagnostics
+
+
+def optimise_acquisition(acquisition, posterior, mu_sample_opt, bounds, n_candidates=10000, n_restarts=1,
+                         batch_size=2048, executor=None, return_diagnostics=False, **acquisition_kwargs):
+    """
+    Maximises an acquisition function over the bounds of the BO problem. The acquisition is first scored at a scrambled
+    Sobol sample of n_candidates points, in batches of batch_size so that the memory taken by the m x batch_size cross
+    covariance stays bounded, and the n_restarts best candidates are then refined with L-BFGS-B using the analytic
+    gradient of the acquisition. The best point found is always returned.
+
+    :param acquisition: acquisition function supporting return_grad.
+    :param posterior: GPPosterior or HeteroscedasticGPPosterior fitted to the samples.
+    :param mu_sample_opt: incumbent eta
+    :param bounds: bounds of the BO problem. Either (2, ) or (2 x 1) for a single dimension or (d x 2).
+    :param n_candidates: number of quasi-random candidates scored, rounded up to a power of 2 as a truncated Sobol
+                         sequence loses its balance properties.
+    :param n_restarts: number of the best candidates refined with L-BFGS-B.
+    :param batch_size: number of candidates scored per batched posterior evaluation.
+    :param executor: concurrent.futures executor on which to run the restarts. The restarts are split into one chunk
+                     per worker of the executor, or per core if it does not report its number of workers, and the
+                     posterior is shipped once with each chunk. If None the restarts are run in the
+                     calling process.
+    :param return_diagnostics: whether to additionally return the per-restart diagnostics. See refine_acquisition.
+    :param acquisition_kwargs: extra arguments passed to the acquisition e.g. hetero_ei=True.
+    :return: Location of the acquisition function maximum (1 x d).
+    """
+
+    bounds = np.array(bounds, dtype=np.float64).reshape(-1, 2)
+    dim = len(bounds)
+
+    sampler = qmc.Sobol(d=dim, seed=np.random.randint(2**31 - 1))
+    candidates = qmc.scale(sampler.random_base2(int(np.ceil(np.log2(n_candidates)))), bounds[:, 0], bounds[:, 1])
+    values = np.concatenate([np.ravel(acquisition(candidates[i:i + batch_size], posterior, mu_sample_opt, **acquisition_kwargs))
+                             for i in range(0, len(candidates), batch_size)])
+    values[np.isnan(values)] = -np.inf
+
+    top_k = np.argsort(-values, kind='stable')[:n_restarts]
+    max_x, max_val = candidates[top_k[0]], values[top_k[0]]
+
+    if executor is None:
+        diagnostics = refine_acquisition(acquisition, posterior, mu_sample_opt, candidates[top_k], bounds, acquisition_kwargs)
+    else:
+        n_workers = getattr(executor, '_max_workers', None) or os.cpu_count() or 1
+        chunks = np.array_split(candidates[top_k], min(len(top_k), n_workers))
+        futures = [executor.submit(refine_acquisition, acquisition, posterior, mu_sample_opt, chunk, bounds, acquisition_kwargs)
+                   for chunk in chunks]
+        diagnostics = [row for future in futures for row in future.result()]
+
+    for row in diagnostics:
+        if row['value'] > max_val:
+            max_val = row['value']
+            max_x = row['x']
+
+    if return_diagnostics:
+        return max_x.reshape(1, -1), diagnostics
+
+    return max_x.reshape(1, -1)
+
+
+def propose_batch(acquisition, posterior, mu_sample_opt, bounds, q, strategy='constant_liar', lie=None,
+                  noise_func=None, n_candidates=10000, n_restarts=1, executor=None, return_diagnostics=False,
+                  **acquisition_kwargs):
+    """
+    Proposes q points to be evaluated in parallel. The points are chosen greedily: after each point is proposed a fantasy
+    observation is appended to a copy of the posterior so that the variance there collapses and the next maximiser of
+    the acquisition lies elsewhere. The fitted posterior itself is left unchanged.
+
+    :param acquisition: acquisition function supporting return_grad.
+    :param posterior: GPPosterior or HeteroscedasticGPPosterior fitted to the samples.
+    :param mu_sample_opt: incumbent eta
+    :param bounds: bounds of the BO problem.
+    :param q: number of points to propose.
+    :param strategy: 'kriging_believer' uses the posterior mean at each proposed point as its fantasy observation and
+                     'constant_liar' uses the constant lie. Under high noise a believed observation barely reduces the
+                     variance and the kriging believer tends to replicate points whereas the pessimistic lie pushes the
+                     batch apart.
+    :param lie: fantasy observation for the constant liar. Defaults to the minimum of the observed targets, a
+                pessimistic lie when maximising.
+    :param noise_func: function mapping input locations (k x d) to noise levels (k x 1) of the fantasy observations e.g.
+                       HeteroscedasticGPState.predict_noise. Defaults to the GP2 prediction of a
+                       HeteroscedasticGPPosterior and is ignored for a GPPosterior with a scalar noise level.
+    :param n_candidates: number of quasi-random candidates scored per point. See optimise_acquisition.
+    :param n_restarts: number of the best candidates refined per point.
+    :param executor: concurrent.futures executor on which to run the restarts. See optimise_acquisition.
+    :param return_diagnostics: whether to additionally return the per-restart diagnostics of each point.
+    :param acquisition_kwargs: extra arguments passed to the acquisition e.g. hetero_ei=True.
+    :return: proposed locations (q x d)
+    """
+
+    assert strategy in ['kriging_believer', 'constant_liar'], 'strategy must be kriging_believer or constant_liar'
+
+    fantasy = copy.deepcopy(posterior)
+    gp1 = fantasy.gp1 if hasattr(fantasy, 'gp1') else fantasy
+
+    if noise_func is None and hasattr(posterior, 'predict_noise'):  # GP2 isn't changed by the fantasies
+        noise_func = posterior.predict_noise
+
+    if lie is None:
+        lie = np.min(gp1.ys)
+
+    X_batch = []
+    diagnostics = []
+
+    for i in range(q):
+        X_next, diag = optimise_acquisition(acquisition, fantasy, mu_sample_opt, bounds, n_candidates, n_restarts,
+                                            executor=executor, return_diagnostics=True, **acquisition_kwargs)
+        X_batch.append(X_next)
+        diagnostics.append(diag)
+
+        if i == q - 1:
+            break
+
+        if strategy == 'kriging_believer':
+            Y_fantasy, _ = gp1.predict(X_next, full_cov=False)
+        else:
+            Y_fantasy = np.full((1, 1), lie)
+
+        if noise_func is not None:
+            fantasy.append(X_next, Y_fantasy, noise_func(X_next))
+        else:
+            fantasy.append(X_next, Y_fantasy)
+
+        mu_sample_opt = max(mu_sample_opt, Y_fantasy.item())
+
+    if return_diagnostics:
+        return np.vstack(X_batch), diagnostics
+
+    return np.vstack(X_batch)
+
+
 def my_propose_location(acquisition, X_sample, Y_sample, noise, l_init, sigma_f_init, bounds, plot_sample, n_restarts=1,
-                        min_val=1):
+                        posterior=None, n_candidates=10000, executor=None, return_diagnostics=False, q=1,
+                        strategy='constant_liar'):
     """
     Proposes the next sampling point by optimising the acquisition function.
 
@@ -317,57 +544,43 @@ def my_propose_location(acquisition, X_sample, Y_sample, noise, l_init, sigma_f_
     :param sigma_f_init: vertical lengthscale to start optimisation with.
     :param bounds: bounds of the BO problem.
     :param plot_sample: for plotting the predictive mean and variance. Same for as X_sample but usually bigger.
-    :param n_restarts: number of restarts for the optimiser.
-    :param min_val: minimum value to do better than (will likely change depending on the problem).
-    :return: Location of the acquisition function maximum.
+    :param n_restarts: number of the best candidates refined by the optimiser.
+    :param posterior: GPPosterior already fitted to (X_sample, Y_sample). If None the GP is fitted here.
+    :param n_candidates: number of quasi-random candidates at which the acquisition is scored. See optimise_acquisition.
+    :param executor: concurrent.futures executor on which to run the restarts. If None they are run in this process.
+    :param return_diagnostics: whether to additionally return the per-restart diagnostics (nit, nfev, final value).
+    :param q: number of points to propose. If greater than 1 a batch is proposed with propose_batch.
+    :param strategy: fantasy strategy for batch proposals. See propose_batch.
+    :return: Location of the acquisition function maximum, or the batch of locations (q x d) if q > 1.
     """
 
-    dim = X_sample.shape[1]
-    min_x = None
+    if posterior is None:
+        l_opt, sigma_f_opt, noise = bo_fit_homo_gp(X_sample, Y_sample, noise, l_init, sigma_f_init)
+        posterior = GPPosterior(X_sample, Y_sample, noise, l_opt, sigma_f_opt)
 
-    l_opt, sigma_f_opt, noise = bo_fit_homo_gp(X_sample, Y_sample, noise, l_init, sigma_f_init)
-    #l_opt, sigma_f_opt = bo_fit_homo_gp(X_sample, Y_sample, noise, l_init, sigma_f_init)
+    # Set f_plot to True to plot the predictive mean at the plotting locations (uniformly spaced in the bounds).
 
-    # Purpose of this line is just to plot.
+    f_plot = False
 
-    _, _ = bo_predict_homo_gp(X_sample, Y_sample, plot_sample, noise, l_opt, sigma_f_opt, f_plot=False)  # predictive mean at test locations (uniformly spaced in the bounds.
+    if f_plot:
+        _, _ = bo_predict_homo_gp(X_sample, Y_sample, plot_sample, posterior.noise, posterior.l, posterior.sigma_f, f_plot=True)
 
-    mu_sample, _ = bo_predict_homo_gp(X_sample, Y_sample, X_sample, noise, l_opt, sigma_f_opt)  # predictive mean for sample locations
+    mu_sample, _ = posterior.predict(X_sample, full_cov=False)  # predictive mean for sample locations
     mu_sample_opt = np.max(mu_sample)
 
-    def min_obj(X):
-        """
-        Minimisation objective is the negative acquisition function.
+    if q > 1:
+        return propose_batch(acquisition, posterior, mu_sample_opt, bounds, q, strategy, n_candidates=n_candidates,
+                             n_restarts=n_restarts, executor=executor, return_diagnostics=return_diagnostics)
 
-        :param X: points at which objective is evaluated.
-        :return: minimisation objective.
-        """
-
-        X = X.reshape(-1, 1).T  # Might have to be changed for higher dimensions (have added .T since writing this)
-
-        return -acquisition(X, X_sample, Y_sample, noise, l_opt, sigma_f_opt, mu_sample_opt)
-
-    # Find the best optimum by starting from n_restart different random points.
-
-    if dim == 1:  # change bounds for a single dimensions. Added for UCI dataset NAS experiments
-        for x0 in np.random.uniform(bounds[0], bounds[1], size=(n_restarts, dim)):
-            res = minimize(min_obj, x0=x0, bounds=bounds.reshape(-1, 2), method='L-BFGS-B')
-            if res.fun < min_val:
-                min_val = res.fun[0]
-                min_x = res.x
-    else:
-        for x0 in np.random.uniform(bounds[:, 0], bounds[:, 1], size=(n_restarts, dim)):
-            res = minimize(min_obj, x0=x0, bounds=bounds, method='L-BFGS-B')
-            if res.fun < min_val:
-                min_val = res.fun[0]
-                min_x = res.x
-
-    return min_x.reshape(-1, 1).T
+    return optimise_acquisition(acquisition, posterior, mu_sample_opt, bounds, n_candidates, n_restarts,
+                                executor=executor, return_diagnostics=return_diagnostics)
 
 
 def heteroscedastic_propose_location(acquisition, X_sample, Y_sample, noise, l_init, sigma_f_init,
                                      l_noise_init, sigma_f_noise_init, gp2_noise, num_iters, sample_size,
-                                     bounds, plot_sample, n_restarts=25, min_val=600):
+                                     bounds, plot_sample, n_restarts=25, posterior=None, n_candidates=10000,
+                                     executor=None, return_diagnostics=False, q=1, strategy='constant_liar',
+                                     noise_func=None, backend='exact', num_inducing=100):
     """
     Proposes the next sampling point by optimising the acquisition function.
 
@@ -384,51 +597,49 @@ def heteroscedastic_propose_location(acquisition, X_sample, Y_sample, noise, l_i
     :param sample_size: samples for variance estimator.
     :param bounds: bounds of the BO problem.
     :param plot_sample: for plotting the predictive mean and variance. Same for as X_sample but usually bigger.
-    :param n_restarts: number of restarts for the optimiser.
-    :param min_val: minimum value to do better than (will likely change depending on the problem).
-    :return: Location of the acquisition function maximum.
+    :param n_restarts: number of the best candidates refined by the optimiser.
+    :param posterior: HeteroscedasticGPPosterior already fitted to (X_sample, Y_sample). If None the heteroscedastic GP
+                      is fitted here.
+    :param n_candidates: number of quasi-random candidates at which the acquisition is scored. See optimise_acquisition.
+    :param executor: concurrent.futures executor on which to run the restarts. If None they are run in this process.
+    :param return_diagnostics: whether to additionally return the per-restart diagnostics (nit, nfev, final value).
+    :param q: number of points to propose. If greater than 1 a batch is proposed with propose_batch.
+    :param strategy: fantasy strategy for batch proposals. See propose_batch.
+    :param noise_func: noise levels of the fantasy observations e.g. HeteroscedasticGPState.predict_noise. Defaults to
+                       the GP2 prediction of the posterior. See propose_batch.
+    :param backend: 'exact' or 'sparse'. Used for both the fit and the posterior if posterior is None. See
+                    bo_gp_fit_predict.bo_hetero_posterior.
+    :param num_inducing: number of inducing inputs of each GP with the 'sparse' backend.
+    :return: Location of the acquisition function maximum, or the batch of locations (q x d) if q > 1.
     """
 
-    dim = X_sample.shape[1]
-    min_x = None
-
-    # Set f_plot to true if you want to test whether the first iteration of the heteroscedastic GP is equivalent to the homoscedastic GP.
+    if posterior is None:
 
-    noise_func, gp2_noise, gp1_l_opt, gp1_sigma_f_opt, gp2_l_opt, gp2_sigma_f_opt, variance_estimator = \
-        bo_fit_hetero_gp(X_sample, Y_sample, noise, l_init, sigma_f_init, l_noise_init, sigma_f_noise_init, gp2_noise, num_iters, sample_size, plot_sample, f_plot=False)
+        # Set f_plot to true if you want to test whether the first iteration of the heteroscedastic GP is equivalent to the homoscedastic GP.
 
-    # Purpose of this line is for plotting.
+        dimensionality = X_sample.shape[1]
+        gp1_hypers = [l_init]*dimensionality + [sigma_f_init]
+        gp2_hypers = [l_noise_init]*dimensionality + [sigma_f_noise_init]
 
-    _, _, _ = bo_predict_hetero_gp(X_sample, Y_sample, variance_estimator, X_sample, noise_func, gp1_l_opt, gp1_sigma_f_opt, gp2_noise, gp2_l_opt, gp2_sigma_f_opt, f_plot=False, f_plot2=False)
+        # bo_hetero_em also returns the StandardScaler of the GP2 targets, which predict_noise needs in order to give
+        # the fantasy noise levels on the scale of the learned noise.
 
-    mu_sample, _, _ = bo_predict_hetero_gp(X_sample, Y_sample, variance_estimator, X_sample, noise_func, gp1_l_opt, gp1_sigma_f_opt, gp2_noise, gp2_l_opt, gp2_sigma_f_opt)
-    mu_sample_opt = np.max(mu_sample)
-
-    def min_obj(X):
-        """
-        Minimisation objective is the negative acquisition function.
+        learned_noise, gp1_hypers, gp2_hypers, variance_estimator, Y_scaler, _ = \
+            bo_hetero_em(X_sample, Y_sample, noise, gp1_hypers, gp2_hypers, gp2_noise, num_iters, sample_size,
+                         plot_sample, f_plot=False, backend=backend, num_inducing=num_inducing)
 
-        :param X: points at which objective is evaluated.
-        :return: minimisation objective.
-        """
+        posterior = bo_hetero_posterior(X_sample, Y_sample, variance_estimator, learned_noise,
+                                        np.array(gp1_hypers[:-1]).reshape(-1, 1), gp1_hypers[-1], gp2_noise,
+                                        np.array(gp2_hypers[:-1]).reshape(-1, 1), gp2_hypers[-1], Y_scaler,
+                                        backend=backend, num_inducing=num_inducing)
 
-        X = X.reshape(-1, 1).T  # Might have to be changed for higher dimensions.
+    mu_sample, _, _ = posterior.predict(X_sample)
+    mu_sample_opt = np.max(mu_sample)
 
-        #return -acquisition(X, X_sample, Y_sample, noise, l_init, sigma_f_init, l_noise_init, sigma_f_noise_init, gp2_noise, num_iters, sample_size)
-        return -acquisition(X, X_sample, Y_sample, variance_estimator, noise_func, gp1_l_opt, gp1_sigma_f_opt, gp2_l_opt, gp2_sigma_f_opt, gp2_noise, mu_sample_opt, hetero_ei=True)
+    if q > 1:
+        return propose_batch(acquisition, posterior, mu_sample_opt, bounds, q, strategy, noise_func=noise_func,
+                             n_candidates=n_candidates, n_restarts=n_restarts, executor=executor,
+                             return_diagnostics=return_diagnostics, hetero_ei=True)
 
-    if dim == 1:  # change bounds for a single dimensions. Added for UCI dataset NAS experiments
-        for x0 in np.random.uniform(bounds[0], bounds[1], size=(n_restarts, dim)):
-            res = minimize(min_obj, x0=x0, bounds=bounds.reshape(-1, 2), method='L-BFGS-B')
-            if res.fun < min_val:
-                min_val = res.fun[0]
-                min_x = res.x
-    else:
-        # Find the best optimum by starting from n_restart different random points.
-        for x0 in np.random.uniform(bounds[:, 0], bounds[:, 1], size=(n_restarts, dim)):
-            res = minimize(min_obj, x0=x0, bounds=bounds, method='L-BFGS-B')
-            if res.fun < min_val:
-                min_val = res.fun[0]
-                min_x = res.x
-
-    return min_x.reshape(-1, 1).T  # added the transpose for (2,) cases. shouldn't affect (1,) cases.
+    return optimise_acquisition(acquisition, posterior, mu_sample_opt, bounds, n_candidates, n_restarts,
+                                executor=executor, return_diagnostics=return_diagnostics, hetero_ei=True)
@@ -11,7 +11,7 @@ from datasets import williams_1996, silverman_1985, goldberg_1998, yuan_2004, li
 from gp_fitting import fit_hetero_gp, fit_homo_gp
 from kernels import scipy_kernel
 from mean_functions import zero_mean
-from utils import posterior_predictive_krasser, nlpd, one_d_train_test_split, posterior_predictive
+from utils import posterior_predictive_krasser, nlpd, one_d_train_test_split, posterior_predictive_chunks
 
 
 if __name__ == '__main__':
@@ -50,10 +50,12 @@ if __name__ == '__main__':
     print(gp2_l_opt)
     print(gp2_sigma_f_opt)
 
-    pred_mean_het, pred_var_het, _, _ = posterior_predictive(xs_train, ys_train, xs_test, noise_func, gp1_l_opt, gp1_sigma_f_opt, mean_func=zero_mean, kernel=scipy_kernel)
-    pred_mean_noise, _, _, _ = posterior_predictive(xs_train, variance_estimator, xs_test, gp2_noise, gp2_l_opt, gp2_sigma_f_opt, mean_func=zero_mean, kernel=scipy_kernel)
+    # The test set is predicted in chunks so that only marginal variances are computed.
+
+    pred_mean_het, pred_var_het = map(np.vstack, zip(*posterior_predictive_chunks(xs_train, ys_train, xs_test, noise_func, gp1_l_opt, gp1_sigma_f_opt, mean_func=zero_mean, kernel=scipy_kernel)))
+    pred_mean_noise, _ = map(np.vstack, zip(*posterior_predictive_chunks(xs_train, variance_estimator, xs_test, gp2_noise, gp2_l_opt, gp2_sigma_f_opt, mean_func=zero_mean, kernel=scipy_kernel)))
 
     pred_mean_noise = np.exp(pred_mean_noise).reshape(len(pred_mean_noise))
-    nlpd_val_het = nlpd(pred_mean_het, np.diag(pred_var_het) + pred_mean_noise, ys_test)
+    nlpd_val_het = nlpd(pred_mean_het, pred_var_het.reshape(len(pred_var_het)) + pred_mean_noise, ys_test)
 
     print(nlpd_val_het)
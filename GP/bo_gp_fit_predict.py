@@ -5,17 +5,22 @@ This module contains GP fit and predict functions for use in Bayesian Optimisati
 the fitting and predict functions have been separated.
 """
 
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 from matplotlib import pyplot as plt
-from scipy.optimize import minimize
 from sklearn.preprocessing import StandardScaler
 
 from utils import plot_het_gp1, plot_het_gp2
-from kernels import scipy_kernel
-from utils import posterior_predictive, zero_mean, nll_fn_het
+from gp_multistart import multistart_minimise_nll
+from gp_posterior import GPPosterior, HeteroscedasticGPPosterior, SparseGPPosterior
+from kernels import SqDistCache, scipy_kernel
+from sparse_gp import nll_fn_het_sparse_grad, select_inducing, sparse_posterior_predictive
+from utils import most_likely_variance_estimator, zero_mean, nll_fn_grad, nll_fn_het_grad, relative_change, nll_fn_batch, \
+    nll_fn_het_batch
 
 
-def bo_fit_homo_gp(xs, ys, noise, l_init, sigma_f_init):
+def bo_fit_homo_gp(xs, ys, noise, l_init, sigma_f_init, n_restarts=1, executor=None, n_screen=0):
     """
     Fit a homoscedastic GP to data (xs, ys) and return the optimised hypers.
 
@@ -24,6 +29,11 @@ def bo_fit_homo_gp(xs, ys, noise, l_init, sigma_f_init):
     :param noise: fixed noise level or noise function
     :param l_init: lengthscale(s) to initialise the optimiser
     :param sigma_f_init: signal amplitude to initialise the optimiser
+    :param n_restarts: number of starts of the optimiser. The first start is (l_init, sigma_f_init, noise) and the rest
+                       are drawn at random within the bounds. See gp_multistart.multistart_minimise_nll.
+    :param executor: concurrent.futures executor to run the restarts on. If None a process pool is created per fit.
+    :param n_screen: number of Sobol samples of the hyperparameters scored in a single batched computation before the
+                     optimiser is run. If positive the optimiser is started from the n_restarts best samples.
     :return: Optimised kernel hyperparaemters.
     """
 
@@ -35,11 +45,11 @@ def bo_fit_homo_gp(xs, ys, noise, l_init, sigma_f_init):
 
     # We fit GP1 to the data
 
-    res = minimize(nll_fn_het(xs, ys, noise), hypers, bounds=bounds, method='L-BFGS-B')
+    res, _ = multistart_minimise_nll(nll_fn_grad, (xs, ys), hypers, bounds, n_restarts, executor, nll_fn_batch, n_screen)
 
-    l_opt = np.array(res.x[:-2]).reshape(-1, 1)
-    sigma_f_opt = res.x[-2]
-    noise_opt = res.x[-1]
+    l_opt = np.array(res['x'][:-2]).reshape(-1, 1)
+    sigma_f_opt = res['x'][-2]
+    noise_opt = res['x'][-1]
 
     #sigma_f_opt = res.x[-1]
 
@@ -48,7 +58,7 @@ def bo_fit_homo_gp(xs, ys, noise, l_init, sigma_f_init):
     #return l_opt, sigma_f_opt
 
 
-def bo_predict_homo_gp(xs, ys, xs_star, noise, l_opt, sigma_f_opt, f_plot=False):
+def bo_predict_homo_gp(xs, ys, xs_star, noise, l_opt, sigma_f_opt, f_plot=False, full_cov=True):
     """
     Compute predictions at new test locations xs_star for the homoscedastic GP.
 
@@ -59,13 +69,14 @@ def bo_predict_homo_gp(xs, ys, xs_star, noise, l_opt, sigma_f_opt, f_plot=False)
     :param l_opt: optimised kernel lengthscale
     :param sigma_f_opt: optimised kernel signal amplitude
     :param f_plot: Whether to plot the GP fit
+    :param full_cov: Whether to return the full predictive covariance matrix or only the marginal variances (m x 1)
     :return: predictive mean and variance
     """
 
-    pred_mean, pred_var, _, _ = posterior_predictive(xs, ys, xs_star, noise, l_opt, sigma_f_opt, mean_func=zero_mean, kernel=scipy_kernel)
+    pred_mean, pred_var = GPPosterior(xs, ys, noise, l_opt, sigma_f_opt, mean_func=zero_mean, kernel=scipy_kernel).predict(xs_star, full_cov)
 
     if f_plot:
-        gp1_plot_pred_var = np.diag(pred_var).reshape(-1, 1)  # Take the diagonal of the covariance matrix for plotting purposes
+        gp1_plot_pred_var = np.diag(pred_var).reshape(-1, 1) if full_cov else pred_var  # Take the diagonal of the covariance matrix for plotting purposes
         plt.plot(xs, ys, '+', color='green', markersize='12', linewidth='8')
         plt.plot(xs_star, pred_mean, '-', color='red')
         upper = pred_mean + 2 * np.sqrt(gp1_plot_pred_var)
@@ -82,85 +93,265 @@ def bo_predict_homo_gp(xs, ys, xs_star, noise, l_opt, sigma_f_opt, f_plot=False)
     return pred_mean, pred_var
 
 
-def bo_fit_hetero_gp(xs, ys, noise, l_init, sigma_f_init, l_noise_init, sigma_f_noise_init, gp2_noise, num_iters, sample_size, plot_sample, f_plot=False):
+def bo_hetero_em_step(xs, ys, noise, gp1_hypers, gp2_hypers, gp2_noise, sample_size, plot_sample, f_plot=False,
+                      estimator='cholesky', n_restarts=1, executor=None, n_screen=0, backend='exact', num_inducing=100,
+                      inducing='kmeans', approximation='vfe'):
     """
-    Fit a heteroscedastic GP to data (xs, ys).
+    Run a single iteration of the most likely heteroscedastic GP algorithm: fit GP1 with the current noise function,
+    estimate the noise at the sample locations and fit GP2 to the log of the estimate.
 
     :param xs: sample locations (m x d)
     :param ys: sample labels (m x 1)
-    :param noise: fixed noise level or noise function
-    :param l_init: lengthscale(s) to initialise the optimiser
-    :param sigma_f_init: signal amplitude to initialise the optimiser
-    :param l_noise_init: lengthscale(s) to initialise the optimiser for the noise
-    :param sigma_f_noise_init: signal amplitude to initialise the optimiser for the noise
+    :param noise: current noise function. Either a scalar or a vector of per-point noise levels (m x 1)
+    :param gp1_hypers: hyperparameters [l_1, ..., l_d, sigma_f] to initialise the optimiser for GP1
+    :param gp2_hypers: hyperparameters [l_1, ..., l_d, sigma_f] to initialise the optimiser for GP2
     :param gp2_noise: the noise level for the second GP modelling the noise (noise of the noise)
-    :param num_iters: number of iterations to run the most likely heteroscedastic GP algorithm.
     :param sample_size: the number of samples for the heteroscedastic GP algorithm.
     :param plot_sample: Sample for plotting.
     :param f_plot: Boolean indicating whether to plot or not
-    :return: The noise function, variance estimator and GP1 and GP2 hypers.
+    :param estimator: how to compute the variance estimator. See utils.most_likely_variance_estimator.
+    :param n_restarts: number of starts of the optimiser for each of GP1 and GP2. See bo_fit_homo_gp.
+    :param executor: concurrent.futures executor to run the restarts on.
+    :param n_screen: number of Sobol samples of the hyperparameters screened for each GP1 and GP2 fit. See
+                     bo_fit_homo_gp. Ignored by the 'sparse' backend.
+    :param backend: 'exact' or 'sparse'. 'sparse' fits GP1 and GP2 as inducing point GPs (sparse_gp.py) at a cost of
+                    O(m num_inducing^2) per objective evaluation rather than O(m^3).
+    :param num_inducing: number of inducing inputs of each GP with the 'sparse' backend.
+    :param inducing: how the inducing inputs are chosen, 'kmeans' or 'greedy'. See sparse_gp.select_inducing.
+    :param approximation: 'vfe' or 'fitc'. See sparse_gp.py.
+    :return: The updated noise function (m x 1), the optimised GP1 and GP2 hypers, the standardised log variance
+             estimator, the StandardScaler used to standardise it and the GP1 negative log marginal likelihood.
     """
 
-    dimensionality = xs.shape[1]  # in order to plot only in the 1D input case.
-    gp1_hypers = [l_init]*dimensionality + [sigma_f_init]  # we initialise each dimension with the same lengthscale value
-    gp2_hypers = [l_noise_init]*dimensionality + [sigma_f_noise_init]  # we initialise each dimensions with the same lengthscale value for gp2 as well.
     bounds = [(0.1, 900)]*len(gp1_hypers)  # we initialise the bounds to be the same in each case
+    dist_cache = SqDistCache(xs) if backend == 'exact' else None  # shared by every GP1 and GP2 objective evaluation
 
-    for i in range(0, num_iters):
+    # We fit GP1 to the data
 
-        # We fit GP1 to the data
+    if backend == 'sparse':
+        gp1_Z = select_inducing(xs, num_inducing, inducing, gp1_hypers[:-1], gp1_hypers[-1])
+        gp1_res, _ = multistart_minimise_nll(nll_fn_het_sparse_grad, (xs, ys, noise, gp1_Z, approximation), gp1_hypers,
+                                             bounds, n_restarts, executor)
+    else:
+        gp1_res, _ = multistart_minimise_nll(nll_fn_het_grad, (xs, ys, noise, dist_cache), gp1_hypers, bounds, n_restarts, executor,
+                                             nll_fn_het_batch, n_screen)
+    gp1_l_opt = np.array(gp1_res['x'][:-1]).reshape(-1, 1)
+    gp1_sigma_f_opt = gp1_res['x'][-1]
+
+    # Line included for plotting purposes
+
+    if f_plot:
 
-        gp1_res = minimize(nll_fn_het(xs, ys, noise), gp1_hypers, bounds=bounds, method='L-BFGS-B')
-        gp1_l_opt = np.array(gp1_res.x[:-1]).reshape(-1, 1)
-        gp1_sigma_f_opt = gp1_res.x[-1]
-        gp1_hypers = list(np.ndarray.flatten(gp1_l_opt)) + [gp1_sigma_f_opt]  # we initialise the optimisation at the next iteration with the optimised hypers
+        _ = plot_het_gp1(xs, ys, plot_sample, noise, gp1_l_opt, gp1_sigma_f_opt)
 
-        # Line included for plotting purposes
+    # We compute the posterior predictive at the test locations
 
-        if f_plot:
+    if backend == 'sparse':
+        gp1_pred_mean, gp1_pred_var = sparse_posterior_predictive(xs, ys, xs, gp1_Z, noise, gp1_l_opt, gp1_sigma_f_opt,
+                                                                  approximation)
+    else:
+        gp1_pred_mean, gp1_pred_var = bo_predict_homo_gp(xs, ys, xs, noise, gp1_l_opt, gp1_sigma_f_opt, full_cov=(estimator != 'exact'))
 
-            _ = plot_het_gp1(xs, ys, plot_sample, noise, gp1_l_opt, gp1_sigma_f_opt)
+    # We construct the most likely heteroscedastic GP noise estimator
 
-        # We compute the posterior predictive at the test locations
+    variance_estimator = most_likely_variance_estimator(ys, gp1_pred_mean, gp1_pred_var, sample_size, estimator)  # Equation given in section 4 of Kersting et al. vector of noise for each data point.
+    variance_estimator = np.log(variance_estimator)
 
-        gp1_pred_mean, gp1_pred_var = bo_predict_homo_gp(xs, ys, xs, noise, gp1_l_opt, gp1_sigma_f_opt)
+    # we reshape the variance estimator here so that it can be passed into posterior_predictive.
 
-        # We construct the most likely heteroscedastic GP noise estimator
+    variance_estimator = variance_estimator.reshape(len(variance_estimator), 1)
 
-        sample_matrix = np.zeros((len(ys), sample_size))
-        for j in range(0, sample_size):
-            sample_matrix[:, j] = np.random.multivariate_normal(gp1_pred_mean.reshape(len(gp1_pred_mean)), gp1_pred_var)
-        variance_estimator = (0.5 / sample_size) * np.sum((ys - sample_matrix) ** 2, axis=1)  # Equation given in section 4 of Kersting et al. vector of noise for each data point.
-        variance_estimator = np.log(variance_estimator)
+    Y_scaler = StandardScaler().fit(variance_estimator)
+    variance_estimator = Y_scaler.transform(variance_estimator)
+
+    # We fit a second GP to the auxiliary dataset z = (xs, variance_estimator)
+
+    if backend == 'sparse':
+        gp2_Z = select_inducing(xs, num_inducing, inducing, gp2_hypers[:-1], gp2_hypers[-1])
+        gp2_res, _ = multistart_minimise_nll(nll_fn_het_sparse_grad, (xs, variance_estimator, gp2_noise, gp2_Z,
+                                                                      approximation), gp2_hypers, bounds, n_restarts,
+                                             executor)
+    else:
+        gp2_res, _ = multistart_minimise_nll(nll_fn_het_grad, (xs, variance_estimator, gp2_noise, dist_cache), gp2_hypers, bounds,
+                                             n_restarts, executor, nll_fn_het_batch, n_screen)
+    gp2_l_opt = np.array(gp2_res['x'][:-1]).reshape(-1, 1)
+    gp2_sigma_f_opt = gp2_res['x'][-1]
+
+    # Line included for plotting purposes
+
+    if f_plot:
 
-        # we reshape the variance estimator here so that it can be passed into posterior_predictive.
+        _ = plot_het_gp2(xs, variance_estimator, plot_sample, gp2_noise, gp2_l_opt, gp2_sigma_f_opt)
+
+    if backend == 'sparse':
+        gp2_pred_mean, _ = sparse_posterior_predictive(xs, variance_estimator, xs, gp2_Z, gp2_noise, gp2_l_opt,
+                                                       gp2_sigma_f_opt, approximation)
+    else:
+        gp2_pred_mean, _ = bo_predict_homo_gp(xs, variance_estimator, xs, gp2_noise, gp2_l_opt, gp2_sigma_f_opt, full_cov=False)
+    gp2_pred_mean = Y_scaler.inverse_transform(gp2_pred_mean)
+    gp2_pred_mean = np.exp(gp2_pred_mean)
+    noise = np.sqrt(gp2_pred_mean)
+
+    # we initialise the optimisation at the next iteration with the optimised hypers
+
+    gp1_hypers = list(np.ndarray.flatten(gp1_l_opt)) + [gp1_sigma_f_opt]
+    gp2_hypers = list(np.ndarray.flatten(gp2_l_opt)) + [gp2_sigma_f_opt]
+
+    return noise, gp1_hypers, gp2_hypers, variance_estimator, Y_scaler, gp1_res['fun']
+
+
+def bo_hetero_em(xs, ys, noise, gp1_hypers, gp2_hypers, gp2_noise, num_iters, sample_size, plot_sample, f_plot=False,
+                 estimator='cholesky', noise_tol=5e-2, nlml_tol=1e-4, n_restarts=1, executor=None, n_screen=0,
+                 backend='exact', num_inducing=100, inducing='kmeans', approximation='vfe'):
+    """
+    Run up to num_iters iterations of the most likely heteroscedastic GP algorithm from the given noise function and
+    GP1/GP2 hyperparameters, stopping early once either convergence criterion is met. Shared by bo_fit_hetero_gp, the
+    fits of HeteroscedasticGPState and acquisition_functions.heteroscedastic_propose_location, which need the
+    StandardScaler of the GP2 targets as well. The arguments not listed below are those of bo_hetero_em_step.
+
+    :param xs: sample locations (m x d)
+    :param ys: sample labels (m x 1)
+    :param noise: initial noise function. Either a scalar or a vector of per-point noise levels (m x 1)
+    :param gp1_hypers: hyperparameters [l_1, ..., l_d, sigma_f] to initialise the optimiser for GP1
+    :param gp2_hypers: hyperparameters [l_1, ..., l_d, sigma_f] to initialise the optimiser for GP2
+    :param num_iters: maximum number of iterations of the algorithm.
+    :param noise_tol: tolerance on the relative change in the noise function. See bo_fit_hetero_gp.
+    :param nlml_tol: tolerance on the relative change in the GP1 negative log marginal likelihood.
+    :return: The noise function (m x 1), the GP1 and GP2 hypers, the standardised log variance estimator, the
+             StandardScaler used to standardise it and a dictionary with the number of iterations run and the final
+             relative changes in the noise function and the GP1 negative log marginal likelihood.
+    """
+
+    info = {'num_iters': 0, 'noise_delta': np.inf, 'nlml_delta': np.inf}
+    nlml = None
+
+    for i in range(0, num_iters):
+
+        old_noise, old_nlml = noise, nlml
+        noise, gp1_hypers, gp2_hypers, variance_estimator, Y_scaler, nlml = \
+            bo_hetero_em_step(xs, ys, noise, gp1_hypers, gp2_hypers, gp2_noise, sample_size, plot_sample, f_plot, estimator,
+                              n_restarts, executor, n_screen, backend, num_inducing, inducing, approximation)
+        info['num_iters'] = i + 1
+
+        # The first iteration starts from the homoscedastic noise level so there is no previous NLML to compare to.
+
+        if i >= 1:
+            info['noise_delta'] = relative_change(noise, old_noise)
+            info['nlml_delta'] = relative_change(nlml, old_nlml)
+            if (noise_tol is not None and info['noise_delta'] < noise_tol) or \
+                    (nlml_tol is not None and info['nlml_delta'] < nlml_tol):
+                break
+
+    return noise, gp1_hypers, gp2_hypers, variance_estimator, Y_scaler, info
+
+
+def bo_fit_hetero_gp(xs, ys, noise, l_init, sigma_f_init, l_noise_init, sigma_f_noise_init, gp2_noise, num_iters, sample_size, plot_sample, f_plot=False,
+                     estimator='cholesky', noise_tol=5e-2, nlml_tol=1e-4, return_info=False, n_restarts=1,
+                     executor=None, n_screen=0, backend='exact', num_inducing=100, inducing='kmeans', approximation='vfe'):
+    """
+    Fit a heteroscedastic GP to data (xs, ys).
 
-        variance_estimator = variance_estimator.reshape(len(variance_estimator), 1)
+    :param xs: sample locations (m x d)
+    :param ys: sample labels (m x 1)
+    :param noise: fixed noise level or noise function
+    :param l_init: lengthscale(s) to initialise the optimiser
+    :param sigma_f_init: signal amplitude to initialise the optimiser
+    :param l_noise_init: lengthscale(s) to initialise the optimiser for the noise
+    :param sigma_f_noise_init: signal amplitude to initialise the optimiser for the noise
+    :param gp2_noise: the noise level for the second GP modelling the noise (noise of the noise)
+    :param num_iters: number of iterations to run the most likely heteroscedastic GP algorithm.
+    :param sample_size: the number of samples for the heteroscedastic GP algorithm.
+    :param plot_sample: Sample for plotting.
+    :param f_plot: Boolean indicating whether to plot or not
+    :param estimator: how to compute the variance estimator. One of 'sample', 'cholesky' or 'exact'. See
+                      utils.most_likely_variance_estimator.
+    :param noise_tol: the algorithm stops before num_iters iterations once the relative change in the noise function
+                      falls below noise_tol. The sampled variance estimators are noisy so noise_tol should not be set
+                      below their Monte Carlo error. None disables the criterion.
+    :param nlml_tol: the algorithm also stops once the relative change in the GP1 negative log marginal likelihood falls
+                     below nlml_tol. None disables the criterion.
+    :param return_info: whether to additionally return a dictionary with the number of iterations run and the final
+                        relative changes in the noise function and the GP1 negative log marginal likelihood.
+    :param n_restarts: number of starts of the optimiser for each GP1 and GP2 fit. See bo_fit_homo_gp.
+    :param executor: concurrent.futures executor to run the restarts on. Reused across the iterations of the
+                     algorithm. If None and n_restarts > 1 a process pool is created for the whole fit.
+    :param n_screen: number of Sobol samples of the hyperparameters screened for each GP1 and GP2 fit. See
+                     bo_fit_homo_gp.
+    :param backend: 'exact' or 'sparse'. See bo_hetero_em_step.
+    :param num_inducing: number of inducing inputs of each GP with the 'sparse' backend.
+    :param inducing: how the inducing inputs are chosen, 'kmeans' or 'greedy'.
+    :param approximation: 'vfe' or 'fitc'.
+    :return: The noise function, variance estimator and GP1 and GP2 hypers.
+    """
 
-        Y_scaler = StandardScaler().fit(variance_estimator)
-        variance_estimator = Y_scaler.transform(variance_estimator)
+    if executor is None and n_restarts != 1:  # a single pool is shared by the GP1 and GP2 fits of every iteration
 
-        # We fit a second GP to the auxiliary dataset z = (xs, variance_estimator)
+        with ProcessPoolExecutor() as executor:
 
-        gp2_res = minimize(nll_fn_het(xs, variance_estimator, gp2_noise), gp2_hypers, bounds=bounds, method='L-BFGS-B')
-        gp2_l_opt = np.array(gp2_res.x[:-1]).reshape(-1, 1)
-        gp2_sigma_f_opt = gp2_res.x[-1]
-        gp2_hypers = list(np.ndarray.flatten(gp2_l_opt)) + [gp2_sigma_f_opt]  # we initialise the optimisation at the next iteration with the optimised hypers
+            return bo_fit_hetero_gp(xs, ys, noise, l_init, sigma_f_init, l_noise_init, sigma_f_noise_init, gp2_noise,
+                                    num_iters, sample_size, plot_sample, f_plot, estimator, noise_tol, nlml_tol,
+                                    return_info, n_restarts, executor, n_screen, backend, num_inducing, inducing,
+                                    approximation)
 
-        # Line included for plotting purposes
+    dimensionality = xs.shape[1]  # in order to plot only in the 1D input case.
+    gp1_hypers = [l_init]*dimensionality + [sigma_f_init]  # we initialise each dimension with the same lengthscale value
+    gp2_hypers = [l_noise_init]*dimensionality + [sigma_f_noise_init]  # we initialise each dimensions with the same lengthscale value for gp2 as well.
 
-        if f_plot:
+    noise, gp1_hypers, gp2_hypers, variance_estimator, _, info = \
+        bo_hetero_em(xs, ys, noise, gp1_hypers, gp2_hypers, gp2_noise, num_iters, sample_size, plot_sample, f_plot,
+                     estimator, noise_tol, nlml_tol, n_restarts, executor, n_screen, backend, num_inducing, inducing,
+                     approximation)
 
-            _ = plot_het_gp2(xs, variance_estimator, plot_sample, gp2_noise, gp2_l_opt, gp2_sigma_f_opt)
+    gp1_l_opt = np.array(gp1_hypers[:-1]).reshape(-1, 1)
+    gp1_sigma_f_opt = gp1_hypers[-1]
+    gp2_l_opt = np.array(gp2_hypers[:-1]).reshape(-1, 1)
+    gp2_sigma_f_opt = gp2_hypers[-1]
 
-        gp2_pred_mean, gp2_pred_var = bo_predict_homo_gp(xs, variance_estimator, xs, gp2_noise, gp2_l_opt, gp2_sigma_f_opt)
-        gp2_pred_mean = Y_scaler.inverse_transform(gp2_pred_mean)
-        gp2_pred_mean = np.exp(gp2_pred_mean)
-        noise = np.sqrt(gp2_pred_mean)
+    if return_info:
+        return noise, gp2_noise, gp1_l_opt, gp1_sigma_f_opt, gp2_l_opt, gp2_sigma_f_opt, variance_estimator, info
 
     return noise, gp2_noise, gp1_l_opt, gp1_sigma_f_opt, gp2_l_opt, gp2_sigma_f_opt, variance_estimator
 
 
+def bo_hetero_posterior(xs, ys, variance_estimator, noise_func, gp1_l_opt, gp1_sigma_f_opt, gp2_noise, gp2_l_opt,
+                        gp2_sigma_f_opt, Y_scaler=None, backend='exact', num_inducing=100, inducing='kmeans',
+                        approximation='vfe'):
+    """
+    Construct the posterior of the heteroscedastic GP from the output of bo_fit_hetero_gp. The posterior caches the
+    Cholesky factors of GP1 and GP2 so that it may be passed to the acquisition functions and evaluated repeatedly.
+
+    :param xs: sample locations (m x d)
+    :param ys: sample labels (m x 1)
+    :param variance_estimator: estimated variance at sample locations (m x 1)
+    :param noise_func: learned noise function
+    :param gp1_l_opt: optimised lengthscale(s) of GP1
+    :param gp1_sigma_f_opt: optimised signal amplitude of GP1
+    :param gp2_noise: noise level of GP2
+    :param gp2_l_opt: optimised lengthscale(s) of GP2
+    :param gp2_sigma_f_opt: optimised signal amplitude of GP2
+    :param Y_scaler: StandardScaler used to standardise variance_estimator, if any. See
+                     HeteroscedasticGPPosterior.predict_noise.
+    :param backend: 'exact' or 'sparse'. 'sparse' builds GP1 and GP2 as SparseGPPosteriors on inducing inputs chosen
+                    for the optimised hypers, so that neither the posterior nor the acquisition function optimisation
+                    factorises an m x m matrix.
+    :param num_inducing: number of inducing inputs of each GP with the 'sparse' backend.
+    :param inducing: how the inducing inputs are chosen, 'kmeans' or 'greedy'. See sparse_gp.select_inducing.
+    :param approximation: 'vfe' or 'fitc'. See sparse_gp.py.
+    :return: HeteroscedasticGPPosterior
+    """
+
+    if backend == 'sparse':
+        gp1_Z = select_inducing(xs, num_inducing, inducing, gp1_l_opt, gp1_sigma_f_opt)
+        gp2_Z = select_inducing(xs, num_inducing, inducing, gp2_l_opt, gp2_sigma_f_opt)
+        gp1 = SparseGPPosterior(xs, ys, gp1_Z, noise_func, gp1_l_opt, gp1_sigma_f_opt, approximation)
+        gp2 = SparseGPPosterior(xs, variance_estimator, gp2_Z, gp2_noise, gp2_l_opt, gp2_sigma_f_opt, approximation)
+    else:
+        gp1 = GPPosterior(xs, ys, noise_func, gp1_l_opt, gp1_sigma_f_opt, mean_func=zero_mean, kernel=scipy_kernel)
+        gp2 = GPPosterior(xs, variance_estimator, gp2_noise, gp2_l_opt, gp2_sigma_f_opt, mean_func=zero_mean, kernel=scipy_kernel)
+
+    return HeteroscedasticGPPosterior(gp1, gp2, Y_scaler)
+
+
 def bo_predict_hetero_gp(xs, ys, variance_estimator, xs_star, noise_func, gp1_l_opt, gp1_sigma_f_opt, gp2_noise, gp2_l_opt, gp2_sigma_f_opt, f_plot=False, f_plot2=False):
     """
     Compute predictions at the test locations using the heteroscedastic GP.
@@ -180,13 +371,9 @@ def bo_predict_hetero_gp(xs, ys, variance_estimator, xs_star, noise_func, gp1_l_
     :return: predictive mean and variance of the heteroscedastic GP at the test locations xs_star.
     """
 
-    pred_mean_het, pred_var_het, _, _ = posterior_predictive(xs, ys, xs_star, noise_func, gp1_l_opt, gp1_sigma_f_opt)
-    pred_mean_noise, pred_var_noise, _, _ = posterior_predictive(xs, variance_estimator, xs_star, gp2_noise, gp2_l_opt, gp2_sigma_f_opt)
-    pred_mean_noise = np.exp(pred_mean_noise)
-    pred_mean_noise = np.sqrt(pred_mean_noise).reshape(len(pred_mean_noise))  # taking the standard deviation
-
-    pred_mean = pred_mean_het
-    pred_var = np.diag(pred_var_het) + pred_mean_noise
+    posterior = bo_hetero_posterior(xs, ys, variance_estimator, noise_func, gp1_l_opt, gp1_sigma_f_opt, gp2_noise,
+                                    gp2_l_opt, gp2_sigma_f_opt)
+    pred_mean, pred_var, pred_mean_noise = posterior.predict(xs_star)
 
     if f_plot:
 
@@ -205,7 +392,7 @@ def bo_predict_hetero_gp(xs, ys, variance_estimator, xs_star, noise_func, gp1_l_
         plt.show()
 
     if f_plot2:
-        gp2_plot_pred_var = np.diag(pred_var_noise).reshape(-1, 1)  # Take the diagonal of the covariance matrix for plotting purposes
+        _, gp2_plot_pred_var = posterior.gp2.predict(xs_star, full_cov=False)  # Take the diagonal of the covariance matrix for plotting purposes
         pred_mean_noise = pred_mean_noise.reshape(-1, 1)
         plt.plot(xs, variance_estimator, '+', color='green', markersize='12', linewidth='8')
         plt.plot(xs_star, np.log(pred_mean_noise), '-', color='red')
@@ -220,3 +407,198 @@ def bo_predict_hetero_gp(xs, ys, variance_estimator, xs_star, noise_func, gp1_l_
         plt.show()
 
     return pred_mean, pred_var, pred_mean_noise
+
+
+class HomoscedasticGPState:
+    """
+    Homoscedastic GP carried across the iterations of Bayesian Optimisation. New observations are added to the cached
+    Cholesky factor with a rank-k update that costs O(n^2 k). The hyperparameters are only re-optimised, with a full
+    O(n^3) refactorisation, once refit_every new observations have been collected since the last fit.
+    """
+
+    def __init__(self, X_sample, Y_sample, noise, l_init, sigma_f_init, refit_every=5, n_restarts=1, executor=None,
+                 n_screen=0):
+        """
+        :param X_sample: initial sample locations (m x d)
+        :param Y_sample: initial sample labels (m x 1)
+        :param noise: noise level to initialise the optimiser
+        :param l_init: lengthscale(s) to initialise the optimiser
+        :param sigma_f_init: signal amplitude to initialise the optimiser
+        :param refit_every: number of new observations after which the hyperparameters are re-optimised. In between,
+                            observations are added with rank-k updates. A value of 1 re-optimises on every call to
+                            add_observations.
+        :param n_restarts: number of starts of the optimiser in each refit. See bo_fit_homo_gp.
+        :param executor: concurrent.futures executor to run the restarts on. A long-lived pool avoids paying the
+                         start-up cost of a new pool on every refit.
+        :param n_screen: number of Sobol samples of the hyperparameters screened in each refit. See bo_fit_homo_gp.
+        """
+
+        self.noise_init = noise
+        self.l_init = l_init
+        self.sigma_f_init = sigma_f_init
+        self.refit_every = refit_every
+        self.n_restarts = n_restarts
+        self.executor = executor
+        self.n_screen = n_screen
+        self.num_since_refit = 0
+        self.posterior = None
+
+        self.fit(X_sample, Y_sample)
+
+    @property
+    def X_sample(self):
+        return self.posterior.xs
+
+    @property
+    def Y_sample(self):
+        return self.posterior.ys
+
+    def fit(self, X_sample, Y_sample):
+        """
+        Re-optimise the hyperparameters and refactorise the covariance matrix from scratch.
+
+        :param X_sample: sample locations (m x d)
+        :param Y_sample: sample labels (m x 1)
+        :return: None
+        """
+
+        l_opt, sigma_f_opt, noise_opt = bo_fit_homo_gp(X_sample, Y_sample, self.noise_init, self.l_init, self.sigma_f_init,
+                                                       self.n_restarts, self.executor, self.n_screen)
+        self.posterior = GPPosterior(X_sample, Y_sample, noise_opt, l_opt, sigma_f_opt, mean_func=zero_mean, kernel=scipy_kernel)
+        self.num_since_refit = 0
+
+    def add_observations(self, X_next, Y_next):
+        """
+        Add one or a block of observations. Either extends the Cholesky factor or triggers a full refit according to
+        the refit_every policy.
+
+        :param X_next: new sample locations (k x d)
+        :param Y_next: new sample labels (k x 1)
+        :return: None
+        """
+
+        self.num_since_refit += len(X_next)
+
+        if self.num_since_refit >= self.refit_every:
+            self.fit(np.vstack((self.X_sample, X_next)), np.vstack((self.Y_sample, Y_next)))
+        else:
+            self.posterior.append(X_next, Y_next)
+
+
+class HeteroscedasticGPState:
+    """
+    Most likely heteroscedastic GP carried across the iterations of Bayesian Optimisation. The first fit runs num_iters
+    iterations of the algorithm from cold. Subsequent fits are warm-started from the previous noise function and GP1/GP2
+    hyperparameters, with the noise function extended to the new observations by predicting from GP2, so that only
+    num_warm_iters iterations are required per new batch of observations.
+    """
+
+    def __init__(self, X_sample, Y_sample, noise, l_init, sigma_f_init, l_noise_init, sigma_f_noise_init, gp2_noise,
+                 num_iters, sample_size, plot_sample, num_warm_iters=2, estimator='cholesky', noise_tol=5e-2,
+                 nlml_tol=1e-4, n_restarts=1, executor=None, n_screen=0, backend='exact', num_inducing=100,
+                 inducing='kmeans', approximation='vfe'):
+        """
+        :param X_sample: initial sample locations (m x d)
+        :param Y_sample: initial sample labels (m x 1)
+        :param noise: noise level used to initialise the noise function in the cold fit
+        :param l_init: lengthscale(s) to initialise the optimiser for GP1
+        :param sigma_f_init: signal amplitude to initialise the optimiser for GP1
+        :param l_noise_init: lengthscale(s) to initialise the optimiser for GP2
+        :param sigma_f_noise_init: signal amplitude to initialise the optimiser for GP2
+        :param gp2_noise: the noise level for the second GP modelling the noise (noise of the noise)
+        :param num_iters: number of iterations of the most likely heteroscedastic GP algorithm in the cold fit.
+        :param sample_size: the number of samples for the heteroscedastic GP algorithm.
+        :param plot_sample: Sample for plotting.
+        :param num_warm_iters: number of iterations of the algorithm in each warm-started fit.
+        :param estimator: how to compute the variance estimator. See utils.most_likely_variance_estimator.
+        :param noise_tol: tolerance on the relative change in the noise function. See bo_fit_hetero_gp.
+        :param nlml_tol: tolerance on the relative change in the GP1 negative log marginal likelihood.
+        :param n_restarts: number of starts of the optimiser for each GP1 and GP2 fit. See bo_fit_homo_gp.
+        :param executor: concurrent.futures executor to run the restarts on.
+        :param n_screen: number of Sobol samples of the hyperparameters screened for each GP1 and GP2 fit.
+        :param backend: 'exact' or 'sparse'. Used for both the fits and the posterior. See bo_hetero_em_step and
+                        bo_hetero_posterior.
+        :param num_inducing: number of inducing inputs of each GP with the 'sparse' backend.
+        :param inducing: how the inducing inputs are chosen, 'kmeans' or 'greedy'.
+        :param approximation: 'vfe' or 'fitc'.
+        """
+
+        dimensionality = X_sample.shape[1]
+        self.noise = noise
+        self.gp1_hypers = [l_init]*dimensionality + [sigma_f_init]
+        self.gp2_hypers = [l_noise_init]*dimensionality + [sigma_f_noise_init]
+        self.gp2_noise = gp2_noise
+        self.sample_size = sample_size
+        self.plot_sample = plot_sample
+        self.num_warm_iters = num_warm_iters
+        self.estimator = estimator
+        self.noise_tol = noise_tol
+        self.nlml_tol = nlml_tol
+        self.n_restarts = n_restarts
+        self.executor = executor
+        self.n_screen = n_screen
+        self.backend = backend
+        self.num_inducing = num_inducing
+        self.inducing = inducing
+        self.approximation = approximation
+        self.info = None  # number of iterations and final relative changes of the most recent fit
+        self.Y_scaler = None
+        self.posterior = None
+
+        self.fit(X_sample, Y_sample, num_iters)
+
+    @property
+    def X_sample(self):
+        return self.posterior.xs
+
+    @property
+    def Y_sample(self):
+        return self.posterior.gp1.ys
+
+    def fit(self, X_sample, Y_sample, num_iters):
+        """
+        Run up to num_iters iterations of the most likely heteroscedastic GP algorithm starting from the current noise
+        function and hyperparameters.
+
+        :param X_sample: sample locations (m x d)
+        :param Y_sample: sample labels (m x 1)
+        :param num_iters: number of iterations of the algorithm.
+        :return: None
+        """
+
+        self.noise, self.gp1_hypers, self.gp2_hypers, variance_estimator, self.Y_scaler, self.info = \
+            bo_hetero_em(X_sample, Y_sample, self.noise, self.gp1_hypers, self.gp2_hypers, self.gp2_noise, num_iters,
+                         self.sample_size, self.plot_sample, estimator=self.estimator, noise_tol=self.noise_tol,
+                         nlml_tol=self.nlml_tol, n_restarts=self.n_restarts, executor=self.executor,
+                         n_screen=self.n_screen, backend=self.backend, num_inducing=self.num_inducing,
+                         inducing=self.inducing, approximation=self.approximation)
+
+        self.posterior = bo_hetero_posterior(X_sample, Y_sample, variance_estimator, self.noise,
+                                             np.array(self.gp1_hypers[:-1]).reshape(-1, 1), self.gp1_hypers[-1],
+                                             self.gp2_noise, np.array(self.gp2_hypers[:-1]).reshape(-1, 1),
+                                             self.gp2_hypers[-1], self.Y_scaler, self.backend, self.num_inducing,
+                                             self.inducing, self.approximation)
+
+    def predict_noise(self, xs_star):
+        """
+        Predict the noise function at new locations from GP2.
+
+        :param xs_star: locations (n x d)
+        :return: noise standard deviation at xs_star (n x 1)
+        """
+
+        return self.posterior.predict_noise(xs_star)
+
+    def add_observations(self, X_next, Y_next):
+        """
+        Add one or a block of observations and refit the heteroscedastic GP warm-started from the current state.
+
+        :param X_next: new sample locations (k x d)
+        :param Y_next: new sample labels (k x 1)
+        :return: None
+        """
+
+        X_next = np.reshape(X_next, (-1, self.X_sample.shape[1]))
+        self.noise = np.vstack((self.noise, self.predict_noise(X_next)))
+
+        self.fit(np.vstack((self.X_sample, X_next)), np.vstack((self.Y_sample, Y_next)), self.num_warm_iters)
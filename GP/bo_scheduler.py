@@ -0,0 +1,105 @@
+# Copyright Lee Group 2019
+# Author: Ryan-Rhys Griffiths
+"""
+This module contains an asynchronous Bayesian Optimisation loop. A fixed number of workers evaluate the objective and a
+new point is proposed as soon as any one of them finishes, so that workers are not left idle waiting for the slowest
+evaluation of a synchronous batch. Points still being evaluated are treated as pending observations: they are appended
+to a copy of the fitted posterior as constant-liar fantasies before the acquisition function is optimised.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import copy
+import os
+import time
+
+import numpy as np
+
+from acquisition_functions import optimise_acquisition
+
+
+def fantasise_pending(posterior, X_pending, lie, noise_func=None):
+    """
+    Copy of the posterior with the pending points appended as fantasy observations equal to the lie.
+
+    :param posterior: GPPosterior or HeteroscedasticGPPosterior fitted to the completed evaluations.
+    :param X_pending: locations currently being evaluated (k x d)
+    :param lie: fantasy observation
+    :param noise_func: function mapping input locations to noise levels (k x 1) e.g.
+                       HeteroscedasticGPState.predict_noise. Not needed for a GPPosterior with a scalar noise level.
+    :return: the fantasy posterior
+    """
+
+    fantasy = copy.deepcopy(posterior)
+    Y_pending = np.full((len(X_pending), 1), lie)
+
+    if noise_func is not None:
+        fantasy.append(X_pending, Y_pending, noise_func(X_pending))
+    else:
+        fantasy.append(X_pending, Y_pending)
+
+    return fantasy
+
+
+def async_bayesian_optimisation(objective, state, acquisition, bounds, num_evals, n_workers=None, executor=None,
+                                n_candidates=10000, n_restarts=1, **acquisition_kwargs):
+    """
+    Run Bayesian Optimisation with asynchronous evaluations of the objective.
+
+    :param objective: function mapping a location (1 x d) to an observation. Must be picklable (defined at module level)
+                      if it is evaluated on a process pool.
+    :param state: HomoscedasticGPState or HeteroscedasticGPState fitted to the initial samples. Completed evaluations
+                  are added with state.add_observations.
+    :param acquisition: acquisition function supporting return_grad.
+    :param bounds: bounds of the BO problem.
+    :param num_evals: number of objective evaluations to run.
+    :param n_workers: number of evaluations kept in flight. Defaults to the number of cores.
+    :param executor: concurrent.futures executor on which to evaluate the objective. If None a process pool with
+                     n_workers workers is created for the call.
+    :param n_candidates: number of quasi-random candidates scored per proposal. See optimise_acquisition.
+    :param n_restarts: number of the best candidates refined per proposal.
+    :param acquisition_kwargs: extra arguments passed to the acquisition e.g. hetero_ei=True.
+    :return: list of dictionaries, one per evaluation in order of completion, holding the location x, the observation y,
+             the number of points pending when x was proposed and the time from submission to completion.
+    """
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    if executor is None:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            return async_bayesian_optimisation(objective, state, acquisition, bounds, num_evals, n_workers, pool,
+                                               n_candidates, n_restarts, **acquisition_kwargs)
+
+    noise_func = getattr(state, 'predict_noise', None)  # only the heteroscedastic state has a learned noise function
+    pending = {}  # future -> (location, number pending at proposal, submission time)
+    history = []
+    n_submitted = 0
+
+    while n_submitted < num_evals or pending:
+
+        while len(pending) < n_workers and n_submitted < num_evals:
+
+            posterior = state.posterior
+            gp1 = posterior.gp1 if hasattr(posterior, 'gp1') else posterior
+            mu_sample, _ = gp1.predict(state.X_sample, full_cov=False)
+            mu_sample_opt = np.max(mu_sample)
+
+            if pending:
+                X_pending = np.vstack([x for x, _, _ in pending.values()])
+                posterior = fantasise_pending(posterior, X_pending, np.min(state.Y_sample), noise_func)
+
+            X_next = optimise_acquisition(acquisition, posterior, mu_sample_opt, bounds, n_candidates, n_restarts,
+                                          **acquisition_kwargs)
+            pending[executor.submit(objective, X_next)] = (X_next, len(pending), time.time())
+            n_submitted += 1
+
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            X_next, n_pending, t_submit = pending.pop(future)
+            Y_next = np.reshape(future.result(), (1, 1))
+            state.add_observations(X_next, Y_next)
+            history.append({'x': X_next, 'y': Y_next.item(), 'n_pending': n_pending,
+                            'duration': time.time() - t_submit})
+
+    return history
@@ -13,6 +13,7 @@ from tensorflow import set_random_seed
 
 from acquisition_functions import my_expected_improvement, my_propose_location, heteroscedastic_propose_location, \
     heteroscedastic_expected_improvement
+from bo_gp_fit_predict import HeteroscedasticGPState, HomoscedasticGPState
 from exp_utils import measure_class_performance
 
 
@@ -158,6 +159,20 @@ if __name__ == '__main__':
         best_noise_so_far_homo = best_noise_so_far
         best_noise_so_far_hetero = best_noise_so_far
 
+        # The homoscedastic GP is carried across iterations. Each observation extends the Cholesky factor with a
+        # rank-1 update and the hyperparameters are re-optimised after every refit_every observations.
+
+        refit_every = 5
+        homo_state = HomoscedasticGPState(X_sample_homo, Y_sample_homo, noise, l_init, sigma_f_init, refit_every)
+
+        # The heteroscedastic GP is warm-started from the previous noise function and hyperparameters so that only
+        # num_warm_iters iterations of the most likely heteroscedastic GP algorithm are run per new observation.
+
+        num_warm_iters = 2
+        het_state = HeteroscedasticGPState(X_sample_het, Y_sample_het, noise, l_init, sigma_f_init, l_noise_init,
+                                           sigma_f_noise_init, gp2_noise, num_iters, sample_size, plot_sample,
+                                           num_warm_iters)
+
         for iteration in range(bayes_opt_iters):
 
             print('Iteration number is ' + str(iteration))
@@ -165,7 +180,8 @@ if __name__ == '__main__':
             # We run Homoscedastic BO
 
             X_next_homo = my_propose_location(my_expected_improvement, X_sample_homo, Y_sample_homo, noise, l_init, sigma_f_init,
-                                         bounds, plot_sample, n_restarts=3, min_val=300)
+                                         bounds, plot_sample, n_restarts=3,
+                                         posterior=homo_state.posterior)
             X_next_homo = int(np.round(X_next_homo))  # Continuous values won't be accepted for the number of neurons.
             collected_homoscedastic_neurons.append(X_next_homo)  # append the real rather than the standardised value.
 
@@ -196,15 +212,15 @@ if __name__ == '__main__':
             Y_next_homo = Y_scaler.transform(np.array(Y_next_homo).reshape(-1, 1))  # standardise the collected output.
 
             # Add sample to previous samples
-            X_sample_homo = np.vstack((X_sample_homo, X_next_homo))
-            Y_sample_homo = np.vstack((Y_sample_homo, Y_next_homo))
+            homo_state.add_observations(X_next_homo, Y_next_homo)
+            X_sample_homo, Y_sample_homo = homo_state.X_sample, homo_state.Y_sample
 
             # We run Heteroscedastic BO
 
             X_next_het = heteroscedastic_propose_location(heteroscedastic_expected_improvement, X_sample_het, Y_sample_het,
                                                           noise, l_init, sigma_f_init, l_noise_init, sigma_f_noise_init,
                                                           gp2_noise, num_iters, sample_size, bounds, plot_sample,
-                                                          n_restarts=3, min_val=300)
+                                                          n_restarts=3, posterior=het_state.posterior)
 
             X_next_het = int(np.round(X_next_het))  # Continuous values won't be accepted for the number of neurons.
             collected_heteroscedastic_neurons.append(X_next_het)
@@ -236,8 +252,8 @@ if __name__ == '__main__':
             Y_next_het = Y_scaler.transform(np.array(Y_next_het).reshape(-1, 1))
 
             # Add sample to previous samples
-            X_sample_het = np.vstack((X_sample_het, X_next_het))
-            Y_sample_het = np.vstack((Y_sample_het, Y_next_het))
+            het_state.add_observations(X_next_het, Y_next_het)
+            X_sample_het, Y_sample_het = het_state.X_sample, het_state.Y_sample
 
         print('List of Homoscedastic objective function values of collected points is: ' + str(obj_val_list_homo))
         print('Collected numbers of Homoscedastic neurons are: ' + str(X_sample_homo))
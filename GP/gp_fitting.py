@@ -4,17 +4,26 @@
 This module contains GP-fitting procedures for the homoscedastic and heteroscedastic GP implementations.
 """
 
+from concurrent.futures import ProcessPoolExecutor
+
 from matplotlib import pyplot as plt
 import numpy as np
-from scipy.optimize import minimize
 from scipy.optimize import fmin_l_bfgs_b
 
-from kernels import scipy_kernel
+from gp_multistart import multistart_minimise_nll
+from iterative_gp import nll_fn_het_cg_grad
+from kronecker_gp import kron_posterior_predictive, nll_fn_kron_grad
+from kernels import SqDistCache, scipy_kernel
 from mean_functions import zero_mean
-from utils import neg_log_marg_lik_krasser, nll_fn, posterior_predictive_krasser, posterior_predictive, nll_fn_het
+from sparse_gp import nll_fn_het_sparse_grad, select_inducing, sparse_posterior_predictive
+from state_space_gp import nll_fn_het_state_space_grad, state_space_posterior_predictive
+from rff import nll_fn_het_rff_grad, nll_fn_rff_grad, rff_frequencies, rff_posterior_predictive, rff_posterior_samples
+from utils import neg_log_marg_lik_krasser, nll_fn, posterior_predictive_krasser, posterior_predictive, nll_fn_het, \
+    nll_fn_grad, nll_fn_het_grad, most_likely_variance_estimator, relative_change
 
 
-def fit_homo_gp(xs, ys, noise, xs_star, l_init, sigma_f_init, fplot=True):
+def fit_homo_gp(xs, ys, noise, xs_star, l_init, sigma_f_init, fplot=True, n_restarts=1, executor=None, backend='exact',
+                num_features=500):
     """
     Fit a homoscedastic GP to data (xs, ys) and compute the negative log predictive density at new input locations
     xs_star.
@@ -26,6 +35,12 @@ def fit_homo_gp(xs, ys, noise, xs_star, l_init, sigma_f_init, fplot=True):
     :param l_init: lengthscale(s) to initialise the optimiser
     :param sigma_f_init: signal amplitude to initialise the optimiser
     :param f_plot: bool indicating whether to plot the posterior predictive or not.
+    :param n_restarts: number of starts of the optimiser. The first start is (l_init, sigma_f_init, noise) and the rest
+                       are drawn at random within the bounds. See gp_multistart.multistart_minimise_nll.
+    :param executor: concurrent.futures executor to run the restarts on. If None a process pool is created.
+    :param backend: 'exact' for the exact GP or 'rff' for the random Fourier feature approximation in rff.py, which
+                    fits and predicts in O(N num_features^2) rather than O(N^3).
+    :param num_features: number of random features used by the 'rff' backend.
     :return: negative log marginal likelihood value and negative log predictive density.
     """
 
@@ -35,14 +50,22 @@ def fit_homo_gp(xs, ys, noise, xs_star, l_init, sigma_f_init, fplot=True):
 
     # We fit GP1 to the data
 
-    res = minimize(nll_fn_het(xs, ys, noise), hypers, bounds=bounds, method='L-BFGS-B')
+    if backend == 'rff':
+        W, b = rff_frequencies(dimensionality, num_features)  # held fixed for the whole fit
+        res, _ = multistart_minimise_nll(nll_fn_rff_grad, (xs, ys, W, b), hypers, bounds, n_restarts, executor)
+    else:
+        res, _ = multistart_minimise_nll(nll_fn_grad, (xs, ys), hypers, bounds, n_restarts, executor)
 
-    l_opt = np.array(res.x[:-2]).reshape(-1, 1)  # res.x[:-1]
-    sigma_f_opt = res.x[-2]  # res.x[-1] before noise included
-    noise = res.x[-1]
+    l_opt = np.array(res['x'][:-2]).reshape(-1, 1)  # res.x[:-1]
+    sigma_f_opt = res['x'][-2]  # res.x[-1] before noise included
+    noise = res['x'][-1]
 
-    pred_mean, pred_var, _, _ = posterior_predictive(xs, ys, xs_star, noise, l_opt, sigma_f_opt, mean_func=zero_mean, kernel=scipy_kernel)
-    nlml = neg_log_marg_lik_krasser(xs, ys, noise, l_opt, sigma_f_opt)
+    if backend == 'rff':
+        pred_mean, pred_var = rff_posterior_predictive(xs, ys, xs_star, noise, l_opt, sigma_f_opt, W, b)
+        nlml = res['fun']
+    else:
+        pred_mean, pred_var, _, _ = posterior_predictive(xs, ys, xs_star, noise, l_opt, sigma_f_opt, mean_func=zero_mean, kernel=scipy_kernel)
+        nlml = neg_log_marg_lik_krasser(xs, ys, noise, l_opt, sigma_f_opt)
 
     f_print_diagnostics = False
 
@@ -71,7 +94,40 @@ def fit_homo_gp(xs, ys, noise, xs_star, l_init, sigma_f_init, fplot=True):
     return pred_mean, pred_var, nlml
 
 
-def fit_hetero_gp(xs, ys, aleatoric_noise, xs_star, l_init, sigma_f_init, l_noise_init, sigma_f_noise_init, gp2_noise, num_iters, sample_size):
+def fit_grid_gp(grid_axes, ys, noise, xs_star, l_init, sigma_f_init, n_restarts=1, executor=None):
+    """
+    Fit a homoscedastic GP to data observed on a Cartesian grid using the Kronecker structure of the covariance matrix
+    (see kronecker_gp.py) and predict at new input locations xs_star. Exact, but O(d N^(1 + 1/d)) rather than O(N^3).
+
+    :param grid_axes: list of d one-dimensional arrays of grid coordinates
+    :param ys: target labels at the grid points ordered as in kronecker_gp.grid_points (N x 1)
+    :param noise: noise level to initialise the optimiser
+    :param xs_star: test input locations. Either an array (N* x d) or a list of d arrays of test grid coordinates.
+    :param l_init: lengthscale(s) to initialise the optimiser
+    :param sigma_f_init: signal amplitude to initialise the optimiser
+    :param n_restarts: number of starts of the optimiser. See fit_homo_gp.
+    :param executor: concurrent.futures executor to run the restarts on.
+    :return: predictive mean, marginal predictive variance and negative log marginal likelihood value.
+    """
+
+    hypers = [l_init]*len(grid_axes) + [sigma_f_init] + [noise]
+    bounds = [(1e-2, 900)]*len(hypers)
+
+    res, _ = multistart_minimise_nll(nll_fn_kron_grad, (grid_axes, ys), hypers, bounds, n_restarts, executor)
+
+    l_opt = np.array(res['x'][:-2]).reshape(-1, 1)
+    sigma_f_opt = res['x'][-2]
+    noise = res['x'][-1]
+
+    pred_mean, pred_var = kron_posterior_predictive(grid_axes, ys, xs_star, noise, l_opt, sigma_f_opt)
+
+    return pred_mean, pred_var, res['fun']
+
+
+def fit_hetero_gp(xs, ys, aleatoric_noise, xs_star, l_init, sigma_f_init, l_noise_init, sigma_f_noise_init, gp2_noise, num_iters, sample_size,
+                  estimator='cholesky', noise_tol=5e-2, nlml_tol=1e-4, return_info=False, n_restarts=1,
+                  executor=None, backend='exact', num_features=500, num_inducing=100, inducing='kmeans',
+                  approximation='vfe', nu=1.5):
     """
     Fit a heteroscedastic GP to data (xs, ys) and compute the negative log predictive density at new input locations
     xs_star.
@@ -87,45 +143,113 @@ def fit_hetero_gp(xs, ys, aleatoric_noise, xs_star, l_init, sigma_f_init, l_nois
     :param gp2_noise: the noise level for the second GP modelling the noise (noise of the noise)
     :param num_iters: number of iterations to run the most likely heteroscedastic GP algorithm.
     :param sample_size: the number of samples for the heteroscedastic GP algorithm.
+    :param estimator: how to compute the variance estimator. One of 'sample', 'cholesky' or 'exact'. See
+                      utils.most_likely_variance_estimator.
+    :param noise_tol: the algorithm stops before num_iters iterations once the relative change in the noise function
+                      falls below noise_tol. The defaults match bo_gp_fit_predict.bo_fit_hetero_gp. None disables the
+                      criterion.
+    :param nlml_tol: the algorithm also stops once the relative change in the GP1 negative log marginal likelihood falls
+                     below nlml_tol. None disables the criterion.
+    :param n_restarts: number of starts of the optimiser for each GP1 and GP2 fit. See fit_homo_gp.
+    :param executor: concurrent.futures executor to run the restarts on. If None and n_restarts > 1 a process pool is
+                     created for the whole fit.
+    :param return_info: whether to additionally return a dictionary with the number of iterations run and the final
+                        relative changes in the noise function and the GP1 negative log marginal likelihood.
+    :param backend: 'exact', 'rff', 'sparse', 'cg' or 'state_space'. With 'rff' both GP1 and GP2 use the random Fourier feature
+                    approximation of fit_homo_gp, the predictive variances at xs_star are marginal (N* x 1) and the 'sample' and
+                    'cholesky' estimators sample the feature weights rather than factorising the N* x N* covariance.
+                    'sparse' uses the inducing point GP of sparse_gp.py for both GP1 and GP2 with marginal predictive
+                    variances at xs_star. GP1 keeps the per-point noise and GP2 the fixed gp2_noise. 'cg' optimises
+                    the hypers against the iterative estimate of iterative_gp.py, which needs no factorisation, and
+                    keeps a single exact prediction per iteration with marginal predictive variances, so that the
+                    N* x N* covariance is never formed or factorised. 'state_space' fits GP1 and GP2 in O(N) time with
+                    the Kalman filter of state_space_gp.py. It requires one-dimensional inputs, replaces the squared
+                    exponential kernel with a Matern kernel of smoothness nu and gives marginal predictive variances.
+    :param num_features: number of random features used by each GP with the 'rff' backend.
+    :param num_inducing: number of inducing inputs of each GP with the 'sparse' backend.
+    :param inducing: how the inducing inputs are chosen, 'kmeans' or 'greedy'. 'greedy' uses each GP's hypers from the
+                     previous iteration. See sparse_gp.select_inducing.
+    :param approximation: 'vfe' or 'fitc'. See sparse_gp.py.
+    :param nu: smoothness of the Matern kernel of the 'state_space' backend, 1.5 or 2.5.
     :return: The negative log marginal likelihood value and the negative log predictive density at the test input locations.
     """
 
+    if executor is None and n_restarts != 1:  # a single pool is shared by the GP1 and GP2 fits of every iteration
+
+        with ProcessPoolExecutor() as executor:
+
+            return fit_hetero_gp(xs, ys, aleatoric_noise, xs_star, l_init, sigma_f_init, l_noise_init, sigma_f_noise_init,
+                                 gp2_noise, num_iters, sample_size, estimator, noise_tol, nlml_tol, return_info, n_restarts,
+                                 executor, backend, num_features, num_inducing, inducing, approximation, nu)
+
     dimensionality = xs.shape[1]  # in order to plot only in the 1D input case.
     gp1_hypers = [l_init]*dimensionality + [sigma_f_init]  # we initialise each dimension with the same lengthscale value
     gp2_hypers = [l_noise_init]*dimensionality + [sigma_f_noise_init]  # we initialise each dimensions with the same lengthscale value for gp2 as well.
     bounds = [(1, 900)]*len(gp1_hypers)  # we initialise the bounds to be the same in each case
+    info = {'num_iters': 0, 'noise_delta': np.inf, 'nlml_delta': np.inf}
+    gp1_nlml = None
+    dist_cache = SqDistCache(xs, xs_star) if backend == 'exact' else None  # GP1 and GP2 share the squared distances between xs and xs_star in every iteration
+
+    if backend == 'rff':  # GP1 and GP2 each keep a fixed set of features for every iteration
+        gp1_W, gp1_b = rff_frequencies(dimensionality, num_features)
+        gp2_W, gp2_b = rff_frequencies(dimensionality, num_features)
+        gp1_nll_factory, gp1_factory_args = nll_fn_het_rff_grad, (gp1_W, gp1_b)
+        gp2_nll_factory, gp2_factory_args = nll_fn_het_rff_grad, (gp2_W, gp2_b)
+    elif backend == 'cg':
+        gp1_nll_factory, gp1_factory_args = nll_fn_het_cg_grad, ()
+        gp2_nll_factory, gp2_factory_args = nll_fn_het_cg_grad, ()
+    elif backend == 'state_space':
+        if dimensionality != 1:
+            raise ValueError('The state_space backend requires one-dimensional inputs')
+        gp1_nll_factory, gp1_factory_args = nll_fn_het_state_space_grad, (nu,)
+        gp2_nll_factory, gp2_factory_args = nll_fn_het_state_space_grad, (nu,)
+    else:
+        gp1_nll_factory, gp1_factory_args = nll_fn_het_grad, (dist_cache,)
+        gp2_nll_factory, gp2_factory_args = nll_fn_het_grad, (dist_cache,)
 
     for i in range(0, num_iters):
 
-        # We fit GP1 to the data
+        old_noise, old_gp1_nlml = aleatoric_noise, gp1_nlml
 
-        # n_restarts = 25
-        # dim = len(gp1_hypers)
-        # min_x = None
-        # min_val = 100
-        #
-        # for x0 in np.random.uniform(np.array(bounds[0]), np.array(bounds[1]), size=(n_restarts, dim)):
-        #     gp1_res = minimize(nll_fn(xs, ys), x0=x0, bounds=bounds, method='L-BFGS-B')
-        #     if gp1_res.fun < min_val:
-        #         min_val = gp1_res.fun[0]
-        #         min_x = gp1_res.x
+        if backend == 'sparse':  # the inducing inputs are chosen afresh each iteration
+            gp1_Z = select_inducing(xs, num_inducing, inducing, gp1_hypers[:-1], gp1_hypers[-1])
+            gp2_Z = select_inducing(xs, num_inducing, inducing, gp2_hypers[:-1], gp2_hypers[-1])
+            gp1_nll_factory, gp1_factory_args = nll_fn_het_sparse_grad, (gp1_Z, approximation)
+            gp2_nll_factory, gp2_factory_args = nll_fn_het_sparse_grad, (gp2_Z, approximation)
 
-        gp1_res = minimize(nll_fn_het(xs, ys, aleatoric_noise), gp1_hypers, bounds=bounds, method='L-BFGS-B')
-        #gp1_res = min_x
+        # We fit GP1 to the data
+
+        gp1_res, _ = multistart_minimise_nll(gp1_nll_factory, (xs, ys, aleatoric_noise) + gp1_factory_args, gp1_hypers,
+                                             bounds, n_restarts, executor)
 
         # We collect the hyperparameters from the optimisation
 
-        gp1_l_opt = np.array(gp1_res.x[:-1]).reshape(-1, 1)
-        gp1_sigma_f_opt = gp1_res.x[-1]
+        gp1_l_opt = np.array(gp1_res['x'][:-1]).reshape(-1, 1)
+        gp1_sigma_f_opt = gp1_res['x'][-1]
+        gp1_nlml = gp1_res['fun']
         #gp1_noise_opt = gp1_res.x[-1]
 
         gp1_hypers = list(np.ndarray.flatten(gp1_l_opt)) + [gp1_sigma_f_opt]  # we initialise the optimisation at the next iteration with the optimised hypers
 
         # We compute the posterior predictive at the test locations
 
-        gp1_pred_mean, gp1_pred_var, _, _ = posterior_predictive(xs, ys, xs_star, aleatoric_noise, gp1_l_opt, gp1_sigma_f_opt, mean_func=zero_mean, kernel=scipy_kernel)
-
-        f_print_diagnostics = True
+        if backend == 'rff':
+            gp1_pred_mean, gp1_pred_var = rff_posterior_predictive(xs, ys, xs_star, aleatoric_noise, gp1_l_opt,
+                                                                   gp1_sigma_f_opt, gp1_W, gp1_b, full_cov=False)
+        elif backend == 'sparse':
+            gp1_pred_mean, gp1_pred_var = sparse_posterior_predictive(xs, ys, xs_star, gp1_Z, aleatoric_noise, gp1_l_opt,
+                                                                      gp1_sigma_f_opt, approximation)
+        elif backend == 'state_space':
+            gp1_pred_mean, gp1_pred_var = state_space_posterior_predictive(xs, ys, xs_star, aleatoric_noise, gp1_l_opt,
+                                                                           gp1_sigma_f_opt, nu)
+        elif backend == 'cg':
+            gp1_pred_mean, gp1_pred_var, _, _ = posterior_predictive(xs, ys, xs_star, aleatoric_noise, gp1_l_opt,
+                                                                     gp1_sigma_f_opt, mean_func=zero_mean,
+                                                                     kernel=scipy_kernel, full_cov=False)
+        else:
+            gp1_pred_mean, gp1_pred_var, _, _ = posterior_predictive(xs, ys, xs_star, aleatoric_noise, gp1_l_opt, gp1_sigma_f_opt, mean_func=zero_mean, kernel=dist_cache)
+
+        f_print_diagnostics = backend == 'exact'  # the exact NLML costs O(N^3)
 
         if f_print_diagnostics and i>= 1:
 
@@ -134,91 +258,53 @@ def fit_hetero_gp(xs, ys, aleatoric_noise, xs_star, l_init, sigma_f_init, l_nois
             print('lengthscale on iteration {} is: '.format(i) + str(gp1_l_opt))
             print('signal amplitude on iteration {} is: '.format(i) + str(gp1_sigma_f_opt))
 
-        # We plot the fit on the final iteration.
-
-        f_gp1_plot_posterior = False
-
-        if i == num_iters - 1 and dimensionality == 1:
-            f_gp1_plot_posterior = True
-
-        f_gp1_plot_posterior_2d = False
-
-        # Switch designed for the scallop dataset
-
-        if i == num_iters - 1 and dimensionality == 2:
-            f_gp1_plot_posterior_2d = True
-
-        if f_gp1_plot_posterior_2d:
-
-            x1_star = np.arange(38.5, 41.0, 0.05)  # hardcoded limits for the scallop dataset.
-            x2_star = np.arange(-74.0, -71.0, 0.05) # hardcoded limits for the scallop dataset.
-            xs_star_plot = np.array(np.meshgrid(x1_star, x2_star)).T.reshape(-1, 2)  # Where 2 gives the dimensionality
-
-            gp1_plot_pred_mean, gp1_plot_pred_var, _, _ = posterior_predictive(xs, ys, xs_star_plot, aleatoric_noise, gp1_l_opt, gp1_sigma_f_opt, mean_func=zero_mean, kernel=scipy_kernel, full_cov=False)
-
-            gp1_plot_pred_mean = gp1_plot_pred_mean.reshape(len(x1_star), len(x2_star)).T
-            gp1_plot_pred_var = gp1_plot_pred_var.reshape(len(x1_star), len(x2_star)).T
-            X, Y = np.meshgrid(x1_star, x2_star)
-
-            upper = gp1_plot_pred_mean + 2 * np.sqrt(gp1_plot_pred_var)
-            lower = gp1_plot_pred_mean - 2 * np.sqrt(gp1_plot_pred_var)
-
-            fig = plt.figure()
-            ax = plt.axes(projection='3d')
-            ax.plot_surface(X, Y, gp1_plot_pred_mean)
-            #ax.plot_surface(X, Y, upper, color='gray', alpha=0.4)
-            #ax.plot_surface(X, Y, lower, color='gray', alpha=0.4)
-            ax.scatter(xs[:, 0], xs[:, 1], ys, '+', color='red')
-            plt.show()
-
-        if f_gp1_plot_posterior:
-            gp1_plot_pred_var = np.diag(gp1_pred_var).reshape(-1, 1)  # Take the diagonal of the covariance matrix for plotting purposes
-            gp1_plot_pred_var = gp1_plot_pred_var + np.square(aleatoric_noise)
-            plt.plot(xs, ys, '+', color='green', markersize='12', linewidth='8')
-            plt.plot(xs_star, gp1_pred_mean, '-', color='red')
-            upper = gp1_pred_mean + 2 * np.sqrt(gp1_plot_pred_var)
-            lower = gp1_pred_mean - 2 * np.sqrt(gp1_plot_pred_var)
-            upper = upper.reshape(xs_star.shape)
-            lower = lower.reshape(xs_star.shape)
-            plt.fill_between(xs_star.reshape(len(xs_star),), upper.reshape(len(xs_star),), lower.reshape(len(xs_star),), color='gray', alpha=0.2)
-            plt.xlabel('Density (Dry Bulk)')
-            plt.ylabel('Standardised Phosphorus Fraction')
-            plt.title('Heteroscedastic GP Posterior')
-            plt.show()
-
         # We construct the most likely heteroscedastic GP noise estimator
 
-        sample_matrix = np.zeros((len(ys), sample_size))
-
-        for j in range(0, sample_size):
-            sample_matrix[:, j] = np.random.multivariate_normal(gp1_pred_mean.reshape(len(gp1_pred_mean)), gp1_pred_var)
-
-        variance_estimator = (0.5 / sample_size) * np.sum((ys - sample_matrix) ** 2, axis=1)  # Equation given in section 4 of Kersting et al. vector of noise for each data point.
+        if backend == 'rff' and estimator != 'exact':
+            gp1_samples = rff_posterior_samples(xs, ys, xs_star, aleatoric_noise, gp1_l_opt, gp1_sigma_f_opt, gp1_W, gp1_b, sample_size)
+            variance_estimator = (0.5 / sample_size) * np.sum((ys - gp1_samples)**2, axis=1)
+        else:
+            variance_estimator = most_likely_variance_estimator(ys, gp1_pred_mean, gp1_pred_var, sample_size, estimator)  # Equation given in section 4 of Kersting et al. vector of noise for each data point.
         #variance_estimator = (ys - gp1_pred_mean)**2  # Matt's variance estimator
         variance_estimator = np.log(variance_estimator)
 
         # We fit a second GP to the auxiliary dataset z = (xs, variance_estimator)
 
-        gp2_res = minimize(nll_fn_het(xs, variance_estimator, gp2_noise), gp2_hypers, bounds=bounds)
+        gp2_res, _ = multistart_minimise_nll(gp2_nll_factory, (xs, variance_estimator, gp2_noise) + gp2_factory_args,
+                                             gp2_hypers, bounds, n_restarts, executor)
 
         # We collect the hyperparameters
 
-        gp2_l_opt = np.array(gp2_res.x[:-1]).reshape(-1, 1)
-        gp2_sigma_f_opt = gp2_res.x[-1]
+        gp2_l_opt = np.array(gp2_res['x'][:-1]).reshape(-1, 1)
+        gp2_sigma_f_opt = gp2_res['x'][-1]
         gp2_hypers = list(np.ndarray.flatten(gp2_l_opt)) + [gp2_sigma_f_opt]  # we initialise the optimisation at the next iteration with the optimised hypers
 
         # we reshape the variance estimator here so that it can be passed into posterior_predictive.
 
         variance_estimator = variance_estimator.reshape(len(variance_estimator), 1)
 
-        gp2_pred_mean, gp2_pred_var, _, _ = posterior_predictive(xs, variance_estimator, xs_star, gp2_noise, gp2_l_opt, gp2_sigma_f_opt, mean_func=zero_mean, kernel=scipy_kernel)
+        if backend == 'rff':
+            gp2_pred_mean, gp2_pred_var = rff_posterior_predictive(xs, variance_estimator, xs_star, gp2_noise, gp2_l_opt,
+                                                                   gp2_sigma_f_opt, gp2_W, gp2_b, full_cov=False)
+        elif backend == 'sparse':
+            gp2_pred_mean, gp2_pred_var = sparse_posterior_predictive(xs, variance_estimator, xs_star, gp2_Z, gp2_noise,
+                                                                      gp2_l_opt, gp2_sigma_f_opt, approximation)
+        elif backend == 'state_space':
+            gp2_pred_mean, gp2_pred_var = state_space_posterior_predictive(xs, variance_estimator, xs_star, gp2_noise,
+                                                                           gp2_l_opt, gp2_sigma_f_opt, nu)
+        elif backend == 'cg':
+            gp2_pred_mean, gp2_pred_var, _, _ = posterior_predictive(xs, variance_estimator, xs_star, gp2_noise,
+                                                                     gp2_l_opt, gp2_sigma_f_opt, mean_func=zero_mean,
+                                                                     kernel=scipy_kernel, full_cov=False)
+        else:
+            gp2_pred_mean, gp2_pred_var, _, _ = posterior_predictive(xs, variance_estimator, xs_star, gp2_noise, gp2_l_opt, gp2_sigma_f_opt, mean_func=zero_mean, kernel=dist_cache)
         gp2_pred_mean = np.exp(gp2_pred_mean)
         aleatoric_noise = np.sqrt(gp2_pred_mean)
 
         f_gp2_plot_posterior = False
 
         if f_gp2_plot_posterior:
-            gp2_plot_pred_var = np.diag(gp2_pred_var).reshape(-1, 1)  # Take the diagonal of the covariance matrix for plotting purposes
+            gp2_plot_pred_var = (gp2_pred_var if backend in ['rff', 'sparse', 'state_space', 'cg'] else np.diag(gp2_pred_var)).reshape(-1, 1)  # Take the diagonal of the covariance matrix for plotting purposes
             plt.plot(xs, variance_estimator, '+', color='green', markersize='12', linewidth='8')
             plt.plot(xs_star, np.log(gp2_pred_mean), '-', color='red')
             upper = np.log(gp2_pred_mean) + 2 * np.sqrt(gp2_plot_pred_var)
@@ -231,4 +317,68 @@ def fit_hetero_gp(xs, ys, aleatoric_noise, xs_star, l_init, sigma_f_init, l_nois
             plt.title('GP2 Posterior')
             plt.show()
 
+        # The first iteration starts from the homoscedastic noise level so there is no previous NLML to compare to.
+
+        info['num_iters'] = i + 1
+
+        if i >= 1:
+            info['noise_delta'] = relative_change(aleatoric_noise, old_noise)
+            info['nlml_delta'] = relative_change(gp1_nlml, old_gp1_nlml)
+            if (noise_tol is not None and info['noise_delta'] < noise_tol) or \
+                    (nlml_tol is not None and info['nlml_delta'] < nlml_tol):
+                break
+
+    # We plot the fit of the final iteration, which may come before num_iters if the algorithm stopped early. GP1 was
+    # fitted with the noise function from the start of that iteration.
+
+    gp1_noise = old_noise
+    f_gp1_plot_posterior = dimensionality == 1
+    f_gp1_plot_posterior_2d = dimensionality == 2  # Switch designed for the scallop dataset
+
+    if f_gp1_plot_posterior_2d:
+
+        x1_star = np.arange(38.5, 41.0, 0.05)  # hardcoded limits for the scallop dataset.
+        x2_star = np.arange(-74.0, -71.0, 0.05) # hardcoded limits for the scallop dataset.
+        xs_star_plot = np.array(np.meshgrid(x1_star, x2_star)).T.reshape(-1, 2)  # Where 2 gives the dimensionality
+
+        if backend == 'rff':
+            gp1_plot_pred_mean, gp1_plot_pred_var = rff_posterior_predictive(xs, ys, xs_star_plot, gp1_noise, gp1_l_opt, gp1_sigma_f_opt, gp1_W, gp1_b, full_cov=False)
+        elif backend == 'sparse':
+            gp1_plot_pred_mean, gp1_plot_pred_var = sparse_posterior_predictive(xs, ys, xs_star_plot, gp1_Z, gp1_noise, gp1_l_opt, gp1_sigma_f_opt, approximation)
+        else:
+            gp1_plot_pred_mean, gp1_plot_pred_var, _, _ = posterior_predictive(xs, ys, xs_star_plot, gp1_noise, gp1_l_opt, gp1_sigma_f_opt, mean_func=zero_mean, kernel=scipy_kernel, full_cov=False)
+
+        gp1_plot_pred_mean = gp1_plot_pred_mean.reshape(len(x1_star), len(x2_star)).T
+        gp1_plot_pred_var = gp1_plot_pred_var.reshape(len(x1_star), len(x2_star)).T
+        X, Y = np.meshgrid(x1_star, x2_star)
+
+        upper = gp1_plot_pred_mean + 2 * np.sqrt(gp1_plot_pred_var)
+        lower = gp1_plot_pred_mean - 2 * np.sqrt(gp1_plot_pred_var)
+
+        fig = plt.figure()
+        ax = plt.axes(projection='3d')
+        ax.plot_surface(X, Y, gp1_plot_pred_mean)
+        #ax.plot_surface(X, Y, upper, color='gray', alpha=0.4)
+        #ax.plot_surface(X, Y, lower, color='gray', alpha=0.4)
+        ax.scatter(xs[:, 0], xs[:, 1], ys, '+', color='red')
+        plt.show()
+
+    if f_gp1_plot_posterior:
+        gp1_plot_pred_var = (gp1_pred_var if backend in ['rff', 'sparse', 'state_space', 'cg'] else np.diag(gp1_pred_var)).reshape(-1, 1)  # Take the diagonal of the covariance matrix for plotting purposes
+        gp1_plot_pred_var = gp1_plot_pred_var + np.square(gp1_noise)
+        plt.plot(xs, ys, '+', color='green', markersize='12', linewidth='8')
+        plt.plot(xs_star, gp1_pred_mean, '-', color='red')
+        upper = gp1_pred_mean + 2 * np.sqrt(gp1_plot_pred_var)
+        lower = gp1_pred_mean - 2 * np.sqrt(gp1_plot_pred_var)
+        upper = upper.reshape(xs_star.shape)
+        lower = lower.reshape(xs_star.shape)
+        plt.fill_between(xs_star.reshape(len(xs_star),), upper.reshape(len(xs_star),), lower.reshape(len(xs_star),), color='gray', alpha=0.2)
+        plt.xlabel('Density (Dry Bulk)')
+        plt.ylabel('Standardised Phosphorus Fraction')
+        plt.title('Heteroscedastic GP Posterior')
+        plt.show()
+
+    if return_info:
+        return aleatoric_noise, gp2_noise, gp1_l_opt, gp1_sigma_f_opt, gp2_l_opt, gp2_sigma_f_opt, variance_estimator, info
+
     return aleatoric_noise, gp2_noise, gp1_l_opt, gp1_sigma_f_opt, gp2_l_opt, gp2_sigma_f_opt, variance_estimator
@@ -0,0 +1,129 @@
+# Copyright Lee Group 2019
+# Author: Ryan-Rhys Griffiths
+"""
+This module contains multi-start optimisation of GP hyperparameters. The negative log marginal likelihood is
+multimodal over the wide hyperparameter bounds used in the fitting modules so a single start from l_init and
+sigma_f_init can land in a poor local optimum. Restarts are spread across a process pool so that the number of restarts
+scales with the number of cores rather than with wall-clock time. Starting points may additionally be screened by
+scoring a large Sobol sample of hyperparameters in one batched computation and keeping only the most promising.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+import numpy as np
+from scipy.optimize import minimize
+from scipy.stats import qmc
+
+
+def random_starts(x0, bounds, n_restarts):
+    """
+    Starting points for a multi-start optimisation. The first start is x0 and the remaining starts are drawn
+    log-uniformly within the bounds as the hyperparameters are positive and the bounds span several orders of magnitude.
+
+    :param x0: initial hyperparameters supplied by the user
+    :param bounds: list of (lower, upper) bounds of length p
+    :param n_restarts: total number of starting points
+    :return: starting points (n_restarts x p)
+    """
+    bounds = np.array(bounds, dtype=np.float64)
+    log_starts = np.random.uniform(np.log(bounds[:, 0]), np.log(bounds[:, 1]), size=(n_restarts - 1, len(bounds)))
+
+    return np.vstack((np.array(x0, dtype=np.float64).reshape(1, -1), np.exp(log_starts)))
+
+
+def sobol_starts(bounds, n_samples):
+    """
+    Scrambled Sobol sample of hyperparameters spread log-uniformly within the bounds. The sample size is rounded up to
+    a power of 2 because a truncated Sobol sequence loses its balance properties.
+
+    :param bounds: list of (lower, upper) bounds of length p
+    :param n_samples: minimum number of samples
+    :return: samples (2^ceil(log2(n_samples)) x p)
+    """
+    bounds = np.array(bounds, dtype=np.float64)
+    sampler = qmc.Sobol(d=len(bounds), seed=np.random.randint(2**31 - 1))
+    unit_samples = sampler.random_base2(int(np.ceil(np.log2(n_samples))))
+
+    return np.exp(qmc.scale(unit_samples, np.log(bounds[:, 0]), np.log(bounds[:, 1])))
+
+
+def screen_starts(batch_nll, x0, bounds, n_screen, top_k, batch_size=64):
+    """
+    Score x0 and n_screen Sobol samples of the hyperparameters with a batched objective and return the top_k with the
+    lowest negative log marginal likelihood. The batch is processed in chunks of batch_size to bound the memory taken by
+    the stack of m x m covariance matrices.
+
+    :param batch_nll: objective mapping a batch of hyperparameters (B x p) to NLML values (B, ) e.g. the function
+                      returned by utils.nll_fn_het_batch
+    :param x0: initial hyperparameters supplied by the user. Scored alongside the Sobol samples.
+    :param bounds: list of (lower, upper) bounds of length p
+    :param n_screen: number of Sobol samples, rounded up to a power of 2. See sobol_starts.
+    :param top_k: number of starting points to return
+    :param batch_size: number of hyperparameter settings scored per batched Cholesky
+    :return: the top_k starting points (top_k x p) in order of increasing NLML
+    """
+    candidates = np.vstack((np.array(x0, dtype=np.float64).reshape(1, -1), sobol_starts(bounds, n_screen)))
+    scores = np.concatenate([batch_nll(candidates[i:i + batch_size]) for i in range(0, len(candidates), batch_size)])
+
+    return candidates[np.argsort(scores, kind='stable')[:top_k]]
+
+
+def minimise_nll(nll_factory, factory_args, x0, bounds):
+    """
+    Minimise a negative log marginal likelihood from a single starting point with L-BFGS-B. The objective is built from
+    nll_factory inside this function because the closures returned by the utils.nll_fn_* factories can't be pickled
+    and sent to a worker process whereas the factories themselves can.
+
+    :param nll_factory: function such as utils.nll_fn_grad returning an objective that gives the NLML and its gradient
+    :param factory_args: tuple of arguments passed to nll_factory e.g. (X_train, Y_train)
+    :param x0: starting hyperparameters
+    :param bounds: list of (lower, upper) bounds
+    :return: dictionary with the starting point, optimised hyperparameters, NLML value, number of iterations and
+             whether the optimiser reported success.
+    """
+    res = minimize(nll_factory(*factory_args), x0, bounds=bounds, method='L-BFGS-B', jac=True)
+
+    return {'x0': np.array(x0), 'x': res.x, 'fun': float(res.fun), 'nit': res.nit, 'success': res.success}
+
+
+def multistart_minimise_nll(nll_factory, factory_args, x0, bounds, n_restarts=None, executor=None, batch_nll_factory=None,
+                            n_screen=0):
+    """
+    Minimise a negative log marginal likelihood from several starting points in parallel.
+
+    :param nll_factory: function such as utils.nll_fn_grad returning an objective that gives the NLML and its gradient
+    :param factory_args: tuple of arguments passed to nll_factory
+    :param x0: initial hyperparameters. Used as the first start unless screening ranks it outside the top n_restarts.
+    :param bounds: list of (lower, upper) bounds
+    :param n_restarts: number of starts. Defaults to the number of cores.
+    :param executor: concurrent.futures executor to run the restarts on. If None a process pool with one worker per
+                     core is created for the call. A single start is always run in the calling process.
+    :param batch_nll_factory: batched counterpart of nll_factory such as utils.nll_fn_batch taking the same arguments.
+                              Required if n_screen > 0.
+    :param n_screen: number of Sobol samples to screen with the batched objective. If positive the starts are the
+                     n_restarts best of x0 and the samples. If 0 the starts are x0 followed by random starts.
+    :return: the restart with the lowest NLML and the full restart table (list of dictionaries, one per start, see
+             minimise_nll) in the order of the starting points.
+    """
+    if n_restarts is None:
+        n_restarts = os.cpu_count() or 1
+
+    if n_screen > 0:
+        starts = screen_starts(batch_nll_factory(*factory_args), x0, bounds, n_screen, n_restarts)
+    else:
+        starts = random_starts(x0, bounds, n_restarts)
+
+    map_args = ([nll_factory]*len(starts), [factory_args]*len(starts), starts, [bounds]*len(starts))
+
+    if len(starts) == 1:
+        table = [minimise_nll(nll_factory, factory_args, starts[0], bounds)]
+    elif executor is not None:
+        table = list(executor.map(minimise_nll, *map_args))
+    else:
+        with ProcessPoolExecutor(max_workers=min(len(starts), os.cpu_count() or 1)) as pool:
+            table = list(pool.map(minimise_nll, *map_args))
+
+    best = min(table, key=lambda row: row['fun'] if np.isfinite(row['fun']) else np.inf)  # failed starts may give nan
+
+    return best, table
@@ -0,0 +1,403 @@
+# Copyright Lee Group 2019
+# Author: Ryan-Rhys Griffiths
+"""
+This module contains fitted GP posterior objects for use in Bayesian Optimisation. The training data and
+hyperparameters are fixed for the whole of an acquisition function optimisation, so the Cholesky factor of the training
+covariance matrix and alpha = K^-1 y are computed once per fit and reused for every prediction. The training covariance
+matrix and its Cholesky factor are also shared through kernel_cache.kernel_cache with any other posterior built on the
+same data and hyperparameters. SparseGPPosterior holds the equivalent factors of the inducing point GP.
+"""
+
+import numpy as np
+from scipy.linalg import cho_solve, cholesky, solve_triangular
+
+from kernel_cache import fingerprint, kernel_cache
+from kernels import kernel_diag, scipy_kernel
+from mean_functions import zero_mean
+from sparse_gp import jitter as inducing_jitter
+
+
+class GPPosterior:
+    """
+    Posterior of a GP with fixed hyperparameters. A prediction at n* test locations costs O(n n*) for the mean and
+    O(n^2 n*) for the variance as opposed to the O(n^3) of refactorising the training covariance matrix.
+    """
+
+    jitter = 1e-3  # matches the jitter added to the predictive variance in utils.posterior_predictive
+
+    def __init__(self, xs, ys, noise, l, sigma_f, mean_func=zero_mean, kernel=scipy_kernel):
+        """
+        :param xs: training data input locations (m x d)
+        :param ys: training data targets (m x 1)
+        :param noise: noise level. Either a scalar or a vector of per-point noise levels (m x 1)
+        :param l: kernel lengthscale(s)
+        :param sigma_f: signal amplitude
+        :param mean_func: prior mean function
+        :param kernel: GP covariance function
+        """
+
+        self.xs = xs
+        self.ys = ys
+        self.noise = noise
+        self.l = l
+        self.sigma_f = sigma_f
+        self.mean_func = mean_func
+        self.kernel = kernel
+
+        self.L = kernel_cache.cholesky(kernel, xs, noise, l, sigma_f)  # Cholesky factor of the covariance matrix with output noise
+        self.alpha = cho_solve((self.L, True), ys - mean_func(xs))  # K^-1 (y - m(x))
+
+    def _cross_kernel(self, xs_star):
+        """
+        :param xs_star: test data input locations (n x d)
+        :return: K(xs, xs_star) and whether the test locations are the training inputs, in which case the matrix is
+                 K(xs, xs) from the kernel cache
+        """
+        if np.shape(xs_star) == np.shape(self.xs) and fingerprint(xs_star) == fingerprint(self.xs):
+            return kernel_cache.kernel(self.kernel, self.xs, self.l, self.sigma_f), True
+
+        return self.kernel(self.xs, xs_star, self.l, self.sigma_f), False
+
+    def predict(self, xs_star, full_cov=True):
+        """
+        Compute the posterior predictive mean and variance of the GP.
+
+        :param xs_star: test data input locations (n x d)
+        :param full_cov: whether to return the full predictive covariance matrix (n x n) or only the marginal variances
+                         (n x 1). The marginal variances are computed in O(n n*) memory.
+        :return: pred_mean, pred_var
+        """
+
+        K_s, training_inputs = self._cross_kernel(xs_star)
+        pred_mean = K_s.T.dot(self.alpha) + self.mean_func(xs_star)
+        Lk = solve_triangular(self.L, K_s, lower=True)
+
+        if not full_cov:
+            pred_var = kernel_diag(xs_star, self.l, self.sigma_f) - np.sum(np.square(Lk), axis=0)
+            return pred_mean, pred_var.reshape(pred_mean.shape) + self.jitter
+
+        K_ss = K_s if training_inputs else self.kernel(xs_star, xs_star, self.l, self.sigma_f)
+        pred_var = K_ss - np.dot(Lk.T, Lk)
+
+        return pred_mean, pred_var + self.jitter * np.eye(pred_var.shape[0])
+
+    def predict_chunks(self, xs_star, chunk_size=4096):
+        """
+        Generator over the posterior predictive mean and marginal variance of a large test set, chunk_size locations at
+        a time so that peak memory is O(chunk_size x m).
+
+        :param xs_star: test data input locations (n x d). May be a memory-mapped array.
+        :param chunk_size: number of test locations per chunk
+        :return: generator of (pred_mean, pred_var) blocks of shape (chunk_size x 1)
+        """
+
+        for i in range(0, len(xs_star), chunk_size):
+            yield self.predict(np.asarray(xs_star[i:i + chunk_size]), full_cov=False)
+
+    def predict_with_grad(self, xs_star):
+        """
+        Compute the posterior predictive mean and marginal variance together with their gradients with respect to the
+        test locations. Assumes a squared exponential kernel for which dk(x*, x_i)/dx* = -k(x*, x_i)(x* - x_i)/l^2.
+
+        :param xs_star: test data input locations (n x d)
+        :return: pred_mean (n x 1), pred_var (n x 1), d pred_mean / d xs_star (n x d), d pred_var / d xs_star (n x d)
+        """
+
+        K_s, _ = self._cross_kernel(xs_star)
+        pred_mean = K_s.T.dot(self.alpha) + self.mean_func(xs_star)
+        Lk = solve_triangular(self.L, K_s, lower=True)
+        pred_var = kernel_diag(xs_star, self.l, self.sigma_f) - np.sum(np.square(Lk), axis=0)
+
+        l = np.ravel(self.l) * np.ones(xs_star.shape[1])  # a single lengthscale is shared by every dimension
+        diffs = (xs_star[np.newaxis, :, :] - self.xs[:, np.newaxis, :]) / l**2  # (m x n x d)
+        dK_s = -K_s[:, :, np.newaxis] * diffs  # derivative of k(x*_j, x_i) with respect to x*_j
+
+        v = solve_triangular(self.L.T, Lk, lower=False)  # K^-1 K_s
+        dpred_mean = np.einsum('ijk,i->jk', dK_s, np.ravel(self.alpha))
+        dpred_var = -2 * np.einsum('ijk,ij->jk', dK_s, v)
+
+        return pred_mean, pred_var.reshape(pred_mean.shape) + self.jitter, dpred_mean, dpred_var
+
+    def _append_noise(self, k, noise_new):
+        """
+        :param k: number of new observations
+        :param noise_new: noise level(s) of the new observations or None to reuse a scalar noise level
+        :return: noise level(s) of the new observations. A per-point noise vector is extended with them.
+        """
+        if noise_new is None:
+            assert np.ndim(self.noise) == 0, 'noise_new must be given when the posterior has per-point noise levels.'
+            return self.noise
+
+        noise_new = np.reshape(noise_new, (-1, 1)) * np.ones((k, 1))
+        self.noise = np.vstack((self.noise * np.ones((len(self.xs), 1)), noise_new))
+
+        return noise_new
+
+    def append(self, xs_new, ys_new, noise_new=None):
+        """
+        Add a block of k observations to the posterior without refactorising the training covariance matrix. The
+        Cholesky factor is extended with a rank-k update at a cost of O(n^2 k) as opposed to O(n^3). The
+        hyperparameters are left unchanged.
+
+        :param xs_new: new input locations (k x d)
+        :param ys_new: new targets (k x 1)
+        :param noise_new: noise level(s) of the new observations. May be omitted if the posterior has a scalar noise
+                          level in which case the same noise level is used.
+        :return: None
+        """
+
+        xs_new = np.reshape(xs_new, (-1, self.xs.shape[1]))
+        ys_new = np.reshape(ys_new, (-1, 1))
+        m = len(self.xs)
+        k = len(xs_new)
+        noise_new = self._append_noise(k, noise_new)
+
+        # [[L, 0], [S^T, L_22]] is the Cholesky factor of [[K, K_12], [K_12^T, K_22]] with S = L^-1 K_12
+
+        K_12 = self.kernel(self.xs, xs_new, self.l, self.sigma_f)
+        K_22 = self.kernel(xs_new, xs_new, self.l, self.sigma_f) + noise_new**2 * np.eye(k)
+        S = solve_triangular(self.L, K_12, lower=True)
+        L_22 = np.linalg.cholesky(K_22 - S.T.dot(S))
+
+        L = np.zeros((m + k, m + k))
+        L[:m, :m] = self.L
+        L[m:, :m] = S.T
+        L[m:, m:] = L_22
+
+        self.L = L
+        self.xs = np.vstack((self.xs, xs_new))
+        self.ys = np.vstack((self.ys, ys_new))
+        self.alpha = cho_solve((self.L, True), self.ys - self.mean_func(self.xs))
+
+
+class SparseGPPosterior(GPPosterior):
+    """
+    Posterior of the inducing point GP of sparse_gp.py with fixed hyperparameters and inducing inputs Z. Everything is
+    held in the m-dimensional inducing space so that construction costs O(n m^2), a prediction at n* test locations
+    O(n* m^2) and no n x n matrix is formed. The predictions match sparse_gp.sparse_posterior_predictive.
+    """
+
+    def __init__(self, xs, ys, Z, noise, l, sigma_f, approximation='vfe'):
+        """
+        :param xs: training data input locations (n x d)
+        :param ys: training data targets (n x 1)
+        :param Z: inducing inputs (m x d)
+        :param noise: noise level. Either a scalar or a vector of per-point noise levels (n x 1)
+        :param l: kernel lengthscale(s)
+        :param sigma_f: signal amplitude
+        :param approximation: 'vfe' or 'fitc'. See sparse_gp.py.
+        """
+
+        self.xs = xs
+        self.ys = ys
+        self.Z = Z
+        self.noise = noise
+        self.l = l
+        self.sigma_f = sigma_f
+        self.approximation = approximation
+        self.mean_func = zero_mean
+        self.kernel = scipy_kernel
+
+        self.L_u = cholesky(scipy_kernel(Z, Z, l, sigma_f) + inducing_jitter * np.eye(len(Z)), lower=True)
+        self.B = np.eye(len(Z))  # I + V Lambda^-1 V^T with V = L_u^-1 K_uf
+        self.b = np.zeros((len(Z), 1))  # V Lambda^-1 y
+        self._add_to_factors(xs, ys, noise)
+
+    def _add_to_factors(self, xs, ys, noise):
+        """
+        Add the contribution of a block of observations to B and b and refactorise B. Lambda is diagonal so the
+        observations contribute independently and the cost is O(k m^2 + m^3) for k observations.
+        """
+
+        V = solve_triangular(self.L_u, scipy_kernel(self.Z, xs, self.l, self.sigma_f), lower=True)
+        lam = np.square(np.reshape(noise, -1)) * np.ones(len(xs))
+        if self.approximation == 'fitc':
+            lam += kernel_diag(xs, self.l, self.sigma_f) - np.sum(np.square(V), axis=0)
+
+        V_lam = V / lam
+        self.B += V_lam.dot(V.T)
+        self.b += V_lam.dot(np.reshape(ys, (-1, 1)))
+
+        L_B = cholesky(self.B, lower=True)
+        self.L_uB = self.L_u.dot(L_B)  # lower triangular with L_uB L_uB^T = K_uu + K_uf Lambda^-1 K_fu
+        self.alpha = solve_triangular(self.L_uB.T, solve_triangular(L_B, self.b, lower=True), lower=False)
+
+    def predict(self, xs_star, full_cov=True):
+        """
+        Compute the posterior predictive mean and variance of the sparse GP.
+
+        :param xs_star: test data input locations (n x d)
+        :param full_cov: whether to return the full predictive covariance matrix (n x n) or only the marginal variances
+                         (n x 1).
+        :return: pred_mean, pred_var
+        """
+
+        K_s = self.kernel(self.Z, xs_star, self.l, self.sigma_f)
+        pred_mean = K_s.T.dot(self.alpha)
+        V_s = solve_triangular(self.L_u, K_s, lower=True)
+        W_s = solve_triangular(self.L_uB, K_s, lower=True)
+
+        if not full_cov:
+            pred_var = kernel_diag(xs_star, self.l, self.sigma_f) - np.sum(np.square(V_s), axis=0) + \
+                np.sum(np.square(W_s), axis=0)
+            return pred_mean, pred_var.reshape(pred_mean.shape) + self.jitter
+
+        pred_var = self.kernel(xs_star, xs_star, self.l, self.sigma_f) - V_s.T.dot(V_s) + W_s.T.dot(W_s)
+
+        return pred_mean, pred_var + self.jitter * np.eye(pred_var.shape[0])
+
+    def predict_with_grad(self, xs_star):
+        """
+        Compute the posterior predictive mean and marginal variance together with their gradients with respect to the
+        test locations. See GPPosterior.predict_with_grad.
+
+        :param xs_star: test data input locations (n x d)
+        :return: pred_mean (n x 1), pred_var (n x 1), d pred_mean / d xs_star (n x d), d pred_var / d xs_star (n x d)
+        """
+
+        K_s = self.kernel(self.Z, xs_star, self.l, self.sigma_f)
+        pred_mean = K_s.T.dot(self.alpha)
+        V_s = solve_triangular(self.L_u, K_s, lower=True)
+        W_s = solve_triangular(self.L_uB, K_s, lower=True)
+        pred_var = kernel_diag(xs_star, self.l, self.sigma_f) - np.sum(np.square(V_s), axis=0) + \
+            np.sum(np.square(W_s), axis=0)
+
+        l = np.ravel(self.l) * np.ones(xs_star.shape[1])  # a single lengthscale is shared by every dimension
+        diffs = (xs_star[np.newaxis, :, :] - self.Z[:, np.newaxis, :]) / l**2  # (m x n x d)
+        dK_s = -K_s[:, :, np.newaxis] * diffs  # derivative of k(x*_j, z_i) with respect to x*_j
+
+        v = solve_triangular(self.L_u.T, V_s, lower=False) - solve_triangular(self.L_uB.T, W_s, lower=False)
+        dpred_mean = np.einsum('ijk,i->jk', dK_s, np.ravel(self.alpha))
+        dpred_var = -2 * np.einsum('ijk,ij->jk', dK_s, v)
+
+        return pred_mean, pred_var.reshape(pred_mean.shape) + self.jitter, dpred_mean, dpred_var
+
+    def append(self, xs_new, ys_new, noise_new=None):
+        """
+        Add a block of k observations to the posterior at a cost of O(k m^2 + m^3). The inducing inputs and
+        hyperparameters are left unchanged.
+
+        :param xs_new: new input locations (k x d)
+        :param ys_new: new targets (k x 1)
+        :param noise_new: noise level(s) of the new observations. May be omitted if the posterior has a scalar noise
+                          level in which case the same noise level is used.
+        :return: None
+        """
+
+        xs_new = np.reshape(xs_new, (-1, self.xs.shape[1]))
+        ys_new = np.reshape(ys_new, (-1, 1))
+        noise_new = self._append_noise(len(xs_new), noise_new)
+
+        self._add_to_factors(xs_new, ys_new, noise_new)
+        self.xs = np.vstack((self.xs, xs_new))
+        self.ys = np.vstack((self.ys, ys_new))
+
+
+class HeteroscedasticGPPosterior:
+    """
+    Posterior of the most likely heteroscedastic GP. GP1 models the objective with the learned per-point noise and GP2
+    models the log variance of the noise.
+    """
+
+    def __init__(self, gp1, gp2, Y_scaler=None):
+        """
+        :param gp1: GPPosterior or SparseGPPosterior fitted to (X_sample, Y_sample) with the learned noise function as
+                    its noise.
+        :param gp2: GPPosterior or SparseGPPosterior fitted to the auxiliary dataset (X_sample, variance_estimator).
+        :param Y_scaler: StandardScaler used to standardise the log variance estimator GP2 was fitted to, if any. Only
+                         used by predict_noise.
+        """
+
+        self.gp1 = gp1
+        self.gp2 = gp2
+        self.Y_scaler = Y_scaler
+
+    @property
+    def xs(self):
+        return self.gp1.xs
+
+    def predict(self, xs_star):
+        """
+        Compute predictions at the test locations using the heteroscedastic GP. Equivalent to
+        bo_gp_fit_predict.bo_predict_hetero_gp.
+
+        :param xs_star: test locations (n x d)
+        :return: predictive mean (n x 1), predictive variance (n, ) and aleatoric standard deviation (n, ).
+        """
+
+        pred_mean_het, pred_var_het = self.gp1.predict(xs_star, full_cov=False)
+        pred_mean_noise, _ = self.gp2.predict(xs_star, full_cov=False)
+        pred_mean_noise = np.exp(pred_mean_noise)
+        pred_mean_noise = np.sqrt(pred_mean_noise).reshape(len(pred_mean_noise))  # taking the standard deviation
+
+        pred_var = pred_var_het.reshape(len(pred_var_het)) + pred_mean_noise
+
+        return pred_mean_het, pred_var, pred_mean_noise
+
+    def predict_noise(self, xs_star):
+        """
+        Predict the learned noise function at new locations from GP2, e.g. as the noise levels of fantasy observations.
+
+        :param xs_star: locations (n x d)
+        :return: noise standard deviation at xs_star (n x 1)
+        """
+
+        gp2_pred_mean, _ = self.gp2.predict(xs_star, full_cov=False)
+        if self.Y_scaler is not None:
+            gp2_pred_mean = self.Y_scaler.inverse_transform(gp2_pred_mean)
+
+        return np.sqrt(np.exp(gp2_pred_mean))
+
+    def predict_chunks(self, xs_star, chunk_size=4096):
+        """
+        Generator over the heteroscedastic predictions of a large test set, chunk_size locations at a time.
+
+        :param xs_star: test locations (n x d). May be a memory-mapped array.
+        :param chunk_size: number of test locations per chunk
+        :return: generator of (predictive mean, predictive variance, aleatoric standard deviation) blocks. See predict.
+        """
+
+        for i in range(0, len(xs_star), chunk_size):
+            yield self.predict(np.asarray(xs_star[i:i + chunk_size]))
+
+    def predict_with_grad(self, xs_star):
+        """
+        Compute the heteroscedastic predictions together with their gradients with respect to the test locations. The
+        gradient of the aleatoric standard deviation sqrt(exp(g(x))) is 0.5 sqrt(exp(g(x))) dg/dx where g is the GP2
+        predictive mean.
+
+        :param xs_star: test locations (n x d)
+        :return: predictive mean (n x 1), predictive variance (n, ), aleatoric standard deviation (n, ) and the
+                 gradients of each with respect to xs_star (n x d).
+        """
+
+        pred_mean_het, pred_var_het, dpred_mean_het, dpred_var_het = self.gp1.predict_with_grad(xs_star)
+        pred_mean_noise, _, dpred_mean_noise, _ = self.gp2.predict_with_grad(xs_star)
+        aleatoric_std = np.sqrt(np.exp(pred_mean_noise))  # (n x 1)
+        daleatoric_std = 0.5 * aleatoric_std * dpred_mean_noise
+
+        pred_var = pred_var_het + aleatoric_std
+        dpred_var = dpred_var_het + daleatoric_std
+
+        return pred_mean_het, np.ravel(pred_var), np.ravel(aleatoric_std), dpred_mean_het, dpred_var, daleatoric_std
+
+    def append(self, xs_new, ys_new, noise_new):
+        """
+        Add a block of observations to GP1 and GP2 with rank-k updates of their Cholesky factors. GP2 is given the log
+        variance of the new noise levels, standardised with Y_scaler if there is one, so that it covers the same inputs
+        as GP1 and agrees with the noise levels assigned to the new observations. The hyperparameters of both GPs are
+        left unchanged until they are refitted together with the noise function by the EM procedure.
+
+        :param xs_new: new input locations (k x d)
+        :param ys_new: new targets (k x 1)
+        :param noise_new: learned noise level(s) of the new observations (k x 1)
+        :return: None
+        """
+
+        xs_new = np.reshape(xs_new, (-1, self.xs.shape[1]))
+        log_variance = np.log(np.square(np.reshape(noise_new, (-1, 1)))) * np.ones((len(xs_new), 1))
+        if self.Y_scaler is not None:
+            log_variance = self.Y_scaler.transform(log_variance)
+
+        self.gp1.append(xs_new, ys_new, noise_new)
+        self.gp2.append(xs_new, log_variance)
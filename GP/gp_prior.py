@@ -10,7 +10,7 @@ from mpl_toolkits.mplot3d.axes3d import Axes3D
 import numpy as np
 from scipy.optimize import minimize
 
-from kernels import anisotropic_kernel
+from kernels import anisotropic_kernel, sq_exp_kernel_matrix
 from mean_functions import zero_mean
 from objective_functions import branin_function, branin_plot_function, noise_plot_function, min_branin_noise_function
 from utils import my_nll_fn, neg_log_marg_lik, posterior_predictive
@@ -45,11 +45,7 @@ if __name__ == "__main__":
         xs = np.linspace(0.0, 10.0, num=100)  # array of sampling locations
         m = len(xs)  # number of sampling locations
         mean_vector = np.zeros((m,))
-        K = np.zeros((m, m))  # covariance matrix
-
-        for i in range(0, m):
-            for j in range(0, m):
-                K[i, j] = anisotropic_kernel(xs[i], xs[j], 2, 1)
+        K = sq_exp_kernel_matrix(xs, None, 2, 1)  # covariance matrix
 
         upper, lower = compute_confidence_bounds(mean_vector, K)
         y_1 = np.random.multivariate_normal(mean_vector, K)
@@ -0,0 +1,207 @@
+# Copyright Lee Group 2019
+# Author: Ryan-Rhys Griffiths
+"""
+This module contains an iterative engine for the exact GP negative log marginal likelihood. In place of a Cholesky
+factorisation of K = K_nn + N it uses
+
+a blocked preconditioned conjugate gradient (mBCG) solve for K^-1 y and K^-1 z_1, ..., K^-1 z_t at once,
+stochastic Lanczos quadrature for log|K|, using the Lanczos tridiagonals recovered from the CG coefficients,
+a rank-k pivoted Cholesky preconditioner P = L_k L_k^T + N which is inverted with the Woodbury identity.
+
+Only products of K with a block of vectors are needed and these are computed in row blocks of scipy_kernel, so memory
+is O(block_size n) rather than O(n^2) and no approximation is made to the model itself (Gardner et al., 2018).
+"""
+
+import numpy as np
+from scipy.linalg import cho_solve, cholesky
+
+from kernels import scipy_kernel, scipy_kernel_with_grad
+from sparse_gp import pivoted_cholesky
+
+
+def kernel_matvec(X, V, l, sigma_f, noise_var, block_size=1024):
+    """
+    Product (K_nn + N) V computed in row blocks so that at most block_size rows of K_nn are held in memory.
+
+    :param X: input locations (n x d)
+    :param V: block of vectors (n x t)
+    :param l: kernel lengthscale(s)
+    :param sigma_f: signal amplitude
+    :param noise_var: noise variance. Either a scalar or a vector of per-point noise variances (n x 1)
+    :param block_size: number of rows of K_nn computed at a time
+    :return: (K_nn + N) V (n x t)
+    """
+    out = np.reshape(noise_var, (-1, 1)) * V
+
+    for i in range(0, len(X), block_size):
+        out[i:i + block_size] += scipy_kernel(X[i:i + block_size], X, l, sigma_f).dot(V)
+
+    return out
+
+
+def kernel_grad_quadratic(X, U, W, l, sigma_f, block_size=1024):
+    """
+    Sum over columns of u_c^T (dK_nn / dtheta) w_c for each kernel hyperparameter theta, computed in row blocks.
+
+    :param X: input locations (n x d)
+    :param U: block of vectors (n x t)
+    :param W: block of vectors (n x t)
+    :param l: kernel lengthscale(s)
+    :param sigma_f: signal amplitude
+    :param block_size: number of rows of K_nn computed at a time
+    :return: array (p + 1, ) ordered as [lengthscale(s), sigma_f]
+    """
+    out = 0
+
+    for i in range(0, len(X), block_size):
+        _, dK = scipy_kernel_with_grad(X[i:i + block_size], X, l, sigma_f)
+        out = out + np.einsum('pbn,nt,bt->p', dK, W, U[i:i + block_size])
+
+    return out
+
+
+def pivoted_cholesky_preconditioner(L_k, noise_var):
+    """
+    Preconditioner P = L_k L_k^T + N.
+
+    :param L_k: low-rank factor (n x k)
+    :param noise_var: noise variance. Either a scalar or a vector of per-point noise variances (n x 1)
+    :return: function applying P^-1 to a block of vectors (n x t) and log|P|
+    """
+    noise_inv = 1 / (np.reshape(noise_var, (-1, 1)) * np.ones((len(L_k), 1)))
+    L_C = cholesky(np.eye(L_k.shape[1]) + L_k.T.dot(noise_inv * L_k), lower=True)  # I + L_k^T N^-1 L_k
+    logdet = 2 * np.sum(np.log(np.diagonal(L_C))) - np.sum(np.log(noise_inv))
+
+    def solve(V):
+        return noise_inv * V - noise_inv * L_k.dot(cho_solve((L_C, True), L_k.T.dot(noise_inv * V)))
+
+    return solve, logdet
+
+
+def mbcg(matvec, B, precond, max_iter=100, tol=1e-6):
+    """
+    Blocked preconditioned conjugate gradients solving A X = B for every column of B at once. The CG step sizes alpha_j
+    and beta_j of each column are also returned; they define the Lanczos tridiagonal of the preconditioned matrix.
+
+    :param matvec: function computing A V for a block of vectors V (n x t)
+    :param B: right-hand sides (n x t)
+    :param precond: function applying the inverse of the preconditioner to a block of vectors
+    :param max_iter: maximum number of iterations
+    :param tol: stop once every column's residual norm relative to its right-hand side is below tol
+    :return: solutions X (n x t), alphas (j x t) and betas (j x t)
+    """
+    X = np.zeros_like(B)
+    R = B.copy()
+    Z = precond(R)
+    P = Z.copy()
+    rz = np.sum(R * Z, axis=0)
+    b_norm = np.linalg.norm(B, axis=0)
+    alphas, betas = [], []
+
+    for j in range(max_iter):
+        AP = matvec(P)
+        alpha = rz / np.sum(P * AP, axis=0)
+        X += alpha * P
+        R -= alpha * AP
+        Z = precond(R)
+        rz_new = np.sum(R * Z, axis=0)
+        beta = rz_new / rz
+        alphas.append(alpha)
+        betas.append(beta)
+
+        if np.all(np.linalg.norm(R, axis=0) < tol * b_norm):
+            break
+
+        P = Z + beta * P
+        rz = rz_new
+
+    return X, np.array(alphas), np.array(betas)
+
+
+def lanczos_quadrature_log(alphas, betas):
+    """
+    Gauss quadrature estimate of e_1^T log(T) e_1 for the Lanczos tridiagonal T of a single CG run.
+
+    :param alphas: CG step sizes (j, )
+    :param betas: CG direction updates (j, )
+    :return: e_1^T log(T) e_1
+    """
+    diag = 1 / alphas
+    diag[1:] += betas[:-1] / alphas[:-1]
+    off_diag = np.sqrt(betas[:-1]) / alphas[:-1]
+    T = np.diag(diag) + np.diag(off_diag, 1) + np.diag(off_diag, -1)
+    eigvals, eigvecs = np.linalg.eigh(T)
+
+    return np.sum(eigvecs[0]**2 * np.log(eigvals))
+
+
+def iterative_nll_and_grad(X_train, Y_train, noise_var, l, sigma_f, probes, rank=20, max_iter=100, tol=1e-6,
+                           block_size=1024):
+    """
+    Stochastic estimate of the negative log marginal likelihood and its gradient with respect to the kernel
+    hyperparameters.
+
+    log|K| = log|P| + log|P^-1 K| where the second term is estimated by stochastic Lanczos quadrature with probes
+    z ~ N(0, P), and tr(K^-1 dK) is estimated as the mean of (P^-1 z)^T dK (K^-1 z) over the same probes.
+
+    :param X_train: training inputs locations (n x d)
+    :param Y_train: training targets (n x 1)
+    :param noise_var: noise variance. Either a scalar or a vector of per-point noise variances (n x 1)
+    :param l: horizontal lengthscale(s)
+    :param sigma_f: vertical lengthscale
+    :param probes: standard normal draws (n + rank x t) mapped to probes z = L_k e_k + N^1/2 e_n
+    :param rank: rank of the pivoted Cholesky preconditioner
+    :param max_iter: maximum number of CG iterations
+    :param tol: relative residual tolerance of CG
+    :param block_size: number of rows of K_nn computed at a time
+    :return: value of the negative log marginal likelihood and its gradient with respect to [lengthscale(s), sigma_f]
+    """
+    Y_train = np.reshape(Y_train, (-1, 1))
+    n = len(X_train)
+    noise_var = np.reshape(noise_var, (-1, 1)) * np.ones((n, 1))
+
+    L_k, _ = pivoted_cholesky(X_train, rank, l, sigma_f)
+    precond, logdet_P = pivoted_cholesky_preconditioner(L_k, noise_var)
+    Z = L_k.dot(probes[n:n + L_k.shape[1]]) + np.sqrt(noise_var) * probes[:n]  # z ~ N(0, P)
+
+    def matvec(V):
+        return kernel_matvec(X_train, V, l, sigma_f, noise_var, block_size)
+
+    solves, alphas, betas = mbcg(matvec, np.hstack((Y_train, Z)), precond, max_iter, tol)
+    alpha = solves[:, :1]  # K^-1 y
+    P_inv_Z = precond(Z)
+
+    quadratures = [lanczos_quadrature_log(alphas[:, i + 1], betas[:, i + 1]) for i in range(Z.shape[1])]
+    logdet = logdet_P + np.mean(np.sum(Z * P_inv_Z, axis=0) * np.array(quadratures))
+
+    nll = 0.5 * Y_train.T.dot(alpha).item() + 0.5 * logdet + 0.5 * n * np.log(2*np.pi)
+
+    trace_term = kernel_grad_quadratic(X_train, P_inv_Z, solves[:, 1:], l, sigma_f, block_size) / Z.shape[1]
+    quadratic_term = kernel_grad_quadratic(X_train, alpha, alpha, l, sigma_f, block_size)
+
+    return nll, 0.5 * (trace_term - quadratic_term)
+
+
+def nll_fn_het_cg_grad(X_train, Y_train, noise, num_probes=10, rank=20, max_iter=100, tol=1e-6, block_size=1024):
+    """
+    :param X_train: training inputs locations
+    :param Y_train: training targets
+    :param noise: fixed noise parameter of y_train. Either a scalar or a vector of per-point noise levels (n x 1).
+    :param num_probes: number of probe vectors of the stochastic estimators
+    :param rank: rank of the pivoted Cholesky preconditioner
+    :param max_iter: maximum number of CG iterations
+    :param tol: relative residual tolerance of CG
+    :param block_size: number of rows of K_nn computed at a time
+    :return: optimisation step
+
+    Iterative counterpart of utils.nll_fn_het_grad. The hyperparameter vector theta is [lengthscale(s), sigma_f]. The
+    probe draws are fixed when the objective is created so that the estimate is a deterministic function of theta, as
+    the line search of the optimiser requires.
+    """
+
+    probes = np.random.randn(len(X_train) + rank, num_probes)
+
+    def step(theta):
+        return iterative_nll_and_grad(X_train, Y_train, np.square(noise), theta[:-1], theta[-1], probes, rank, max_iter,
+                                      tol, block_size)
+    return step
@@ -0,0 +1,137 @@
+# Copyright Lee Group 2019
+# Author: Ryan-Rhys Griffiths
+"""
+This module contains a bounded least recently used cache of training covariance matrices K(xs, xs) and the Cholesky
+factors of K(xs, xs) + N. In a heteroscedastic BO iteration the same matrices are rebuilt with identical
+hyperparameters by the final GP1 fit, bo_predict_homo_gp at the sample locations, the plotting calls and the
+mu_sample prediction, all of which go through GPPosterior. utils.posterior_predictive uses the cache when it is
+passed one. Entries are keyed on a fingerprint of the inputs (and the noise for the Cholesky factors), the
+kernel function and the hyperparameters, and the least recently used entries are evicted once the cached arrays exceed
+max_bytes. Cached arrays are read-only so that a caller can't modify an entry in place.
+"""
+
+from collections import OrderedDict
+import hashlib
+import threading
+
+import numpy as np
+
+
+def fingerprint(X):
+    """
+    Cheap fingerprint of an array: its shape, dtype and a 128-bit hash of its contents. Costs O(n d) as opposed to the
+    O(n^2 d) of building a covariance matrix from it.
+
+    :param X: array
+    :return: hashable fingerprint
+    """
+    X = np.ascontiguousarray(X)
+
+    return X.shape, X.dtype.str, hashlib.blake2b(X.view(np.uint8), digest_size=16).digest()
+
+
+def hyper_key(l, sigma_f):
+    """
+    :param l: lengthscale(s)
+    :param sigma_f: signal amplitude
+    :return: hashable tuple of the hyperparameters
+    """
+    return tuple(np.ravel(l).astype(np.float64)) + (float(sigma_f),)
+
+
+class KernelCache:
+    """
+    LRU cache of training covariance matrices and their Cholesky factors with hit and miss counters.
+    """
+
+    def __init__(self, max_bytes=256 * 2**20):
+        """
+        :param max_bytes: upper bound on the total size of the cached arrays. Arrays larger than this are not cached.
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()  # the cache may be shared by the threads of an executor
+
+    def _get(self, key, count=True):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += count
+                return self._entries[key]
+            self.misses += count
+            return None
+
+    def _put(self, key, value):
+        value.setflags(write=False)
+        if value.nbytes > self.max_bytes:
+            return value
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = value
+                self.nbytes += value.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+
+        return value
+
+    def kernel(self, kernel, xs, l, sigma_f):
+        """
+        :param kernel: GP covariance function with the signature of kernels.scipy_kernel
+        :param xs: input locations (m x d)
+        :param l: kernel lengthscale(s)
+        :param sigma_f: signal amplitude
+        :return: covariance matrix K(xs, xs) (m x m), read-only
+        """
+        return self._kernel(kernel, xs, l, sigma_f, count=True)
+
+    def _kernel(self, kernel, xs, l, sigma_f, count):
+        key = ('kernel', kernel, fingerprint(xs), hyper_key(l, sigma_f))
+        K = self._get(key, count)
+        if K is None:
+            K = self._put(key, kernel(xs, xs, l, sigma_f))
+
+        return K
+
+    def cholesky(self, kernel, xs, noise, l, sigma_f):
+        """
+        :param kernel: GP covariance function with the signature of kernels.scipy_kernel
+        :param xs: input locations (m x d)
+        :param noise: noise level. Either a scalar or a vector of per-point noise levels (m x 1)
+        :param l: kernel lengthscale(s)
+        :param sigma_f: signal amplitude
+        :return: lower Cholesky factor of K(xs, xs) + noise^2 I (m x m), read-only
+        """
+        key = ('cholesky', kernel, fingerprint(xs), fingerprint(np.asarray(noise, dtype=np.float64)),
+               hyper_key(l, sigma_f))
+        L = self._get(key)
+        if L is None:
+            K = self._kernel(kernel, xs, l, sigma_f, count=False)  # each public call counts a single hit or miss
+            L = self._put(key, np.linalg.cholesky(K + noise**2 * np.eye(len(xs))))
+
+        return L
+
+    def stats(self):
+        """
+        :return: dictionary of the hit, miss and eviction counts, the number of entries and their total size in bytes
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'nbytes': self.nbytes}
+
+    def clear(self):
+        """
+        Remove every entry and reset the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = self.nbytes = 0
+
+
+kernel_cache = KernelCache()  # shared by every GPPosterior in the process
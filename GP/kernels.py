@@ -5,7 +5,7 @@ This module contains definitions of common GP kernels.
 """
 
 import numpy as np
-from scipy.spatial.distance import cdist, squareform
+from scipy.spatial.distance import cdist, pdist, squareform
 
 
 def kernel(X1, X2, l, sigma_f):
@@ -20,6 +20,7 @@ def kernel(X1, X2, l, sigma_f):
     :return: Covariance matrix (m x n)
     """
     sqdist = np.sum(X1**2, 1).reshape(-1, 1) + np.sum(X2**2, 1) - 2 * np.dot(X1, X2.T)
+    sqdist = np.maximum(sqdist, 0)  # the expansion can round to small negative values for coincident points
     return sigma_f**2 * np.exp(-0.5 / l**2 * sqdist)
 
 
@@ -35,18 +36,246 @@ def scipy_kernel(X1, X2, l, sigma_f):
     :param sigma_f: vertical lengthscale
     :return: Covariance matrix (m x n)
     """
-    l = np.array(l).reshape(-1, 1)
-    num_dims = X1.shape[1]
-    l_matrix = np.zeros((num_dims, num_dims))
-    np.fill_diagonal(l_matrix, 1/l)  # lengthscale gets squared later on
-    reduced_X1 = X1@l_matrix  # we right multiply by a diagonal matrix with 1/lengthscale on the diagonals
-    reduced_X2 = X2@l_matrix
+    l = np.array(l, dtype=np.float64).reshape(-1)
+    reduced_X1 = X1 / l  # we divide each dimension by its lengthscale, which gets squared later on
+    reduced_X2 = X2 / l
     pairwise_sq_dists = cdist(reduced_X1, reduced_X2, 'sqeuclidean')
     K = sigma_f**2 * np.exp(-0.5 * pairwise_sq_dists)
 
     return K
 
 
+def scipy_kernel_with_grad(X1, X2, l, sigma_f):
+    """
+    Scipy implementation of the squared exponential kernel together with its derivatives with respect to the
+    hyperparameters. Used to supply analytic gradients of the negative log marginal likelihood to the optimiser.
+
+    :param X1: Array of m points (m x d)
+    :param X2: Array of n points (n x d)
+    :param l: horizontal lengthscale(s). Either a single lengthscale shared across dimensions or one per dimension.
+    :param sigma_f: vertical lengthscale
+    :return: Covariance matrix K (m x n) and derivative array dK (p + 1 x m x n) where dK[i] is the derivative of K with
+             respect to the ith of the p lengthscales and dK[-1] is the derivative with respect to sigma_f.
+    """
+    K = scipy_kernel(X1, X2, l, sigma_f)
+    l = np.array(l, dtype=np.float64).reshape(-1)
+    num_dims = X1.shape[1]
+
+    dK = np.empty((len(l) + 1, X1.shape[0], X2.shape[0]))
+
+    if len(l) == 1:  # a single lengthscale is shared by every dimension
+        dK[0] = K * cdist(X1, X2, 'sqeuclidean') / l[0]**3
+    else:
+        for i in range(num_dims):
+            dK[i] = K * cdist(X1[:, i:i + 1], X2[:, i:i + 1], 'sqeuclidean') / l[i]**3
+
+    dK[-1] = 2 * K / sigma_f
+
+    return K, dK
+
+
+def scaled_sq_dists(X1, X2=None, l=1.0):
+    """
+    Pairwise squared distances between the points in X1 and X2 after dividing each dimension by its lengthscale. If X2
+    is None the distances of X1 to itself are returned and only the upper triangle is computed and then mirrored.
+
+    :param X1: Array of m points (m x d) or (m, ) for one-dimensional inputs
+    :param X2: Array of n points (n x d), or None for the symmetric case X2 = X1
+    :param l: horizontal lengthscale(s). Either a single lengthscale shared across dimensions or one per dimension.
+    :return: Squared distance matrix (m x n)
+    """
+    l = np.array(l, dtype=np.float64).reshape(-1)
+    X1 = np.reshape(X1, (len(X1), -1)) / l
+
+    if X2 is None:
+        return squareform(pdist(X1, 'sqeuclidean'))  # pdist computes each pair i < j once
+
+    return cdist(X1, np.reshape(X2, (len(X2), -1)) / l, 'sqeuclidean')
+
+
+def sq_exp_kernel_matrix(X1, X2=None, l=1.0, sigma_f=1.0, out=None):
+    """
+    Squared exponential covariance matrix built with a single vectorised distance computation. If X2 is None the
+    symmetric matrix k(X1, X1) is computed from its upper triangle.
+
+    :param X1: Array of m points (m x d) or (m, ) for one-dimensional inputs
+    :param X2: Array of n points (n x d), or None for the symmetric case X2 = X1
+    :param l: horizontal lengthscale(s). Either a single lengthscale shared across dimensions or one per dimension.
+    :param sigma_f: vertical lengthscale
+    :param out: optional C-contiguous float64 array (m x n) that is overwritten with the covariance matrix so that no
+                m x n temporaries are allocated
+    :return: Covariance matrix (m x n)
+    """
+    if out is None:
+        return sigma_f**2 * np.exp(-0.5 * scaled_sq_dists(X1, X2, l))
+
+    l = np.array(l, dtype=np.float64).reshape(-1)
+    X1 = np.reshape(X1, (len(X1), -1)) / l
+    X2 = X1 if X2 is None else np.reshape(X2, (len(X2), -1)) / l
+    cdist(X1, X2, 'sqeuclidean', out=out)
+    out *= -0.5
+    np.exp(out, out=out)
+    out *= sigma_f**2
+
+    return out
+
+
+class SqDistCache:
+    """
+    Per-dimension squared differences between a fixed set of training inputs xs and test inputs xs_star, computed once
+    so that each evaluation of the squared exponential kernel for new hyperparameters is only a weighted sum over
+    dimensions followed by an exponential. The cache is called with the signature of scipy_kernel and can be passed
+    wherever a kernel is expected. The differences take d x n x n memory for each pair of input sets that is used, so
+    only the (xs, xs) and (xs, xs_star) blocks are cached. The (xs_star, xs_star) block is needed just once per full
+    covariance prediction and is computed directly.
+
+    Inputs are recognised by identity (``X is xs``) rather than by content, so that a lookup costs nothing next to the
+    kernel evaluation. Any other array, including an equal copy of xs, falls back to scipy_kernel. The cache assumes
+    that xs and xs_star are not modified in place while it is in use; build a new cache for new inputs.
+
+    The differences are held in-process only. Pickling, e.g. to send the cache to an executor's worker, keeps xs and
+    xs_star but drops the differences, which the worker recomputes on first use. Identity survives only when the cache
+    is pickled together with the arrays it is used with, as gp_multistart.multistart_minimise_nll does with the
+    factory arguments of each restart. A cache pickled on its own falls back to scipy_kernel in the worker.
+    """
+
+    def __init__(self, xs, xs_star=None):
+        """
+        :param xs: training input locations (n x d)
+        :param xs_star: test input locations (n* x d)
+        """
+        self.xs = xs
+        self.xs_star = xs_star
+        self._sq_diffs = {}
+        self._sq_dists = {}
+
+    def __getstate__(self):
+        # the differences are recomputed on first use rather than pickled to worker processes
+
+        return {'xs': self.xs, 'xs_star': self.xs_star, '_sq_diffs': {}, '_sq_dists': {}}
+
+    def _name(self, X):
+        if X is self.xs:
+            return 'train'
+        if X is self.xs_star:
+            return 'test'
+        return None
+
+    def sq_diffs(self, X1, X2):
+        """
+        :param X1: Array of m points (m x d), either xs or xs_star
+        :param X2: Array of n points (n x d), either xs or xs_star
+        :return: per-dimension squared differences (d x m x n) and their sum over dimensions (m x n), or None if either
+                 input is not cached or both are xs_star
+        """
+        key = (self._name(X1), self._name(X2))
+        if None in key or key == ('test', 'test'):
+            return None
+
+        if key not in self._sq_diffs and key[::-1] in self._sq_diffs:
+            return self._sq_diffs[key[::-1]].transpose(0, 2, 1), self._sq_dists[key[::-1]].T
+
+        if key not in self._sq_diffs:
+            X1, X2 = np.reshape(X1, (len(X1), -1)), np.reshape(X2, (len(X2), -1))
+            self._sq_diffs[key] = np.stack([cdist(X1[:, i:i + 1], X2[:, i:i + 1], 'sqeuclidean')
+                                            for i in range(X1.shape[1])])
+            self._sq_dists[key] = np.sum(self._sq_diffs[key], axis=0)
+
+        return self._sq_diffs[key], self._sq_dists[key]
+
+    def _scaled_sq_dists(self, sq_diffs, sq_dists, ls):
+        """
+        :param ls: lengthscales (B x p) where p is either 1 (shared across dimensions) or d
+        :return: squared distances scaled by each row of lengthscales (B x m x n)
+        """
+        if ls.shape[1] == 1:  # a single lengthscale is shared by every dimension
+            return sq_dists[np.newaxis] / ls[:, :1, np.newaxis]**2
+
+        return np.einsum('bp,pmn->bmn', 1 / ls**2, sq_diffs)
+
+    def __call__(self, X1, X2, l, sigma_f):
+        """
+        Drop-in replacement for scipy_kernel.
+        """
+        cached = self.sq_diffs(X1, X2)
+        if cached is None:
+            return scipy_kernel(X1, X2, l, sigma_f)
+
+        return sigma_f**2 * np.exp(-0.5 * self._scaled_sq_dists(*cached, np.reshape(l, (1, -1)).astype(np.float64))[0])
+
+    def batched(self, X1, X2, ls, sigma_fs):
+        """
+        Drop-in replacement for batched_scipy_kernel.
+        """
+        cached = self.sq_diffs(X1, X2)
+        if cached is None:
+            return batched_scipy_kernel(X1, X2, ls, sigma_fs)
+
+        ls = np.array(ls, dtype=np.float64).reshape(len(sigma_fs), -1)
+        sigma_fs = np.array(sigma_fs, dtype=np.float64).reshape(-1)
+
+        return sigma_fs[:, np.newaxis, np.newaxis]**2 * np.exp(-0.5 * self._scaled_sq_dists(*cached, ls))
+
+
+def batched_scipy_kernel(X1, X2, ls, sigma_fs):
+    """
+    Squared exponential kernel evaluated for a batch of B hyperparameter settings at once. The per-dimension squared
+    distances are computed a single time and reweighted by each setting's lengthscales so that scoring many candidate
+    hyperparameters costs one stacked computation rather than B calls to scipy_kernel.
+
+    :param X1: Array of m points (m x d)
+    :param X2: Array of n points (n x d)
+    :param ls: lengthscales (B x p) where p is either 1 (shared across dimensions) or d
+    :param sigma_fs: vertical lengthscales (B, )
+    :return: Covariance matrices (B x m x n)
+    """
+    ls = np.array(ls, dtype=np.float64).reshape(len(sigma_fs), -1)
+    sigma_fs = np.array(sigma_fs, dtype=np.float64).reshape(-1)
+
+    if ls.shape[1] == 1:  # a single lengthscale is shared by every dimension
+        sq_dists = cdist(X1, X2, 'sqeuclidean')[np.newaxis]
+    else:
+        sq_dists = np.stack([cdist(X1[:, i:i + 1], X2[:, i:i + 1], 'sqeuclidean') for i in range(X1.shape[1])])
+
+    scaled_sq_dists = np.einsum('bp,pmn->bmn', 1 / ls**2, sq_dists)
+
+    return sigma_fs[:, np.newaxis, np.newaxis]**2 * np.exp(-0.5 * scaled_sq_dists)
+
+
+def kernel_diag(X, l, sigma_f):
+    """
+    Diagonal of the covariance matrix k(X, X) for the squared exponential kernels in this module. The kernels are
+    stationary so the diagonal is the signal variance at every point and the full m x m matrix need never be built.
+
+    :param X: Array of m points (m x d)
+    :param l: horizontal lengthscale(s). Unused but kept so that the signature matches the kernels.
+    :param sigma_f: vertical lengthscale
+    :return: Diagonal of the covariance matrix (m, )
+    """
+    return np.full(np.shape(X)[0], sigma_f**2, dtype=np.float64)
+
+
+def matern_kernel(X1, X2, l, sigma_f, nu=1.5):
+    """
+    Matern kernel with smoothness nu = 3/2 or 5/2. Used as the dense reference for the state space GP in
+    state_space_gp.py, which represents these kernels exactly.
+
+    :param X1: Array of m points (m x d)
+    :param X2: Array of n points (n x d)
+    :param l: horizontal lengthscale
+    :param sigma_f: vertical lengthscale
+    :param nu: smoothness, 1.5 or 2.5
+    :return: Covariance matrix (m x n)
+    """
+    r = np.sqrt(2 * nu) * cdist(X1, X2, 'euclidean') / np.ravel(l)[0]
+
+    if nu == 1.5:
+        return sigma_f**2 * (1 + r) * np.exp(-r)
+    elif nu == 2.5:
+        return sigma_f**2 * (1 + r + r**2 / 3) * np.exp(-r)
+    raise ValueError('Only nu = 1.5 and nu = 2.5 are supported')
+
+
 def anisotropic_kernel(X1, X2, l, sigma_f):
     """
     Implementation of anisotropic squared exponential kernel. Computes a covariance matrix from points in X1 and X2.
@@ -77,11 +306,10 @@ def anisotropic_kernel(X1, X2, l, sigma_f):
     num_dims = X1.shape[1]
     assert num_dims == len(l)  # There must be a lengthscale per dimension
 
-    l_matrix = np.zeros((num_dims, num_dims))
-    np.fill_diagonal(l_matrix, 1/l)  # lengthscale gets squared later on
-    reduced_X1 = X1@l_matrix  # we right multiply by a diagonal matrix with 1/lengthscale on the diagonals
-    reduced_X2 = X2@l_matrix
+    reduced_X1 = X1 / l.T  # we divide each dimension by its lengthscale, which gets squared later on
+    reduced_X2 = X2 / l.T
     sqdist = np.sum(reduced_X1**2, 1).reshape(-1, 1) + np.sum(reduced_X2**2, 1) - 2 * np.dot(reduced_X1, reduced_X2.T)
+    sqdist = np.maximum(sqdist, 0)  # the expansion can round to small negative values for coincident points
     return sigma_f**2 * np.exp(-0.5 * sqdist)
 
 
@@ -114,13 +342,4 @@ def compute_kernel_matrix_sq_exp(X, lengthscale, sigma):
 
     assert lengthscale != 0  # Causes zero division error.
 
-    N = X.shape[0]
-    K = np.zeros((N, N))
-    i = 0
-    for input_one in X:
-        j = 0
-        for input_two in X:
-            K[i, j] = sigma**2 * np.exp((-np.linalg.norm(input_one - input_two)**2)/(2*lengthscale**2))
-            j += 1
-        i += 1
-    return K
+    return sq_exp_kernel_matrix(X, None, lengthscale, sigma)
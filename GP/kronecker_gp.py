@@ -0,0 +1,169 @@
+# Copyright Lee Group 2019
+# Author: Ryan-Rhys Griffiths
+"""
+This module contains an exact GP for inputs on a Cartesian grid. The squared exponential kernel is a product over
+dimensions so on a grid x_1 x ... x x_d the covariance matrix is the Kronecker product K = sigma_f^2 K_1 (x) ... (x) K_d.
+With the eigendecompositions K_i = Q_i diag(lambda_i) Q_i^T of the small per-dimension matrices
+
+K + noise^2 I = Q diag(lambda + noise^2) Q^T,  Q = Q_1 (x) ... (x) Q_d,  lambda = sigma_f^2 lambda_1 (x) ... (x) lambda_d
+
+so solves, the log-determinant and predictions cost O(d N^(1 + 1/d)) for N grid points rather than O(N^3). The noise
+must be homoscedastic. Grid points are ordered as np.array(np.meshgrid(x_1, x_2)).T.reshape(-1, 2) with the first
+dimension varying slowest; see grid_points.
+"""
+
+import numpy as np
+from scipy.spatial.distance import cdist
+
+from kernels import scipy_kernel
+
+jitter = 1e-3  # matches the jitter in utils.nll_fn_grad and utils.posterior_predictive
+
+
+def grid_points(grid_axes):
+    """
+    :param grid_axes: list of d one-dimensional arrays of grid coordinates
+    :return: the grid points (N x d) in the order used by this module
+    """
+    return np.stack(np.meshgrid(*grid_axes, indexing='ij'), axis=-1).reshape(-1, len(grid_axes))
+
+
+def kron_mvprod(As, B):
+    """
+    Product (A_1 (x) ... (x) A_d) B without forming the Kronecker product.
+
+    :param As: list of d matrices, the ith of shape (p_i x n_i)
+    :param B: block of vectors (n_1 ... n_d x t)
+    :return: product (p_1 ... p_d x t)
+    """
+    t = B.shape[1]
+    X = B.reshape([A.shape[1] for A in As] + [t])
+
+    for i, A in enumerate(As):
+        X = np.moveaxis(np.tensordot(A, X, axes=([1], [i])), 0, i)
+
+    return X.reshape(-1, t)
+
+
+def kron_outer(vectors):
+    """
+    :param vectors: list of d vectors
+    :return: the Kronecker product of the vectors
+    """
+    out = np.ones(1)
+    for v in vectors:
+        out = np.outer(out, v).ravel()
+
+    return out
+
+
+def grid_eigendecompositions(grid_axes, l):
+    """
+    Eigendecompositions of the unit amplitude squared exponential covariance matrix of each grid dimension.
+
+    :param grid_axes: list of d one-dimensional arrays of grid coordinates
+    :param l: lengthscale(s). Either one shared by every dimension or one per dimension.
+    :return: list of per-dimension squared distance matrices, covariance matrices, eigenvalues and eigenvectors
+    """
+    l = np.array(l, dtype=np.float64).reshape(-1) * np.ones(len(grid_axes))
+    sq_dists = [cdist(x.reshape(-1, 1), x.reshape(-1, 1), 'sqeuclidean') for x in grid_axes]
+    Ks = [np.exp(-0.5 * sq_dist / l_i**2) for sq_dist, l_i in zip(sq_dists, l)]
+    eigs = [np.linalg.eigh(K) for K in Ks]
+
+    return sq_dists, Ks, [np.clip(eigvals, 0, None) for eigvals, _ in eigs], [eigvecs for _, eigvecs in eigs]
+
+
+def kron_nll_and_grad(grid_axes, Y_train, noise_var, l, sigma_f):
+    """
+    Negative log marginal likelihood of the grid GP and its gradient.
+
+    :param grid_axes: list of d one-dimensional arrays of grid coordinates
+    :param Y_train: training targets at the grid points (N x 1)
+    :param noise_var: homoscedastic noise variance
+    :param l: lengthscale(s). Either one shared by every dimension or one per dimension.
+    :param sigma_f: signal amplitude
+    :return: value of the negative log marginal likelihood, gradient with respect to [lengthscale(s), sigma_f] and the
+             derivative with respect to the noise variance
+    """
+    Y_train = np.reshape(Y_train, (-1, 1))
+    N, dim = len(Y_train), len(grid_axes)
+    l_dims = np.array(l, dtype=np.float64).reshape(-1) * np.ones(dim)
+
+    sq_dists, Ks, eigvals, eigvecs = grid_eigendecompositions(grid_axes, l_dims)
+    lam = sigma_f**2 * kron_outer(eigvals)
+    w = 1 / (lam + noise_var)
+    alpha = kron_mvprod(eigvecs, w.reshape(-1, 1) * kron_mvprod([Q.T for Q in eigvecs], Y_train))  # (K + noise^2 I)^-1 y
+
+    nll = 0.5 * Y_train.T.dot(alpha).item() + 0.5 * np.sum(np.log(lam + noise_var)) + 0.5 * N * np.log(2*np.pi)
+
+    # For a lengthscale, dK replaces K_i by dK_i in the Kronecker product, so tr((K + noise^2 I)^-1 dK) only needs the
+    # diagonals of Q_i^T dK_i Q_i.
+
+    grad_l = np.zeros(dim)
+    for i in range(dim):
+        dK_i = Ks[i] * sq_dists[i] / l_dims[i]**3
+        diags = [eigvals[j] if j != i else np.sum(eigvecs[i] * dK_i.dot(eigvecs[i]), axis=0) for j in range(dim)]
+        factors = [Ks[j] if j != i else dK_i for j in range(dim)]
+        grad_l[i] = 0.5 * (sigma_f**2 * np.sum(w * kron_outer(diags)) -
+                           sigma_f**2 * alpha.T.dot(kron_mvprod(factors, alpha)).item())
+    if np.size(l) == 1:  # a single lengthscale is shared by every dimension
+        grad_l = np.sum(grad_l, keepdims=True)
+
+    grad_sigma_f = (np.sum(w * lam) - alpha.T.dot(Y_train - noise_var * alpha).item()) / sigma_f  # K alpha = y - noise^2 alpha
+    grad_noise_var = 0.5 * (np.sum(w) - np.sum(alpha**2))
+
+    return nll, np.append(grad_l, grad_sigma_f), grad_noise_var
+
+
+def nll_fn_kron_grad(grid_axes, Y_train):
+    """
+    :param grid_axes: list of d one-dimensional arrays of grid coordinates
+    :param Y_train: training targets at the grid points
+    :return: optimisation step
+
+    Grid counterpart of utils.nll_fn_grad. The hyperparameter vector theta is [lengthscale(s), sigma_f, noise].
+    """
+
+    def step(theta):
+        nll, grad, grad_noise_var = kron_nll_and_grad(grid_axes, Y_train, theta[-1]**2 + jitter, theta[:-2], theta[-2])
+        return nll, np.append(grad, 2 * theta[-1] * grad_noise_var)
+    return step
+
+
+def kron_posterior_predictive(grid_axes, ys, xs_star, noise, l, sigma_f):
+    """
+    Compute the posterior predictive mean and marginal variance of the grid GP. If the test locations are themselves a
+    grid, given as a list of axes, the test covariances are Kronecker products too and the prediction never forms an
+    N* x N matrix.
+
+    :param grid_axes: list of d one-dimensional arrays of training grid coordinates
+    :param ys: training targets at the grid points (N x 1)
+    :param xs_star: test locations, either an array (N* x d) or a list of d one-dimensional arrays of grid coordinates
+    :param noise: homoscedastic noise level
+    :param l: lengthscale(s)
+    :param sigma_f: signal amplitude
+    :return: pred_mean (N* x 1), pred_var (N* x 1)
+    """
+    dim = len(grid_axes)
+    l_dims = np.array(l, dtype=np.float64).reshape(-1) * np.ones(dim)
+    _, _, eigvals, eigvecs = grid_eigendecompositions(grid_axes, l_dims)
+    w = 1 / (sigma_f**2 * kron_outer(eigvals) + noise**2)
+    Q_T_y = kron_mvprod([Q.T for Q in eigvecs], np.reshape(ys, (-1, 1)))
+
+    if isinstance(xs_star, (list, tuple)):
+
+        # K_s^T Q = sigma_f^2 (K_s1^T Q_1) (x) ... (x) (K_sd^T Q_d)
+
+        KsQs = [np.exp(-0.5 * cdist(x_s.reshape(-1, 1), x.reshape(-1, 1), 'sqeuclidean') / l_i**2).dot(Q)
+                for x_s, x, l_i, Q in zip(xs_star, grid_axes, l_dims, eigvecs)]
+        pred_mean = sigma_f**2 * kron_mvprod(KsQs, w.reshape(-1, 1) * Q_T_y)
+        pred_var = sigma_f**2 - sigma_f**4 * kron_mvprod([KsQ**2 for KsQ in KsQs], w.reshape(-1, 1))
+
+    else:
+
+        Ks = scipy_kernel(grid_points(grid_axes), xs_star, l_dims, sigma_f)  # (N x N*)
+        Q_T_Ks = kron_mvprod([Q.T for Q in eigvecs], Ks)
+        pred_mean = Q_T_Ks.T.dot(w.reshape(-1, 1) * Q_T_y)
+        pred_var = sigma_f**2 - np.sum(w.reshape(-1, 1) * Q_T_Ks**2, axis=0).reshape(-1, 1)
+
+    return pred_mean, pred_var + jitter
@@ -0,0 +1,194 @@
+# Copyright Lee Group 2019
+# Author: Ryan-Rhys Griffiths
+"""
+This module contains a random Fourier feature (sparse spectrum) approximation of the squared exponential kernel in
+kernels.scipy_kernel. The kernel is approximated as k(x, x') ~ phi(x)^T phi(x') with F features
+
+phi(x) = sigma_f sqrt(2/F) cos(W (x / l) + b),  W_ij ~ N(0, 1),  b_i ~ U(0, 2 pi)
+
+so that the GP becomes Bayesian linear regression on the features. Fitting, prediction and the negative log marginal
+likelihood then cost O(n F^2) rather than the O(n^3) of the exact Cholesky. The frequencies W and phases b are drawn
+once per fit and held fixed so that the objective is a smooth function of the hyperparameters.
+"""
+
+import numpy as np
+from scipy.linalg import cho_solve, cholesky, solve_triangular
+
+jitter = 1e-3  # matches the jitter added in utils.posterior_predictive and utils.nll_fn_grad
+
+
+def rff_frequencies(dim, num_features):
+    """
+    Draw the standard normal frequencies and uniform phases of the random features.
+
+    :param dim: input dimensionality d
+    :param num_features: number of features F
+    :return: frequencies W (F x d) and phases b (F, )
+    """
+    return np.random.randn(num_features, dim), np.random.uniform(0, 2*np.pi, num_features)
+
+
+def rff_features(X, l, sigma_f, W, b):
+    """
+    Random Fourier features of the squared exponential kernel.
+
+    :param X: Array of n points (n x d)
+    :param l: horizontal lengthscale(s)
+    :param sigma_f: vertical lengthscale
+    :param W: frequencies (F x d)
+    :param b: phases (F, )
+    :return: features (n x F)
+    """
+    l = np.array(l, dtype=np.float64).reshape(-1)
+    return sigma_f * np.sqrt(2 / len(b)) * np.cos((X / l) @ W.T + b)
+
+
+def rff_weight_posterior(Phi, ys, noise):
+    """
+    Posterior over the feature weights. With N the diagonal noise covariance the posterior precision is
+    A = Phi^T N^-1 Phi + I and the posterior mean is A^-1 Phi^T N^-1 y.
+
+    :param Phi: features of the training inputs (n x F)
+    :param ys: training targets (n x 1)
+    :param noise: noise variance. Either a scalar or a vector of per-point noise variances (n, )
+    :return: Cholesky factor of A (F x F) and the posterior mean of the weights (F x 1)
+    """
+    noise_inv = (1 / np.reshape(noise, (-1, 1))) * np.ones((len(Phi), 1))
+    L_A = cholesky(Phi.T @ (noise_inv * Phi) + np.eye(Phi.shape[1]), lower=True)
+    mean_w = cho_solve((L_A, True), Phi.T @ (noise_inv * np.reshape(ys, (-1, 1))))
+
+    return L_A, mean_w
+
+
+def rff_posterior_predictive(xs, ys, xs_star, noise, l, sigma_f, W, b, full_cov=True):
+    """
+    Compute the posterior predictive mean and variance of the random feature GP. Counterpart of
+    utils.posterior_predictive.
+
+    :param xs: training data input locations (n x d)
+    :param ys: training data targets (n x 1)
+    :param xs_star: test data input locations (n* x d)
+    :param noise: noise level. Either a scalar or a vector of per-point noise levels (n x 1)
+    :param l: kernel lengthscale(s)
+    :param sigma_f: signal amplitude
+    :param W: frequencies (F x d)
+    :param b: phases (F, )
+    :param full_cov: If True return the full predictive covariance matrix (n* x n*). If False return only the marginal
+                     variances (n* x 1).
+    :return: pred_mean, pred_var
+    """
+    L_A, mean_w = rff_weight_posterior(rff_features(xs, l, sigma_f, W, b), ys, np.square(noise))
+    Phi_star = rff_features(xs_star, l, sigma_f, W, b)
+    pred_mean = Phi_star @ mean_w
+    v = solve_triangular(L_A, Phi_star.T, lower=True)  # the predictive covariance is v^T v
+
+    if not full_cov:
+        return pred_mean, np.sum(np.square(v), axis=0).reshape(-1, 1) + jitter
+
+    return pred_mean, v.T @ v + jitter * np.eye(len(xs_star))
+
+
+def rff_posterior_samples(xs, ys, xs_star, noise, l, sigma_f, W, b, sample_size):
+    """
+    Draw samples of the latent function of the random feature GP at the test locations by sampling the weights. Costs
+    O(n* F s) and never forms the n* x n* predictive covariance.
+
+    :param xs: training data input locations (n x d)
+    :param ys: training data targets (n x 1)
+    :param xs_star: test data input locations (n* x d)
+    :param noise: noise level. Either a scalar or a vector of per-point noise levels (n x 1)
+    :param l: kernel lengthscale(s)
+    :param sigma_f: signal amplitude
+    :param W: frequencies (F x d)
+    :param b: phases (F, )
+    :param sample_size: number of samples s
+    :return: samples (n* x s)
+    """
+    L_A, mean_w = rff_weight_posterior(rff_features(xs, l, sigma_f, W, b), ys, np.square(noise))
+    weights = mean_w + solve_triangular(L_A.T, np.random.randn(len(b), sample_size), lower=False)  # A^-1 = L_A^-T L_A^-1
+
+    return rff_features(xs_star, l, sigma_f, W, b) @ weights
+
+
+def rff_nll_and_grad(X_train, Y_train, noise_var, l, sigma_f, W, b):
+    """
+    Negative log marginal likelihood of the random feature GP and its gradient. With K = Phi Phi^T + N the gradient with
+    respect to a hyperparameter theta is tr(G^T dPhi/dtheta) with G = (K^-1 - alpha alpha^T) Phi, and
+    K^-1 Phi = N^-1 Phi A^-1 so that no n x n matrix is formed.
+
+    :param X_train: training inputs locations (n x d)
+    :param Y_train: training targets (n x 1)
+    :param noise_var: noise variance. Either a scalar or a vector of per-point noise variances (n, )
+    :param l: horizontal lengthscale(s)
+    :param sigma_f: vertical lengthscale
+    :param W: frequencies (F x d)
+    :param b: phases (F, )
+    :return: value of the negative log marginal likelihood, gradient with respect to [lengthscale(s), sigma_f] and the
+             derivative with respect to the noise variance
+    """
+    Y_train = np.reshape(Y_train, (-1, 1))
+    n, dim = X_train.shape
+    l = np.array(l, dtype=np.float64).reshape(-1)
+    noise_inv = (1 / np.reshape(noise_var, (-1, 1))) * np.ones((n, 1))
+
+    Z = (X_train / l) @ W.T + b
+    scale = sigma_f * np.sqrt(2 / len(b))
+    Phi = scale * np.cos(Z)
+
+    L_A = cholesky(Phi.T @ (noise_inv * Phi) + np.eye(len(b)), lower=True)
+    mean_w = cho_solve((L_A, True), Phi.T @ (noise_inv * Y_train))
+    alpha = noise_inv * (Y_train - Phi @ mean_w)  # K^-1 y by the Woodbury identity
+
+    nll = 0.5 * Y_train.T.dot(alpha).item() + np.sum(np.log(np.diagonal(L_A))) - 0.5 * np.sum(np.log(noise_inv)) + \
+        0.5 * n * np.log(2*np.pi)
+
+    K_inv_Phi = noise_inv * cho_solve((L_A, True), Phi.T).T
+    G = K_inv_Phi - alpha @ (alpha.T @ Phi)
+
+    # dPhi/dl_k = scale sin(Z) x_k W_k / l_k^2 and dPhi/dsigma_f = Phi / sigma_f
+
+    grad_l = np.einsum('nk,nf,fk->k', X_train, G * scale * np.sin(Z), W) / (l * np.ones(dim))**2
+    if len(l) == 1:  # a single lengthscale is shared by every dimension
+        grad_l = np.sum(grad_l, keepdims=True)
+    grad_sigma_f = np.sum(G * Phi) / sigma_f
+
+    # d nll / d noise_var = 0.5 (tr(K^-1) - alpha^T alpha) for a scalar noise variance
+
+    grad_noise_var = 0.5 * (np.sum(noise_inv) - np.sum(noise_inv * Phi * K_inv_Phi) - np.sum(np.square(alpha)))
+
+    return nll, np.append(grad_l, grad_sigma_f), grad_noise_var
+
+
+def nll_fn_rff_grad(X_train, Y_train, W, b):
+    """
+    :param X_train: training inputs locations
+    :param Y_train: training targets
+    :param W: frequencies (F x d)
+    :param b: phases (F, )
+    :return: optimisation step
+
+    Random feature counterpart of utils.nll_fn_grad. The hyperparameter vector theta is [lengthscale(s), sigma_f, noise].
+    """
+
+    def step(theta):
+        nll, grad, grad_noise_var = rff_nll_and_grad(X_train, Y_train, theta[-1]**2 + jitter, theta[:-2], theta[-2], W, b)
+        return nll, np.append(grad, 2 * theta[-1] * grad_noise_var)
+    return step
+
+
+def nll_fn_het_rff_grad(X_train, Y_train, noise, W, b):
+    """
+    :param X_train: training inputs locations
+    :param Y_train: training targets
+    :param noise: fixed noise parameter of y_train. Either a scalar or a vector of per-point noise levels (n x 1).
+    :param W: frequencies (F x d)
+    :param b: phases (F, )
+    :return: optimisation step
+
+    Random feature counterpart of utils.nll_fn_het_grad. The hyperparameter vector theta is [lengthscale(s), sigma_f].
+    """
+
+    def step(theta):
+        nll, grad, _ = rff_nll_and_grad(X_train, Y_train, np.square(noise), theta[:-1], theta[-1], W, b)
+        return nll, grad
+    return step
@@ -0,0 +1,203 @@
+# Copyright Lee Group 2019
+# Author: Ryan-Rhys Griffiths
+"""
+This module contains an inducing point sparse GP for large datasets. With m inducing inputs Z the training covariance is
+approximated as Q_nn + Lambda where Q_nn = K_nu K_uu^-1 K_un and Lambda is diagonal:
+
+'vfe' (Titsias, 2009) Lambda = N and the bound has an additional trace penalty 0.5 tr(N^-1 (K_nn - Q_nn))
+'fitc' (Snelson and Ghahramani, 2006) Lambda = N + diag(K_nn - Q_nn)
+
+where N is the noise covariance, which may be heteroscedastic. Fitting and prediction cost O(n m^2) rather than O(n^3)
+and no n x n matrix is formed.
+"""
+
+import numpy as np
+from scipy.linalg import cho_solve, cholesky, solve_triangular
+from sklearn.cluster import KMeans
+
+from kernels import kernel_diag, scipy_kernel, scipy_kernel_with_grad
+
+jitter = 1e-6  # added to the diagonal of K_uu
+
+
+def kmeans_inducing(xs, num_inducing):
+    """
+    Choose inducing inputs as the k-means cluster centres of the training inputs.
+
+    :param xs: training input locations (n x d)
+    :param num_inducing: number of inducing inputs m
+    :return: inducing inputs (m x d)
+    """
+    km = KMeans(n_clusters=min(num_inducing, len(xs)), n_init=1, random_state=np.random.randint(2**31 - 1))
+
+    return km.fit(xs).cluster_centers_
+
+
+def pivoted_cholesky(xs, rank, l, sigma_f):
+    """
+    Partial pivoted Cholesky factorisation of the squared exponential covariance matrix K_nn. At each step the pivot is
+    the input whose prior variance is least explained by the pivots already chosen. Only the rows of K_nn at the pivots
+    are computed so the cost is O(n rank^2).
+
+    :param xs: input locations (n x d)
+    :param rank: maximum number of pivots
+    :param l: kernel lengthscale(s)
+    :param sigma_f: signal amplitude
+    :return: low-rank factor L (n x k) with K_nn ~ L L^T and the k <= rank pivot indices
+    """
+    rank = min(rank, len(xs))
+    residual_var = kernel_diag(xs, l, sigma_f).copy()
+    rows = np.zeros((rank, len(xs)))
+    pivots = []
+
+    for j in range(rank):
+        i = np.argmax(residual_var)
+        if residual_var[i] < 1e-12:  # the remaining inputs are already explained
+            break
+        pivots.append(i)
+        rows[j] = (scipy_kernel(xs[i:i + 1], xs, l, sigma_f).ravel() - rows[:j].T.dot(rows[:j, i])) / np.sqrt(residual_var[i])
+        residual_var -= rows[j]**2
+
+    return rows[:len(pivots)].T, pivots
+
+
+def greedy_variance_inducing(xs, num_inducing, l, sigma_f):
+    """
+    Choose inducing inputs from the training inputs by greedy variance reduction: each new inducing input is the
+    training input whose prior variance is least explained by those already chosen, i.e. the pivots of a partial
+    pivoted Cholesky factorisation of K_nn.
+
+    :param xs: training input locations (n x d)
+    :param num_inducing: number of inducing inputs m
+    :param l: kernel lengthscale(s)
+    :param sigma_f: signal amplitude
+    :return: inducing inputs (m x d)
+    """
+    _, pivots = pivoted_cholesky(xs, num_inducing, l, sigma_f)
+
+    return xs[pivots]
+
+
+def select_inducing(xs, num_inducing, method, l, sigma_f):
+    """
+    :param xs: training input locations (n x d)
+    :param num_inducing: number of inducing inputs m
+    :param method: 'kmeans' or 'greedy'. See kmeans_inducing and greedy_variance_inducing.
+    :param l: kernel lengthscale(s). Only used by 'greedy'.
+    :param sigma_f: signal amplitude. Only used by 'greedy'.
+    :return: inducing inputs (m x d)
+    """
+    if method == 'kmeans':
+        return kmeans_inducing(xs, num_inducing)
+    elif method == 'greedy':
+        return greedy_variance_inducing(xs, num_inducing, l, sigma_f)
+    raise ValueError('Unknown inducing point method: {}'.format(method))
+
+
+def sparse_nll_and_grad(X_train, Y_train, Z, noise_var, l, sigma_f, approximation='vfe'):
+    """
+    Negative log marginal likelihood (the negative of the collapsed bound for 'vfe') of the sparse GP and its gradient
+    with respect to the kernel hyperparameters. The inducing inputs and the noise are held fixed.
+
+    :param X_train: training inputs locations (n x d)
+    :param Y_train: training targets (n x 1)
+    :param Z: inducing inputs (m x d)
+    :param noise_var: noise variance. Either a scalar or a vector of per-point noise variances (n x 1)
+    :param l: horizontal lengthscale(s)
+    :param sigma_f: vertical lengthscale
+    :param approximation: 'vfe' or 'fitc'
+    :return: value of the objective and its gradient with respect to [lengthscale(s), sigma_f]
+    """
+    Y_train = np.reshape(Y_train, (-1, 1))
+    n, m = len(X_train), len(Z)
+    fitc = approximation == 'fitc'
+
+    K_uu, dK_uu = scipy_kernel_with_grad(Z, Z, l, sigma_f)
+    K_uf, dK_uf = scipy_kernel_with_grad(Z, X_train, l, sigma_f)
+    L_u = cholesky(K_uu + jitter * np.eye(m), lower=True)
+    V = solve_triangular(L_u, K_uf, lower=True)  # Q_nn = V^T V
+
+    noise_var = np.reshape(noise_var, -1) * np.ones(n)
+    k_diag = kernel_diag(X_train, l, sigma_f)
+    q_diag = np.sum(np.square(V), axis=0)
+    lam = noise_var + (k_diag - q_diag if fitc else 0)
+    lam_inv = (1 / lam).reshape(-1, 1)
+
+    L_B = cholesky(np.eye(m) + (V * lam_inv.T).dot(V.T), lower=True)  # B = I + V Lambda^-1 V^T
+    c = solve_triangular(L_B, V.dot(lam_inv * Y_train), lower=True)
+
+    nll = np.sum(np.log(np.diagonal(L_B))) + 0.5 * np.sum(np.log(lam)) + \
+        0.5 * (np.sum(lam_inv * Y_train**2) - np.sum(c**2)) + 0.5 * n * np.log(2*np.pi)
+    if not fitc:
+        nll += 0.5 * np.sum((k_diag - q_diag) / noise_var)
+
+    # With Sigma = Q_nn + Lambda and W = Sigma^-1 - alpha alpha^T the objective changes by
+    # 0.5 tr((W - diag(r)) dQ_nn) + 0.5 r . d diag(K_nn) where r = diag(W) for FITC and r = N^-1 for VFE.
+
+    alpha = lam_inv * (Y_train - V.T.dot(solve_triangular(L_B.T, c, lower=False)))  # Sigma^-1 y
+    if fitc:
+        LB_inv_V = solve_triangular(L_B, V, lower=True)
+        r = lam_inv.ravel() - lam_inv.ravel()**2 * np.sum(LB_inv_V**2, axis=0) - alpha.ravel()**2
+    else:
+        r = 1 / noise_var
+
+    P = solve_triangular(L_u.T, V, lower=False)  # K_uu^-1 K_uf
+    P_lam = P * lam_inv.T
+    H = P_lam - P_lam.dot(V.T).dot(cho_solve((L_B, True), V * lam_inv.T)) - P.dot(alpha).dot(alpha.T) - P * r  # P (W - diag(r))
+
+    grad = np.einsum('mn,pmn->p', H, dK_uf) - 0.5 * np.einsum('mk,pmk->p', H.dot(P.T), dK_uu)
+    grad[-1] += np.sum(r) * sigma_f  # d diag(K_nn) / d sigma_f = 2 sigma_f and the lengthscales don't affect it
+
+    return nll, grad
+
+
+def nll_fn_het_sparse_grad(X_train, Y_train, noise, Z, approximation='vfe'):
+    """
+    :param X_train: training inputs locations
+    :param Y_train: training targets
+    :param noise: fixed noise parameter of y_train. Either a scalar or a vector of per-point noise levels (n x 1).
+    :param Z: inducing inputs (m x d)
+    :param approximation: 'vfe' or 'fitc'
+    :return: optimisation step
+
+    Sparse counterpart of utils.nll_fn_het_grad. The hyperparameter vector theta is [lengthscale(s), sigma_f].
+    """
+
+    def step(theta):
+        return sparse_nll_and_grad(X_train, Y_train, Z, np.square(noise), theta[:-1], theta[-1], approximation)
+    return step
+
+
+def sparse_posterior_predictive(xs, ys, xs_star, Z, noise, l, sigma_f, approximation='vfe'):
+    """
+    Compute the posterior predictive mean and marginal variance of the sparse GP. The n* x n* predictive covariance is
+    not available.
+
+    :param xs: training data input locations (n x d)
+    :param ys: training data targets (n x 1)
+    :param xs_star: test data input locations (n* x d)
+    :param Z: inducing inputs (m x d)
+    :param noise: noise level. Either a scalar or a vector of per-point noise levels (n x 1)
+    :param l: kernel lengthscale(s)
+    :param sigma_f: signal amplitude
+    :param approximation: 'vfe' or 'fitc'
+    :return: pred_mean (n* x 1), pred_var (n* x 1)
+    """
+    m = len(Z)
+    L_u = cholesky(scipy_kernel(Z, Z, l, sigma_f) + jitter * np.eye(m), lower=True)
+    V = solve_triangular(L_u, scipy_kernel(Z, xs, l, sigma_f), lower=True)
+
+    lam = np.square(np.reshape(noise, -1)) * np.ones(len(xs))
+    if approximation == 'fitc':
+        lam += kernel_diag(xs, l, sigma_f) - np.sum(np.square(V), axis=0)
+    lam_inv = (1 / lam).reshape(-1, 1)
+
+    L_B = cholesky(np.eye(m) + (V * lam_inv.T).dot(V.T), lower=True)
+    c = solve_triangular(L_B, V.dot(lam_inv * np.reshape(ys, (-1, 1))), lower=True)
+
+    V_star = solve_triangular(L_u, scipy_kernel(Z, xs_star, l, sigma_f), lower=True)
+    W_star = solve_triangular(L_B, V_star, lower=True)
+    pred_mean = W_star.T.dot(c)
+    pred_var = kernel_diag(xs_star, l, sigma_f) - np.sum(np.square(V_star), axis=0) + np.sum(np.square(W_star), axis=0)
+
+    return pred_mean, pred_var.reshape(-1, 1) + 1e-3  # matches the jitter in utils.posterior_predictive
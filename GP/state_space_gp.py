@@ -0,0 +1,203 @@
+# Copyright Lee Group 2019
+# Author: Ryan-Rhys Griffiths
+"""
+This module contains a state space GP for one-dimensional inputs. A GP with a Matern 3/2 or 5/2 kernel is the solution
+of a linear stochastic differential equation df(x) = F f(x) dx + L dW with a 2 or 3 dimensional state whose first
+element is the function value (Hartikainen and Sarkka, 2010). Sorted by input, the GP is then a linear Gaussian state
+space model and the Kalman filter computes the negative log marginal likelihood, and the Rauch-Tung-Striebel smoother
+the predictions, in O(n) time. The observation noise may be different at every point.
+"""
+
+from math import factorial
+
+import numpy as np
+
+jitter = 1e-3  # matches the jitter added to the predictive variance in utils.posterior_predictive
+
+
+def matern_state_space(l, sigma_f, nu):
+    """
+    State space form of the Matern kernel together with the derivatives with respect to the hyperparameters.
+
+    :param l: lengthscale
+    :param sigma_f: signal amplitude
+    :param nu: smoothness, 1.5 or 2.5
+    :return: decay rate lambda = sqrt(2 nu) / l, feedback matrix F, stationary covariance P_inf and the derivatives
+             dF (2 x D x D) and dP_inf (2 x D x D) with respect to [l, sigma_f]
+    """
+    lam = np.sqrt(2 * nu) / l
+    dlam = -lam / l
+
+    if nu == 1.5:
+        F = np.array([[0, 1], [-lam**2, -2 * lam]])
+        dF_dlam = np.array([[0, 0], [-2 * lam, -2]])
+        P_inf = np.diag([sigma_f**2, lam**2 * sigma_f**2])
+        dP_inf_dlam = np.diag([0, 2 * lam * sigma_f**2])
+    elif nu == 2.5:
+        kappa = lam**2 * sigma_f**2 / 3
+        F = np.array([[0, 1, 0], [0, 0, 1], [-lam**3, -3 * lam**2, -3 * lam]])
+        dF_dlam = np.array([[0, 0, 0], [0, 0, 0], [-3 * lam**2, -6 * lam, -3]])
+        P_inf = np.array([[sigma_f**2, 0, -kappa], [0, kappa, 0], [-kappa, 0, lam**4 * sigma_f**2]])
+        dkappa = 2 * lam * sigma_f**2 / 3
+        dP_inf_dlam = np.array([[0, 0, -dkappa], [0, dkappa, 0], [-dkappa, 0, 4 * lam**3 * sigma_f**2]])
+    else:
+        raise ValueError('Only nu = 1.5 and nu = 2.5 are supported')
+
+    dF = np.stack((dF_dlam * dlam, np.zeros_like(F)))
+    dP_inf = np.stack((dP_inf_dlam * dlam, 2 * P_inf / sigma_f))
+
+    return lam, F, P_inf, dF, dP_inf
+
+
+def transitions(lam, F, dF, deltas):
+    """
+    Transition matrices A_k = expm(F delta_k) and their derivatives for every input spacing at once. F + lambda I is
+    nilpotent for the Matern kernels, and so is the block matrix [[F, dF], [0, F]] + lambda I whose exponential holds
+    the derivative of expm(F delta) in its upper right block, so the exponential series terminates.
+
+    :param lam: decay rate
+    :param F: feedback matrix (D x D)
+    :param dF: derivatives of F with respect to each hyperparameter (p x D x D)
+    :param deltas: input spacings (n, )
+    :return: transition matrices (n x D x D) and their derivatives (p x n x D x D)
+    """
+    D = len(F)
+    A, dA = None, []
+
+    for dF_i in dF:
+        N = np.block([[F, dF_i], [np.zeros((D, D)), F]]) + lam * np.eye(2 * D)
+        powers = [np.linalg.matrix_power(N, k) / factorial(k) for k in range(2 * D)]
+        coeffs = np.exp(-lam * deltas)[:, np.newaxis] * deltas[:, np.newaxis]**np.arange(2 * D)
+        block = np.einsum('nk,kij->nij', coeffs, np.array(powers))
+        A = block[:, :D, :D]
+        dA.append(block[:, :D, D:])
+
+    return A, np.array(dA)
+
+
+def state_space_nll_and_grad(X_train, Y_train, noise_var, l, sigma_f, nu=1.5):
+    """
+    Negative log marginal likelihood of the state space GP by Kalman filtering, and its gradient with respect to
+    [l, sigma_f] by propagating the derivatives of the filtering mean and covariance alongside the filter.
+
+    :param X_train: training inputs locations (n x 1)
+    :param Y_train: training targets (n x 1)
+    :param noise_var: noise variance. Either a scalar or a vector of per-point noise variances (n x 1)
+    :param l: lengthscale
+    :param sigma_f: signal amplitude
+    :param nu: smoothness, 1.5 or 2.5
+    :return: value of the negative log marginal likelihood and its gradient (2, )
+    """
+    order = np.argsort(np.ravel(X_train), kind='stable')
+    xs = np.ravel(X_train)[order]
+    ys = np.ravel(Y_train)[order]
+    rs = (np.ravel(noise_var) * np.ones(len(xs)))[order]
+
+    lam, F, P_inf, dF, dP_inf = matern_state_space(np.ravel(l)[0], sigma_f, nu)
+    A, dA = transitions(lam, F, dF, np.diff(xs, prepend=xs[0]))
+    Q = P_inf - A @ P_inf @ A.transpose(0, 2, 1)
+    dQ = dP_inf[:, np.newaxis] - dA @ P_inf @ A.transpose(0, 2, 1) - A @ dP_inf[:, np.newaxis] @ A.transpose(0, 2, 1) - \
+        A @ P_inf @ dA.transpose(0, 1, 3, 2)
+
+    m, P = np.zeros(len(F)), P_inf
+    dm, dP = np.zeros((2, len(F))), dP_inf
+    nll, grad = 0.5 * len(xs) * np.log(2*np.pi), np.zeros(2)
+
+    for k in range(len(xs)):
+
+        # predict
+
+        dm = dA[:, k] @ m + dm @ A[k].T
+        dP = dA[:, k] @ P @ A[k].T + A[k] @ dP @ A[k].T + A[k] @ P @ dA[:, k].transpose(0, 2, 1) + dQ[:, k]
+        m = A[k] @ m
+        P = A[k] @ P @ A[k].T + Q[k]
+
+        # update with the observation of the first state element
+
+        v = ys[k] - m[0]
+        S = P[0, 0] + rs[k]
+        K = P[:, 0] / S
+        dv = -dm[:, 0]
+        dS = dP[:, 0, 0]
+        dK = (dP[:, :, 0] - np.outer(dS, K)) / S
+
+        nll += 0.5 * (np.log(S) + v**2 / S)
+        grad += 0.5 * (dS / S + 2 * v * dv / S - v**2 * dS / S**2)
+
+        dm = dm + dK * v + np.outer(dv, K)
+        dP = dP - S * (dK[:, :, np.newaxis] * K + K[:, np.newaxis] * dK[:, np.newaxis, :]) - dS[:, np.newaxis, np.newaxis] * np.outer(K, K)
+        m = m + K * v
+        P = P - S * np.outer(K, K)
+
+    return nll, grad
+
+
+def nll_fn_het_state_space_grad(X_train, Y_train, noise, nu=1.5):
+    """
+    :param X_train: training inputs locations (n x 1)
+    :param Y_train: training targets
+    :param noise: fixed noise parameter of y_train. Either a scalar or a vector of per-point noise levels (n x 1).
+    :param nu: Matern smoothness, 1.5 or 2.5
+    :return: optimisation step
+
+    State space counterpart of utils.nll_fn_het_grad for one-dimensional inputs and a Matern kernel. The
+    hyperparameter vector theta is [lengthscale, sigma_f].
+    """
+
+    def step(theta):
+        return state_space_nll_and_grad(X_train, Y_train, np.square(noise), theta[0], theta[1], nu)
+    return step
+
+
+def state_space_posterior_predictive(xs, ys, xs_star, noise, l, sigma_f, nu=1.5):
+    """
+    Compute the posterior predictive mean and marginal variance of the state space GP. The training and test inputs are
+    merged into a single sorted sequence, filtered with updates only at the training inputs and smoothed.
+
+    :param xs: training data input locations (n x 1)
+    :param ys: training data targets (n x 1)
+    :param xs_star: test data input locations (n* x 1)
+    :param noise: noise level. Either a scalar or a vector of per-point noise levels (n x 1)
+    :param l: lengthscale
+    :param sigma_f: signal amplitude
+    :param nu: smoothness, 1.5 or 2.5
+    :return: pred_mean (n* x 1), pred_var (n* x 1)
+    """
+    n, n_star = len(xs), len(xs_star)
+    x_all = np.concatenate((np.ravel(xs), np.ravel(xs_star)))
+    order = np.argsort(x_all, kind='stable')  # a test input that coincides with a training input comes after it
+    x_all = x_all[order]
+    observed = order < n
+    y_all = np.concatenate((np.ravel(ys), np.zeros(n_star)))[order]
+    r_all = np.concatenate((np.ravel(np.square(noise)) * np.ones(n), np.zeros(n_star)))[order]
+
+    lam, F, P_inf, dF, _ = matern_state_space(np.ravel(l)[0], sigma_f, nu)
+    A, _ = transitions(lam, F, dF[:1], np.diff(x_all, prepend=x_all[0]))
+    Q = P_inf - A @ P_inf @ A.transpose(0, 2, 1)
+
+    N, D = len(x_all), len(F)
+    m_pred, P_pred = np.zeros((N, D)), np.zeros((N, D, D))
+    m_filt, P_filt = np.zeros((N, D)), np.zeros((N, D, D))
+    m, P = np.zeros(D), P_inf
+
+    for k in range(N):
+        m = A[k] @ m
+        P = A[k] @ P @ A[k].T + Q[k]
+        m_pred[k], P_pred[k] = m, P
+        if observed[k]:
+            S = P[0, 0] + r_all[k]
+            K = P[:, 0] / S
+            m = m + K * (y_all[k] - m[0])
+            P = P - S * np.outer(K, K)
+        m_filt[k], P_filt[k] = m, P
+
+    for k in range(N - 2, -1, -1):
+        G = np.linalg.solve(P_pred[k + 1], A[k + 1] @ P_filt[k]).T  # P_filt A^T P_pred^-1
+        m = m_filt[k] + G @ (m - m_pred[k + 1])
+        P = P_filt[k] + G @ (P - P_pred[k + 1]) @ G.T
+        m_filt[k], P_filt[k] = m, P
+
+    star = np.empty(n_star, dtype=int)
+    star[order[~observed] - n] = np.flatnonzero(~observed)  # position of each test input in the merged sequence
+
+    return m_filt[star, :1], P_filt[star, 0, :1] + jitter
@@ -4,18 +4,36 @@
 Tests for the GP prior module.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+import pickle
+
 from matplotlib import pyplot as plt
 import numpy as np
 import pytest
-from scipy.optimize import minimize
+from scipy.optimize import approx_fprime, minimize
 
+import acquisition_functions
+import gp_fitting
+from bo_gp_fit_predict import HeteroscedasticGPState, HomoscedasticGPState, bo_fit_hetero_gp, bo_hetero_posterior
+from bo_scheduler import async_bayesian_optimisation
 from datasets import williams_1996
+from gp_multistart import multistart_minimise_nll, screen_starts
+from iterative_gp import kernel_matvec, nll_fn_het_cg_grad
+from kronecker_gp import grid_points, kron_posterior_predictive, nll_fn_kron_grad
+from gp_posterior import GPPosterior, HeteroscedasticGPPosterior, SparseGPPosterior
 from gp_prior import compute_confidence_bounds
-from kernels import anisotropic_kernel, compute_kernel_matrix_sq_exp, kernel, sq_exp, scipy_kernel
+from kernel_cache import KernelCache, kernel_cache
+from kernels import anisotropic_kernel, compute_kernel_matrix_sq_exp, kernel, matern_kernel, sq_exp, scipy_kernel, \
+    scipy_kernel_with_grad, sq_exp_kernel_matrix, SqDistCache
 from mean_functions import zero_mean
 from objective_functions import branin_function, heteroscedastic_branin
+from rff import nll_fn_rff_grad, rff_frequencies, rff_posterior_predictive
+from sparse_gp import kmeans_inducing, nll_fn_het_sparse_grad, sparse_posterior_predictive
+from state_space_gp import nll_fn_het_state_space_grad, state_space_posterior_predictive
 from utils import multivariate_normal, mvn_sample, neg_log_marg_lik_krasser, \
-    posterior_predictive_krasser, nll_fn, neg_log_marg_lik, my_nll_fn, posterior_predictive, nlpd
+    posterior_predictive_krasser, nll_fn, neg_log_marg_lik, my_nll_fn, posterior_predictive, nlpd, nll_fn_het, \
+    nll_fn_grad, nll_fn_het_grad, most_likely_variance_estimator, nll_fn_batch, nll_fn_het_batch, \
+    posterior_predictive_chunks, nll_workspace
 
 
 def test_mvn_sampler():
@@ -115,6 +133,63 @@ def test_compute_kernel_matrix_sq_exp_against_krasser(inputs, signal_amp, length
     assert np.allclose(krasser_kernel, kernel_matrix)
 
 
+def test_sq_exp_kernel_matrix_symmetric_mode():
+    """
+    Tests that the symmetric mode of the vectorised kernel builder is exactly symmetric with the signal variance on the
+    diagonal and agrees with the anisotropic kernel and with the cross-covariance mode, including for distant inputs
+    where the squared distance expansion loses precision.
+    """
+    np.random.seed(22)
+    X = 1e4 * np.random.randn(40, 3)
+    l = [1e4, 2e4, 3e4]
+    K = sq_exp_kernel_matrix(X, None, l, 1.5)
+    assert np.array_equal(K, K.T)
+    assert np.all(np.diag(K) == 1.5**2)
+    assert np.allclose(K, sq_exp_kernel_matrix(X, X, l, 1.5))
+    assert np.allclose(K, anisotropic_kernel(X, X, l, 1.5))
+    assert np.all(anisotropic_kernel(X, X, l, 1.5) <= 1.5**2)
+
+
+
+@pytest.mark.parametrize("l", [1.3, [1.3, 0.7]])
+def test_sq_dist_cache_against_scipy_kernel(l):
+    """
+    Tests that the squared distance cache reproduces scipy_kernel and the fused het objective for cached
+    inputs in either order, and falls back to scipy_kernel for inputs it doesn't hold and for the test-test block, and
+    that the fused het objective fills the cache on its first evaluation and reuses it after that, also once the cache
+    has been pickled together with its inputs.
+    """
+    np.random.seed(23)
+    xs = np.random.randn(30, 2)
+    xs_star = np.random.randn(10, 2)
+    ys = np.random.randn(30, 1)
+    cache = SqDistCache(xs, xs_star)
+
+    assert np.allclose(cache(xs, xs_star, l, 1.2), scipy_kernel(xs, xs_star, l, 1.2))
+    assert np.allclose(cache(xs_star, xs, l, 1.2), scipy_kernel(xs_star, xs, l, 1.2))
+    assert np.allclose(cache(xs[:5], xs_star, l, 1.2), scipy_kernel(xs[:5], xs_star, l, 1.2))
+    assert np.allclose(cache(xs_star, xs_star, l, 1.2), scipy_kernel(xs_star, xs_star, l, 1.2))
+    assert cache.sq_diffs(xs_star, xs_star) is None and cache.sq_diffs(xs.copy(), xs) is None
+
+    theta = np.append(l, 1.2)
+    cache = SqDistCache(xs)
+    objective = nll_fn_het_grad(xs, ys, 0.3, cache)
+    nll, grad = objective(theta)
+    assert ('train', 'train') in cache._sq_diffs  # filled by the first evaluation
+    sq_diffs = cache._sq_diffs[('train', 'train')]
+    objective(2 * theta)
+    assert cache._sq_diffs[('train', 'train')] is sq_diffs and len(cache._sq_diffs) == 1  # and reused afterwards
+
+    worker_xs, worker_ys, worker_cache = pickle.loads(pickle.dumps((xs, ys, cache)))  # as sent to a worker process
+    assert not worker_cache._sq_diffs
+    assert np.isclose(nll_fn_het_grad(worker_xs, worker_ys, 0.3, worker_cache)(theta)[0], nll)
+    assert ('train', 'train') in worker_cache._sq_diffs
+
+    reference_nll, reference_grad = nll_fn_het_grad(xs, ys, 0.3)(theta)
+    assert np.isclose(nll, reference_nll)
+    assert np.allclose(grad, reference_grad)
+
+
 @pytest.mark.parametrize("xs, xs_star, noise, l, sigma_f, mean_func, kernel_func, fplot", [
     (np.arange(-3, 4, 1).reshape(-1, 1), np.arange(-5, 5, 0.2).reshape(50,1), 0.2, 1, 1, zero_mean, anisotropic_kernel, False),
     (np.arange(-3, 4, 1).reshape(-1, 1), np.arange(-5, 5, 0.2).reshape(50,1),  0.2, 0.3, 1, zero_mean, anisotropic_kernel, False),
@@ -372,3 +447,718 @@ def test_heteroscedastic_branin():
         plt.show()
 
     assert y.shape == y_het.shape
+
+
+@pytest.mark.parametrize("theta, noise", [
+    ([1.0, 1.5], 0.2),
+    ([0.7, 2.0, 1.2], 0.4),
+    ([0.7, 2.0, 1.2], np.linspace(0.1, 0.5, 20).reshape(-1, 1))
+])
+def test_nll_fn_het_grad_against_finite_differences(theta, noise):
+    """
+    Tests that the fused objective returns the same value as nll_fn_het and a gradient that agrees with finite
+    differences, including when the noise is a per-point vector.
+    """
+    np.random.seed(1)
+    xs = np.random.uniform(-3, 3, size=(20, len(theta) - 1))
+    y = np.sin(xs[:, 0:1]) + 0.2 * np.random.randn(20, 1)
+
+    value, grad = nll_fn_het_grad(xs, y, noise)(np.array(theta))
+    numerical_grad = approx_fprime(np.array(theta), lambda t: nll_fn_het_grad(xs, y, noise)(t)[0], 1e-6)
+
+    assert np.allclose(value, nll_fn_het(xs, y, noise)(np.array(theta)))
+    assert np.allclose(grad, numerical_grad, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("theta", [
+    [1.0, 1.5, 0.3],
+    [0.7, 2.0, 1.2, 0.5]
+])
+def test_nll_fn_grad_against_finite_differences(theta):
+    """
+    Tests that the fused objective with a learned noise level matches nll_fn and finite differences.
+    """
+    np.random.seed(2)
+    xs = np.random.uniform(-3, 3, size=(15, len(theta) - 2))
+    y = np.sin(xs[:, 0:1]) + 0.2 * np.random.randn(15, 1)
+
+    value, grad = nll_fn_grad(xs, y)(np.array(theta))
+    numerical_grad = approx_fprime(np.array(theta), lambda t: nll_fn_grad(xs, y)(t)[0], 1e-6)
+
+    assert np.allclose(value, nll_fn(xs, y)(np.array(theta)))
+    assert np.allclose(grad, numerical_grad, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("noise, l, sigma_f", [
+    (0.2, [1.0, 2.0], 1.5),
+    (np.linspace(0.1, 0.5, 12).reshape(-1, 1), [0.5, 1.0], 2.0)
+])
+def test_gp_posterior_against_posterior_predictive(noise, l, sigma_f):
+    """
+    Tests that the cached GP posterior gives the same predictions as utils.posterior_predictive.
+    """
+    np.random.seed(3)
+    xs = np.random.uniform(-3, 3, size=(12, 2))
+    y = np.sin(xs[:, 0:1]) + 0.2 * np.random.randn(12, 1)
+    xs_star = np.random.uniform(-3, 3, size=(7, 2))
+
+    pred_mean, pred_var, _, _ = posterior_predictive(xs, y, xs_star, noise, l, sigma_f, zero_mean, scipy_kernel)
+    posterior = GPPosterior(xs, y, noise, l, sigma_f, zero_mean, scipy_kernel)
+    cached_pred_mean, cached_pred_var = posterior.predict(xs_star)
+
+    assert np.allclose(pred_mean, cached_pred_mean)
+    assert np.allclose(pred_var, cached_pred_var)
+
+
+@pytest.mark.parametrize("kernel_func", [anisotropic_kernel, scipy_kernel])
+def test_marginal_variance_matches_full_covariance(kernel_func):
+    """
+    Tests that the marginal variance path of the posterior predictive equals the diagonal of the full covariance.
+    """
+    np.random.seed(4)
+    xs = np.random.uniform(-3, 3, size=(10, 2))
+    y = np.sin(xs[:, 0:1]) + 0.2 * np.random.randn(10, 1)
+    xs_star = np.random.uniform(-3, 3, size=(25, 2))
+
+    pred_mean, pred_var, _, _ = posterior_predictive(xs, y, xs_star, 0.2, [1.0, 0.7], 1.3, zero_mean, kernel_func)
+    diag_pred_mean, diag_pred_var, _, _ = posterior_predictive(xs, y, xs_star, 0.2, [1.0, 0.7], 1.3, zero_mean,
+                                                               kernel_func, full_cov=False)
+    posterior = GPPosterior(xs, y, 0.2, [1.0, 0.7], 1.3, zero_mean, kernel_func)
+    _, cached_diag_pred_var = posterior.predict(xs_star, full_cov=False)
+
+    assert diag_pred_var.shape == diag_pred_mean.shape
+    assert np.allclose(pred_mean, diag_pred_mean)
+    assert np.allclose(np.diag(pred_var).reshape(-1, 1), diag_pred_var)
+    assert np.allclose(np.diag(pred_var).reshape(-1, 1), cached_diag_pred_var)
+
+
+@pytest.mark.parametrize("estimator", ['sample', 'cholesky'])
+def test_variance_estimator_against_exact(estimator):
+    """
+    Tests that the sampled most likely heteroscedastic GP variance estimators converge to the closed form expectation.
+    """
+    np.random.seed(5)
+    xs = np.linspace(-3, 3, 8).reshape(-1, 1)
+    ys = np.sin(xs) + 0.3 * np.random.randn(8, 1)
+    pred_mean, pred_var, _, _ = posterior_predictive(xs, ys, xs, 0.3, 1.0, 1.0, zero_mean, scipy_kernel)
+
+    exact = most_likely_variance_estimator(ys, pred_mean, pred_var, 0, estimator='exact')
+    sampled = most_likely_variance_estimator(ys, pred_mean, pred_var, 20000, estimator=estimator)
+
+    assert sampled.shape == exact.shape == (8,)
+    assert np.allclose(sampled, exact, rtol=0.1, atol=1e-3)
+
+
+@pytest.mark.parametrize("noise, noise_new", [
+    (0.2, None),
+    (np.linspace(0.1, 0.5, 10).reshape(-1, 1), np.array([[0.3], [0.4], [0.2]]))
+])
+def test_gp_posterior_append_against_refactorisation(noise, noise_new):
+    """
+    Tests that extending the Cholesky factor with new observations gives the same posterior as refactorising.
+    """
+    np.random.seed(6)
+    xs = np.random.uniform(-3, 3, size=(13, 2))
+    y = np.sin(xs[:, 0:1]) + 0.2 * np.random.randn(13, 1)
+    xs_star = np.random.uniform(-3, 3, size=(5, 2))
+    full_noise = noise if noise_new is None else np.vstack((noise, noise_new))
+
+    posterior = GPPosterior(xs[:10], y[:10], noise, [1.0, 0.7], 1.3)
+    posterior.append(xs[10:], y[10:], noise_new)
+    refactorised = GPPosterior(xs, y, full_noise, [1.0, 0.7], 1.3)
+
+    assert np.allclose(posterior.L, refactorised.L)
+    assert np.allclose(posterior.predict(xs_star)[0], refactorised.predict(xs_star)[0])
+    assert np.allclose(posterior.predict(xs_star)[1], refactorised.predict(xs_star)[1])
+
+
+def test_heteroscedastic_state_warm_start():
+    """
+    Tests that the cold fit of HeteroscedasticGPState matches bo_fit_hetero_gp and that adding observations extends
+    the noise function to the new points.
+    """
+    np.random.seed(7)
+    xs = np.random.uniform(0, 10, size=(20, 1))
+    ys = np.sin(xs) + (0.1 + 0.03 * xs) * np.random.randn(20, 1)
+    plot_sample = np.linspace(0, 10, 50).reshape(-1, 1)
+
+    noise, _, gp1_l_opt, gp1_sigma_f_opt, _, _, _ = bo_fit_hetero_gp(xs, ys, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 3, 0,
+                                                                     plot_sample, estimator='exact')
+    state = HeteroscedasticGPState(xs, ys, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 3, 0, plot_sample, num_warm_iters=1,
+                                   estimator='exact')
+
+    assert np.allclose(state.noise, noise)
+    assert np.allclose(state.gp1_hypers, list(gp1_l_opt.ravel()) + [gp1_sigma_f_opt])
+
+    X_next = np.array([[5.0], [7.5]])
+    state.add_observations(X_next, np.sin(X_next))
+
+    assert state.noise.shape == (22, 1)
+    assert state.X_sample.shape == (22, 1) and state.Y_sample.shape == (22, 1)
+    assert np.all(np.isfinite(state.noise)) and np.all(state.noise > 0)
+
+
+@pytest.mark.parametrize("noise_tol, nlml_tol, expected_iters", [
+    (None, None, 5),
+    (np.inf, None, 2),
+    (None, np.inf, 2),
+])
+def test_hetero_gp_early_stopping(noise_tol, nlml_tol, expected_iters, monkeypatch):
+    """
+    Tests that the most likely heteroscedastic GP algorithm stops once either convergence criterion is met and reports
+    the number of iterations run, in both the BO and the benchmark implementations, and that the benchmark
+    implementation plots the final iteration once however many iterations were run.
+    """
+    np.random.seed(8)
+    xs = np.random.uniform(0, 10, size=(20, 1))
+    ys = np.sin(xs) + (0.1 + 0.03 * xs) * np.random.randn(20, 1)
+
+    result = bo_fit_hetero_gp(xs, ys, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 5, 0, None, estimator='exact', noise_tol=noise_tol,
+                              nlml_tol=nlml_tol, return_info=True)
+    info = result[-1]
+
+    assert len(result) == 8
+    assert info['num_iters'] == expected_iters
+    assert np.isfinite(info['noise_delta']) and np.isfinite(info['nlml_delta'])
+
+    shown = []
+    monkeypatch.setattr(gp_fitting.plt, 'show', lambda: shown.append(plt.close()))
+    info = gp_fitting.fit_hetero_gp(xs, ys, 1.0, xs, 1.0, 1.0, 1.0, 1.0, 1.0, 5, 0, estimator='exact',
+                                    noise_tol=noise_tol, nlml_tol=nlml_tol, return_info=True)[-1]
+
+    assert info['num_iters'] == expected_iters
+    assert len(shown) == 1
+
+
+def test_multistart_minimise_nll():
+    """
+    Tests that the parallel multi-start optimiser returns the best of its restarts and that the first restart matches a
+    single start from the initial hyperparameters.
+    """
+    np.random.seed(9)
+    xs = np.random.uniform(-3, 3, size=(15, 2))
+    ys = np.sin(xs[:, 0:1]) * np.cos(xs[:, 1:2]) + 0.1 * np.random.randn(15, 1)
+    x0 = [1.0, 1.0, 1.0, 0.5]
+    bounds = [(1e-2, 900)]*4
+
+    best, table = multistart_minimise_nll(nll_fn_grad, (xs, ys), x0, bounds, n_restarts=4)
+    single = minimize(nll_fn_grad(xs, ys), x0, bounds=bounds, method='L-BFGS-B', jac=True)
+
+    assert len(table) == 4
+    assert np.allclose(table[0]['x0'], x0)
+    assert np.allclose(table[0]['x'], single.x)
+    assert best['fun'] == min(row['fun'] for row in table)
+    assert best['fun'] <= single.fun + 1e-8
+
+
+@pytest.mark.parametrize("noise", [0.3, np.linspace(0.1, 0.5, 12).reshape(-1, 1)])
+def test_batched_nll_against_nll_fn(noise):
+    """
+    Tests the batched negative log marginal likelihoods used for screening against the unbatched objectives.
+    """
+    np.random.seed(10)
+    xs = np.random.uniform(-3, 3, size=(12, 2))
+    ys = np.sin(xs[:, 0:1]) + 0.2 * np.random.randn(12, 1)
+    thetas = np.random.uniform(0.2, 3, size=(6, 4))
+
+    assert np.allclose(nll_fn_batch(xs, ys)(thetas), [nll_fn(xs, ys)(theta).item() for theta in thetas])
+    assert np.allclose(nll_fn_het_batch(xs, ys, noise)(thetas[:, :3]),
+                       [nll_fn_het(xs, ys, noise)(theta).item() for theta in thetas[:, :3]])
+
+    top = screen_starts(nll_fn_het_batch(xs, ys, noise), thetas[0, :3], [(0.1, 900)]*3, 100, 5, batch_size=16)
+    scores = nll_fn_het_batch(xs, ys, noise)(top)
+
+    assert top.shape == (5, 3)
+    assert np.all(np.diff(scores) >= 0)
+    assert scores[0] <= nll_fn_het(xs, ys, noise)(thetas[0, :3]).item()
+
+
+@pytest.mark.parametrize("acquisition, heteroscedastic", [
+    ('my_expected_improvement', False),
+    ('augmented_expected_improvement', False),
+    ('augmented_one_off_expected_improvement', False),
+    ('heteroscedastic_expected_improvement', True),
+    ('heteroscedastic_one_off_expected_improvement', True),
+    ('heteroscedastic_augmented_expected_improvement', True),
+    ('heteroscedastic_one_off_augmented_expected_improvement', True),
+])
+def test_acquisition_grad_against_finite_differences(acquisition, heteroscedastic):
+    """
+    Tests the analytic gradients of the acquisition functions with respect to the test locations.
+    """
+    np.random.seed(11)
+    xs = np.random.uniform(-3, 3, size=(15, 2))
+    ys = np.sin(xs[:, 0:1]) + 0.2 * np.random.randn(15, 1)
+    posterior = GPPosterior(xs, ys, 0.3, [0.7, 1.3], 1.2)
+    if heteroscedastic:
+        gp2 = GPPosterior(xs, np.random.randn(15, 1), 0.5, [1.5, 2.0], 1.0)
+        posterior = HeteroscedasticGPPosterior(GPPosterior(xs, ys, np.random.uniform(0.1, 0.5, (15, 1)), [0.7, 1.3], 1.2), gp2)
+    acquisition = getattr(acquisition_functions, acquisition)
+    xs_star = np.random.uniform(-3, 3, size=(5, 2))
+
+    value, grad = acquisition(xs_star, posterior, 0.5, return_grad=True)
+    fd_grad = np.hstack([(acquisition(xs_star + eps, posterior, 0.5) - acquisition(xs_star - eps, posterior, 0.5)) / 2e-6
+                         for eps in 1e-6 * np.eye(2)])
+
+    assert np.allclose(value, acquisition(xs_star, posterior, 0.5))
+    assert np.allclose(grad, fd_grad, rtol=1e-4, atol=1e-6)
+
+
+@pytest.mark.parametrize("bounds", [np.array([0, 10]), np.array([0, 10]).reshape(-1, 1)])
+def test_optimise_acquisition_returns_best_point(bounds):
+    """
+    Tests that the candidate-pool acquisition optimiser returns a point within the bounds that is at least as good as
+    any point on a dense grid, for both of the one-dimensional bounds layouts used by the experiment scripts.
+    """
+    np.random.seed(12)
+    xs = np.random.uniform(0, 10, size=(8, 1))
+    ys = np.sin(xs)
+    posterior = GPPosterior(xs, ys, 0.1, 1.0, 1.0)
+    mu_sample_opt = np.max(posterior.predict(xs, full_cov=False)[0])
+
+    x_next = acquisition_functions.optimise_acquisition(acquisition_functions.my_expected_improvement, posterior,
+                                                        mu_sample_opt, bounds, n_candidates=256, n_restarts=2)
+    grid = np.linspace(0, 10, 2001).reshape(-1, 1)
+    ei_next = acquisition_functions.my_expected_improvement(x_next, posterior, mu_sample_opt)
+
+    assert x_next.shape == (1, 1)
+    assert 0 <= x_next[0, 0] <= 10
+    assert ei_next.item() >= np.max(acquisition_functions.my_expected_improvement(grid, posterior, mu_sample_opt)) - 1e-6
+
+
+def test_optimise_acquisition_executor_matches_serial():
+    """
+    Tests that running the acquisition restarts on an executor gives the same point and per-restart diagnostics as
+    running them in the calling process. A thread pool stands in for a process pool to keep the test fast.
+    """
+    xs = np.random.RandomState(13).uniform(-5, 5, size=(20, 2))
+    ys = np.sin(xs[:, :1]) + np.cos(xs[:, 1:])
+    posterior = GPPosterior(xs, ys, 0.1, [2.0, 1.5], 1.0)
+    mu_sample_opt = np.max(posterior.predict(xs, full_cov=False)[0])
+    bounds = np.array([[-5, 5], [-5, 5]])
+
+    np.random.seed(13)
+    x_serial, diag_serial = acquisition_functions.optimise_acquisition(
+        acquisition_functions.my_expected_improvement, posterior, mu_sample_opt, bounds, n_candidates=256,
+        n_restarts=4, return_diagnostics=True)
+
+    np.random.seed(13)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        x_pool, diag_pool = acquisition_functions.optimise_acquisition(
+            acquisition_functions.my_expected_improvement, posterior, mu_sample_opt, bounds, n_candidates=256,
+            n_restarts=4, executor=executor, return_diagnostics=True)
+
+    assert len(diag_pool) == 4
+    assert np.allclose(x_serial, x_pool)
+    for row_serial, row_pool in zip(diag_serial, diag_pool):
+        assert row_serial['nit'] == row_pool['nit'] and row_serial['nfev'] == row_pool['nfev']
+        assert np.isclose(row_serial['value'], row_pool['value'])
+
+
+def test_optimise_acquisition_chunks_per_executor_worker():
+    """
+    Tests that the acquisition restarts are split into one chunk per worker of the executor rather than per core.
+    """
+    xs = np.random.RandomState(14).uniform(-5, 5, size=(10, 1))
+    posterior = GPPosterior(xs, np.sin(xs), 0.1, 1.0, 1.0)
+    mu_sample_opt = np.max(posterior.predict(xs, full_cov=False)[0])
+
+    class CountingExecutor(ThreadPoolExecutor):
+        def submit(self, *args, **kwargs):
+            self.n_submitted += 1
+            return super().submit(*args, **kwargs)
+
+    with CountingExecutor(max_workers=2) as executor:
+        executor.n_submitted = 0
+        _, diagnostics = acquisition_functions.optimise_acquisition(
+            acquisition_functions.my_expected_improvement, posterior, mu_sample_opt, np.array([[-5, 5]]),
+            n_candidates=64, n_restarts=6, executor=executor, return_diagnostics=True)
+
+    assert executor.n_submitted == 2 and len(diagnostics) == 6
+
+
+def test_propose_batch_constant_liar():
+    """
+    Tests that a constant liar batch proposal returns distinct points within the bounds and leaves the fitted posterior
+    unchanged.
+    """
+    np.random.seed(14)
+    xs = np.random.uniform(0, 10, size=(10, 1))
+    ys = np.sin(xs)
+    posterior = GPPosterior(xs, ys, 0.1, 1.0, 1.0)
+    mu_sample_opt = np.max(posterior.predict(xs, full_cov=False)[0])
+    L = posterior.L.copy()
+
+    X_batch = acquisition_functions.propose_batch(acquisition_functions.my_expected_improvement, posterior,
+                                                  mu_sample_opt, np.array([0, 10]), 3, n_candidates=256, n_restarts=2)
+
+    assert X_batch.shape == (3, 1)
+    assert np.all((X_batch >= 0) & (X_batch <= 10))
+    assert np.min(np.abs(X_batch - X_batch.T) + np.eye(3)) > 1e-3
+    assert np.array_equal(posterior.L, L) and len(posterior.xs) == 10
+
+
+
+def test_heteroscedastic_propose_batch():
+    """
+    Tests that a heteroscedastic batch proposal works both when the heteroscedastic GP is fitted inside
+    heteroscedastic_propose_location and when a fitted posterior is passed without a noise function, in which case the
+    fantasy noise levels come from GP2.
+    """
+    np.random.seed(27)
+    X_sample = np.random.uniform(0, 5, size=(12, 2))
+    Y_sample = np.sin(X_sample[:, :1]) + 0.1 * np.random.randn(12, 1)
+    bounds = np.array([[0, 5], [0, 5]])
+
+    X_batch = acquisition_functions.heteroscedastic_propose_location(
+        acquisition_functions.heteroscedastic_expected_improvement, X_sample, Y_sample, 0.1, 1.0, 1.0, 1.0, 1.0, 1.0,
+        2, 20, bounds, None, n_restarts=1, n_candidates=64, q=3)
+    assert X_batch.shape == (3, 2)
+
+    posterior = bo_hetero_posterior(X_sample, Y_sample, np.zeros((12, 1)), 0.1 * np.ones((12, 1)), np.ones((2, 1)),
+                                    1.0, 1.0, np.ones((2, 1)), 1.0)
+    X_batch = acquisition_functions.heteroscedastic_propose_location(
+        acquisition_functions.heteroscedastic_expected_improvement, X_sample, Y_sample, 0.1, 1.0, 1.0, 1.0, 1.0, 1.0,
+        2, 20, bounds, None, n_restarts=1, posterior=posterior, n_candidates=64, q=3)
+    assert X_batch.shape == (3, 2)
+    assert np.all((X_batch >= 0) & (X_batch <= 5))
+
+
+def test_heteroscedastic_propose_location_noise_scale(monkeypatch):
+    """
+    Tests that the posterior fitted inside heteroscedastic_propose_location predicts the noise on the same scale as
+    HeteroscedasticGPState fitted to the same data, i.e. that the GP2 target scaler is passed through.
+    """
+    np.random.seed(28)
+    X_sample = np.random.uniform(0, 10, size=(20, 1))
+    Y_sample = np.sin(X_sample) + (0.02 + 0.05 * X_sample) * np.random.randn(20, 1)
+    X_test = np.linspace(0, 10, 7).reshape(-1, 1)
+    posteriors = []
+    monkeypatch.setattr(acquisition_functions, 'optimise_acquisition',
+                        lambda acquisition, posterior, *args, **kwargs: posteriors.append(posterior))
+
+    np.random.seed(29)
+    acquisition_functions.heteroscedastic_propose_location(
+        acquisition_functions.heteroscedastic_expected_improvement, X_sample, Y_sample, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 3,
+        20, np.array([0, 10]), None)
+    np.random.seed(29)
+    state = HeteroscedasticGPState(X_sample, Y_sample, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 3, 20, None)
+
+    assert posteriors[0].Y_scaler is not None
+    assert np.allclose(posteriors[0].predict_noise(X_test), state.predict_noise(X_test))
+
+
+def test_gp_state_append_policy():
+    """
+    Tests that by default HomoscedasticGPState extends its posterior with rank-1 updates and only re-optimises the
+    hyperparameters once refit_every observations have been added, and that appending to a heteroscedastic posterior
+    extends GP2 with the log variance of the new noise levels.
+    """
+    np.random.seed(16)
+    X_sample = np.random.uniform(0, 10, size=(8, 1))
+    state = HomoscedasticGPState(X_sample, np.sin(X_sample), 0.1, 1.0, 1.0)
+    l_opt = state.posterior.l
+
+    for i in range(state.refit_every - 1):
+        X_next = np.random.uniform(0, 10, size=(1, 1))
+        state.add_observations(X_next, np.sin(X_next))
+        assert state.posterior.l is l_opt and state.num_since_refit == i + 1
+    assert len(state.X_sample) == 8 + state.refit_every - 1
+
+    state.add_observations(np.array([[5.0]]), np.sin([[5.0]]))
+    assert state.num_since_refit == 0 and len(state.X_sample) == 8 + state.refit_every
+
+    X_sample = np.random.uniform(0, 10, size=(10, 1))
+    noise = 0.1 * np.ones((10, 1))
+    posterior = bo_hetero_posterior(X_sample, np.sin(X_sample), np.log(noise**2), noise, 1.0, 1.0, 0.1, 1.0, 1.0)
+    posterior.append(np.array([[2.5]]), np.sin([[2.5]]), np.array([[0.3]]))
+    assert len(posterior.gp2.xs) == 11 and np.isclose(posterior.gp2.ys[-1].item(), np.log(0.09))
+
+
+def test_async_bayesian_optimisation():
+    """
+    Tests that the asynchronous loop runs the requested number of evaluations, adds each of them to the state and keeps
+    at most n_workers evaluations in flight.
+    """
+    np.random.seed(15)
+    X_sample = np.random.uniform(0, 10, size=(5, 1))
+    state = HomoscedasticGPState(X_sample, np.sin(X_sample), 0.1, 1.0, 1.0)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        history = async_bayesian_optimisation(np.sin, state, acquisition_functions.my_expected_improvement,
+                                              np.array([0, 10]), 4, n_workers=2, executor=executor, n_candidates=256)
+
+    assert len(history) == 4
+    assert len(state.X_sample) == 9
+    assert max(row['n_pending'] for row in history) <= 1
+    assert np.allclose([row['y'] for row in history], [np.sin(row['x']).item() for row in history])
+
+
+def test_rff_against_exact_gp():
+    """
+    Tests that the random Fourier feature NLML gradient matches finite differences and that with many features the
+    predictive mean and variance approach those of the exact GP.
+    """
+    np.random.seed(16)
+    xs = np.random.uniform(0, 5, size=(40, 2))
+    ys = np.sin(xs[:, :1]) + 0.1 * np.random.randn(40, 1)
+    W, b = rff_frequencies(2, 4000)
+
+    objective = nll_fn_rff_grad(xs, ys, W, b)
+    theta = np.array([1.3, 0.8, 1.1, 0.2])
+    assert np.allclose(objective(theta)[1], approx_fprime(theta, lambda t: objective(t)[0], 1e-6), rtol=1e-4, atol=1e-4)
+
+    pred_mean, pred_var = rff_posterior_predictive(xs, ys, xs[:5], 0.2, [1.3, 0.8], 1.1, W, b, full_cov=False)
+    exact_mean, exact_var, _, _ = posterior_predictive(xs, ys, xs[:5], 0.2, np.array([1.3, 0.8]), 1.1,
+                                                       kernel=scipy_kernel, full_cov=False)
+    assert np.allclose(pred_mean, exact_mean, atol=0.05)
+    assert np.allclose(pred_var, exact_var, atol=0.01)
+
+
+@pytest.mark.parametrize("approximation", ['vfe', 'fitc'])
+def test_sparse_gp_against_exact_gp(approximation):
+    """
+    Tests that the sparse GP objective with heteroscedastic noise recovers the exact negative log marginal likelihood
+    when the inducing inputs are the training inputs and that its gradient matches finite differences with k-means
+    inducing inputs.
+    """
+    np.random.seed(17)
+    xs = np.random.uniform(0, 5, size=(60, 2))
+    ys = np.sin(xs[:, :1]) + 0.1 * np.random.randn(60, 1)
+    noise = np.random.uniform(0.1, 0.4, size=(60, 1))
+    theta = np.array([1.3, 0.8, 1.1])
+
+    exact_nll = nll_fn_het_grad(xs, ys, noise)(theta)[0]
+    assert np.isclose(nll_fn_het_sparse_grad(xs, ys, noise, xs, approximation)(theta)[0], exact_nll, rtol=1e-4)
+
+    objective = nll_fn_het_sparse_grad(xs, ys, noise, kmeans_inducing(xs, 15), approximation)
+    assert np.allclose(objective(theta)[1], approx_fprime(theta, lambda t: objective(t)[0], 1e-6), rtol=1e-4, atol=1e-3)
+
+
+@pytest.mark.parametrize("approximation", ['vfe', 'fitc'])
+def test_sparse_gp_posterior(approximation):
+    """
+    Tests that the sparse GP posterior matches sparse_posterior_predictive, that its gradients match finite differences,
+    that appending observations matches building the posterior on all of them and that bo_hetero_posterior builds it
+    for the sparse backend.
+    """
+    np.random.seed(19)
+    xs = np.random.uniform(0, 5, size=(60, 2))
+    ys = np.sin(xs[:, :1]) + 0.1 * np.random.randn(60, 1)
+    noise = np.random.uniform(0.1, 0.4, size=(60, 1))
+    xs_star = np.random.uniform(0, 5, size=(7, 2))
+    Z = kmeans_inducing(xs, 15)
+    l = np.array([[1.3], [0.8]])
+
+    posterior = SparseGPPosterior(xs, ys, Z, noise, l, 1.1, approximation)
+    pred_mean, pred_var = posterior.predict(xs_star, full_cov=False)
+    reference_mean, reference_var = sparse_posterior_predictive(xs, ys, xs_star, Z, noise, l, 1.1, approximation)
+    assert np.allclose(pred_mean, reference_mean) and np.allclose(pred_var, reference_var)
+    assert np.allclose(np.diag(posterior.predict(xs_star)[1]), pred_var.ravel())
+
+    _, _, dpred_mean, dpred_var = posterior.predict_with_grad(xs_star[:1])
+    for i, grad in enumerate((dpred_mean, dpred_var)):
+        fd = approx_fprime(xs_star[0], lambda x: posterior.predict(x.reshape(1, -1), full_cov=False)[i].item(), 1e-6)
+        assert np.allclose(grad[0], fd, rtol=1e-4, atol=1e-5)
+
+    appended = SparseGPPosterior(xs[:50], ys[:50], Z, noise[:50], l, 1.1, approximation)
+    appended.append(xs[50:], ys[50:], noise[50:])
+    for appended_pred, pred in zip(appended.predict(xs_star, full_cov=False), (pred_mean, pred_var)):
+        assert np.allclose(appended_pred, pred)
+
+    het_posterior = bo_hetero_posterior(xs, ys, np.zeros((60, 1)), noise, l, 1.1, 0.1, l, 1.0, backend='sparse',
+                                        num_inducing=15, approximation=approximation)
+    assert isinstance(het_posterior.gp1, SparseGPPosterior) and isinstance(het_posterior.gp2, SparseGPPosterior)
+    assert het_posterior.predict_with_grad(xs_star)[0].shape == (7, 1)
+
+
+def test_iterative_nll_against_cholesky():
+    """
+    Tests that the blocked kernel product matches the dense product and that the CG and stochastic Lanczos estimate of
+    the heteroscedastic negative log marginal likelihood and its gradient are close to the Cholesky values.
+    """
+    np.random.seed(18)
+    xs = np.random.uniform(0, 5, size=(300, 2))
+    ys = np.sin(xs[:, :1]) + 0.1 * np.random.randn(300, 1)
+    noise = np.random.uniform(0.1, 0.4, size=(300, 1))
+    theta = np.array([1.3, 0.8, 1.1])
+
+    V = np.random.randn(300, 3)
+    K = scipy_kernel(xs, xs, theta[:-1], theta[-1]) + np.diag(noise.ravel()**2)
+    assert np.allclose(kernel_matvec(xs, V, theta[:-1], theta[-1], noise**2, block_size=64), K.dot(V))
+
+    exact_nll, exact_grad = nll_fn_het_grad(xs, ys, noise)(theta)
+    nll, grad = nll_fn_het_cg_grad(xs, ys, noise, num_probes=50, rank=30, block_size=64)(theta)
+    assert np.isclose(nll, exact_nll, atol=0.01 * len(xs))  # the log-determinant error grows with n
+    assert np.allclose(grad, exact_grad, rtol=0.15, atol=2)
+
+
+@pytest.mark.parametrize("mean_func", [zero_mean, lambda x: 2 * np.ones((len(x), 1))])
+def test_posterior_predictive_chunks(mean_func):
+    """
+    Tests that the chunked predictions of utils.posterior_predictive_chunks and GPPosterior.predict_chunks concatenate
+    to the marginal predictions made on the whole test set at once, including a final partial chunk, with both a zero
+    and a non-zero prior mean.
+    """
+    np.random.seed(19)
+    xs = np.random.uniform(0, 10, size=(30, 2))
+    ys = np.sin(xs[:, :1])
+    xs_star = np.random.uniform(0, 10, size=(250, 2))
+    noise = np.random.uniform(0.1, 0.3, size=(30, 1))
+
+    pred_mean, pred_var, _, _ = posterior_predictive(xs, ys, xs_star, noise, np.array([1.5, 2.0]), 1.2, mean_func,
+                                                     kernel=scipy_kernel, full_cov=False)
+    chunks = list(posterior_predictive_chunks(xs, ys, xs_star, noise, np.array([1.5, 2.0]), 1.2, mean_func,
+                                              kernel=scipy_kernel, chunk_size=64))
+    posterior_chunks = list(GPPosterior(xs, ys, noise, np.array([1.5, 2.0]), 1.2, mean_func).predict_chunks(
+        xs_star, chunk_size=64))
+
+    assert len(chunks) == 4
+    for blocks in [chunks, posterior_chunks]:
+        assert np.allclose(np.vstack([mean for mean, _ in blocks]), pred_mean)
+        assert np.allclose(np.vstack([var for _, var in blocks]), pred_var)
+
+    far_mean, _, _, _ = posterior_predictive(xs, ys, np.array([[1e3, 1e3]]), noise, np.array([1.5, 2.0]), 1.2,
+                                             mean_func, kernel=scipy_kernel, full_cov=False)
+    assert np.allclose(far_mean, mean_func(np.zeros((1, 2))))  # away from the data the prediction is the prior mean
+
+
+def test_kronecker_gp_against_dense_gp():
+    """
+    Tests that the Kronecker grid GP gives the same negative log marginal likelihood, gradient and predictions as the
+    dense computation on the same grid, for both grid and scattered test locations.
+    """
+    np.random.seed(20)
+    grid_axes = [np.linspace(0, 5, 12), np.linspace(-2, 3, 9)]
+    xs = grid_points(grid_axes)
+    ys = np.sin(xs[:, :1]) * np.cos(xs[:, 1:]) + 0.1 * np.random.randn(len(xs), 1)
+    theta = np.array([1.3, 0.8, 1.1, 0.2])
+
+    nll, grad = nll_fn_kron_grad(grid_axes, ys)(theta)
+    dense_nll, dense_grad = nll_fn_grad(xs, ys)(theta)
+    assert np.isclose(nll, dense_nll)
+    assert np.allclose(grad, dense_grad)
+
+    star_axes = [np.linspace(0, 5, 7), np.linspace(-2, 3, 4)]
+    dense_mean, dense_var, _, _ = posterior_predictive(xs, ys, grid_points(star_axes), 0.3, theta[:2], theta[2],
+                                                       kernel=scipy_kernel, full_cov=False)
+    for xs_star in [star_axes, grid_points(star_axes)]:
+        pred_mean, pred_var = kron_posterior_predictive(grid_axes, ys, xs_star, 0.3, theta[:2], theta[2])
+        assert np.allclose(pred_mean, dense_mean)
+        assert np.allclose(pred_var, dense_var)
+
+
+@pytest.mark.parametrize('nu', [1.5, 2.5])
+def test_state_space_gp_against_dense_gp(nu):
+    """
+    Tests that the Kalman filter and smoother of the state space GP give the same negative log marginal likelihood,
+    gradient and predictions as the dense Matern GP with per-point noise.
+    """
+    np.random.seed(21)
+    xs = np.random.uniform(0, 10, (50, 1))
+    ys = np.sin(xs) + 0.1 * np.random.randn(50, 1)
+    noise = np.random.uniform(0.1, 0.4, (50, 1))
+    theta = np.array([1.3, 1.1])
+
+    def dense_kernel(X1, X2, l, sigma_f):
+        return matern_kernel(X1, X2, l, sigma_f, nu)
+
+    nll, grad = nll_fn_het_state_space_grad(xs, ys, noise, nu)(theta)
+    K = dense_kernel(xs, xs, theta[0], theta[1]) + np.diag(np.square(noise).ravel())
+    dense_nll = 0.5 * np.linalg.slogdet(K)[1] + 0.5 * ys.T.dot(np.linalg.solve(K, ys)).item() + 25 * np.log(2*np.pi)
+    assert np.isclose(nll, dense_nll)
+    assert np.allclose(grad, approx_fprime(theta, lambda t: nll_fn_het_state_space_grad(xs, ys, noise, nu)(t)[0], 1e-6),
+                       rtol=1e-4)
+
+    xs_star = np.vstack((np.linspace(-1, 11, 20).reshape(-1, 1), xs[:3]))
+    pred_mean, pred_var = state_space_posterior_predictive(xs, ys, xs_star, noise, theta[0], theta[1], nu)
+    dense_mean, dense_var, _, _ = posterior_predictive(xs, ys, xs_star, noise, theta[0], theta[1], kernel=dense_kernel,
+                                                       full_cov=False)
+    assert np.allclose(pred_mean, dense_mean)
+    assert np.allclose(pred_var, dense_var)
+
+
+def test_kernel_cache():
+    """
+    Tests that repeated posteriors on the same data and hyperparameters, and posterior_predictive given the cache, hit the kernel cache
+    with identical predictions and a single hit or miss per lookup, that any change to the data, noise or hyperparameters misses and that the least recently used entries are evicted
+    once the size bound is exceeded.
+    """
+    np.random.seed(24)
+    xs = np.random.randn(20, 2)
+    ys = np.random.randn(20, 1)
+    kernel_cache.clear()
+
+    pred_mean, pred_var = GPPosterior(xs, ys, 0.3, [1.0, 2.0], 1.1).predict(xs)
+    assert kernel_cache.stats()['misses'] == 1  # the Cholesky factor. K(xs, xs) is cached alongside it
+    assert kernel_cache.stats()['hits'] == 1  # K(xs, xs) in predict
+    cached_mean, cached_var = GPPosterior(xs.copy(), ys, 0.3, [1.0, 2.0], 1.1).predict(xs)
+    assert np.array_equal(pred_mean, cached_mean) and np.array_equal(pred_var, cached_var)
+    assert kernel_cache.stats()['misses'] == 1 and kernel_cache.stats()['hits'] == 3
+
+    predictive_mean, predictive_var, K, _ = posterior_predictive(xs, ys, xs, 0.3, [1.0, 2.0], 1.1, kernel=scipy_kernel)
+    assert kernel_cache.stats()['hits'] == 3 and K.flags.writeable  # the cache is opt-in
+    predictive_mean, predictive_var, K, _ = posterior_predictive(xs, ys, xs, 0.3, [1.0, 2.0], 1.1, kernel=scipy_kernel,
+                                                                 cache=kernel_cache)
+    assert np.allclose(predictive_mean, pred_mean) and np.allclose(predictive_var, pred_var)
+    assert kernel_cache.stats()['misses'] == 1 and kernel_cache.stats()['hits'] == 5 and not K.flags.writeable
+
+    for noise, l in [(0.4, [1.0, 2.0]), (0.3, [1.0, 2.5])]:
+        misses = kernel_cache.stats()['misses']
+        GPPosterior(xs, ys, noise, l, 1.1)
+        assert kernel_cache.stats()['misses'] > misses
+
+    small_cache = KernelCache(max_bytes=2 * xs.shape[0]**2 * 8)
+    for sigma_f in [1.0, 2.0, 3.0]:
+        K = small_cache.kernel(scipy_kernel, xs, 1.0, sigma_f)
+    assert not K.flags.writeable
+    assert small_cache.stats()['entries'] == 2 and small_cache.stats()['evictions'] == 1
+
+
+def test_nll_workspace_reuse():
+    """
+    Tests that the workspace evaluator matches a direct computation of the negative log marginal likelihood with
+    per-point noise, gives the same value when an evaluation is repeated after others have overwritten its buffers and
+    raises LinAlgError when the covariance matrix is not positive definite.
+    """
+    np.random.seed(25)
+    xs = np.random.randn(40, 2)
+    ys = np.random.randn(40, 1)
+    noise_var = np.random.uniform(0.05, 0.2, (40, 1))
+    nll = nll_workspace(xs, ys)
+
+    values = [nll([1.0, 2.0], 1.3, noise_var), nll(0.5, 0.7, 0.1), nll([1.0, 2.0], 1.3, noise_var)]
+    K = scipy_kernel(xs, xs, [1.0, 2.0], 1.3) + np.diag(np.ravel(noise_var))
+    expected = 0.5 * np.linalg.slogdet(K)[1] + 0.5 * ys.T.dot(np.linalg.solve(K, ys)).item() + 20 * np.log(2*np.pi)
+    assert np.isclose(values[0], expected)
+    assert values[0] == values[2]
+
+    _, dK = scipy_kernel_with_grad(xs, xs, [1.0, 2.0], 1.3)
+    K_inv = np.linalg.inv(K)
+    alpha = K_inv.dot(ys).ravel()
+    expected_grad = 0.5 * (np.einsum('ij,kji->k', K_inv, dK) - dK.dot(alpha).dot(alpha))  # R&W equation 5.9
+    for cache in [None, SqDistCache(xs)]:
+        value, grad, grad_noise_var = nll_workspace(xs, ys, cache)([1.0, 2.0], 1.3, noise_var, return_grad=True)
+        assert np.isclose(value, expected)
+        assert np.allclose(grad, expected_grad)
+        assert np.isclose(grad_noise_var, 0.5 * (np.trace(K_inv) - alpha.dot(alpha)))
+
+    with pytest.raises(np.linalg.LinAlgError):
+        nll(1.0, 1.0, -10.0)
+
+
+def test_neg_log_marg_lik_large_n():
+    """
+    Tests that neg_log_marg_lik stays finite and matches a log-determinant computed with slogdet at a size where the
+    determinant of the covariance matrix underflows to zero.
+    """
+    np.random.seed(26)
+    xs = np.random.uniform(0, 10, (400, 1))
+    y = np.sin(xs) + 0.1 * np.random.randn(400, 1)
+    K = anisotropic_kernel(xs, xs, [1.0], 1.0) + 0.1**2 * np.eye(400)
+    assert np.linalg.det(K) == 0
+
+    expected = 0.5 * np.linalg.slogdet(K)[1] + 0.5 * y.T.dot(np.linalg.solve(K, y)).item() + 200 * np.log(2*np.pi)
+    value = neg_log_marg_lik(xs, y, 0.1, [1.0], 1.0, kernel=anisotropic_kernel, mean_func=zero_mean)
+    assert np.isfinite(value).all()
+    assert np.allclose(value, expected)
@@ -115,7 +115,7 @@ if __name__ == '__main__':
             # Obtain next sampling point from the acquisition function (expected_improvement)
 
             homo_X_next = my_propose_location(my_expected_improvement, homo_X_sample, homo_Y_sample, noise, l_init, sigma_f_init,
-                                              bounds, plot_sample, n_restarts=5, min_val=6000)
+                                              bounds, plot_sample, n_restarts=5)
 
             homo_collected_x1.append(homo_X_next[:, 0])
             homo_collected_x2.append(homo_X_next[:, 1])
@@ -139,7 +139,7 @@ if __name__ == '__main__':
             het_X_next = heteroscedastic_propose_location(heteroscedastic_one_off_expected_improvement, het_X_sample,
                                                           het_Y_sample, noise, l_init, sigma_f_init, l_noise_init,
                                                           sigma_f_noise_init, gp2_noise, num_iters, sample_size, bounds,
-                                                          plot_sample, n_restarts=5, min_val=6000)
+                                                          plot_sample, n_restarts=5)
 
             het_collected_x1.append(het_X_next[:, 0])
             het_collected_x2.append(het_X_next[:, 1])
@@ -161,7 +161,7 @@ if __name__ == '__main__':
             # # Obtain next sampling point from the augmented expected improvement (AEI)
             #
             # aug_X_next = my_propose_location(augmented_expected_improvement, aug_X_sample, aug_Y_sample, noise, l_init, sigma_f_init,
-            #                                  bounds, plot_sample, n_restarts=5, min_val=6000)
+            #                                  bounds, plot_sample, n_restarts=5)
             #
             # aug_collected_x1.append(aug_X_next[:, 0])
             # aug_collected_x2.append(aug_X_next[:, 1])
@@ -185,7 +185,7 @@ if __name__ == '__main__':
             # aug_het_X_next = heteroscedastic_propose_location(heteroscedastic_one_off_augmented_expected_improvement, aug_het_X_sample,
             #                                               aug_het_Y_sample, noise, l_init, sigma_f_init, l_noise_init,
             #                                               sigma_f_noise_init, gp2_noise, num_iters, sample_size, bounds,
-            #                                               plot_sample, n_restarts=5, min_val=6000)
+            #                                               plot_sample, n_restarts=5)
             #
             # aug_het_collected_x1.append(aug_het_X_next[:, 0])
             # aug_het_collected_x2.append(aug_het_X_next[:, 1])
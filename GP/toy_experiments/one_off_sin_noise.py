@@ -108,7 +108,7 @@ if __name__ == '__main__':
             # Obtain next sampling point from the acquisition function (expected_improvement)
 
             homo_X_next = my_propose_location(my_expected_improvement, homo_X_sample, homo_Y_sample, noise, l_init, sigma_f_init,
-                                              bounds, plot_sample, n_restarts=3, min_val=300)
+                                              bounds, plot_sample, n_restarts=3)
 
             homo_collected_x.append(homo_X_next)
 
@@ -131,7 +131,7 @@ if __name__ == '__main__':
             het_X_next = heteroscedastic_propose_location(heteroscedastic_one_off_expected_improvement, het_X_sample,
                                                           het_Y_sample, noise, l_init, sigma_f_init, l_noise_init,
                                                           sigma_f_noise_init, gp2_noise, num_iters, sample_size, bounds,
-                                                          plot_sample, n_restarts=3, min_val=300)
+                                                          plot_sample, n_restarts=3)
 
             het_collected_x.append(het_X_next)
 
@@ -152,7 +152,7 @@ if __name__ == '__main__':
             # Obtain next sampling point from the augmented expected improvement (AEI)
 
             aug_X_next = my_propose_location(augmented_expected_improvement, aug_X_sample, aug_Y_sample, noise, l_init, sigma_f_init,
-                                             bounds, plot_sample, n_restarts=3, min_val=300)
+                                             bounds, plot_sample, n_restarts=3)
 
             aug_collected_x.append(aug_X_next)
 
@@ -175,7 +175,7 @@ if __name__ == '__main__':
             aug_het_X_next = heteroscedastic_propose_location(heteroscedastic_one_off_augmented_expected_improvement, aug_het_X_sample,
                                                           aug_het_Y_sample, noise, l_init, sigma_f_init, l_noise_init,
                                                           sigma_f_noise_init, gp2_noise, num_iters, sample_size, bounds,
-                                                          plot_sample, n_restarts=3, min_val=300)
+                                                          plot_sample, n_restarts=3)
 
             aug_het_collected_x.append(aug_het_X_next)
 
@@ -64,11 +64,11 @@ if __name__ == '__main__':
         # Obtain next sampling point from the acquisition function (expected_improvement)
 
         X_next = my_propose_location(my_expected_improvement, X_sample, Y_sample, noise, l_init, sigma_f_init, bounds,
-                                     n_restarts=25, min_val=300)
+                                     n_restarts=25)
 
         #X_next = heteroscedastic_propose_location(heteroscedastic_expected_improvement, X_sample, Y_sample, noise, l_init,
                                                   #sigma_f_init, l_noise_init, sigma_f_noise_init, gp2_noise, num_iters,
-                                                  #sample_size, bounds, n_restarts=1, min_val=300)
+                                                  #sample_size, bounds, n_restarts=1)
 
         collected_x1.append(X_next[:, 0])
         collected_x2.append(X_next[:, 1])
@@ -11,6 +11,7 @@ from tensorflow import set_random_seed
 
 from acquisition_functions import heteroscedastic_expected_improvement, heteroscedastic_propose_location, \
     my_propose_location, my_expected_improvement, augmented_expected_improvement, heteroscedastic_augmented_expected_improvement
+from bo_gp_fit_predict import HeteroscedasticGPState, HomoscedasticGPState
 from objective_functions import branin_function, min_branin_noise_function, heteroscedastic_branin
 
 
@@ -87,6 +88,24 @@ if __name__ == '__main__':
         num_iters = 10
         sample_size = 100
 
+        # The homoscedastic GPs are carried across iterations. Each observation extends the Cholesky factor with a
+        # rank-1 update and the hyperparameters are re-optimised after every refit_every observations.
+
+        refit_every = 5
+        homo_state = HomoscedasticGPState(homo_X_sample, homo_Y_sample, noise, l_init, sigma_f_init, refit_every)
+        aug_state = HomoscedasticGPState(aug_X_sample, aug_Y_sample, noise, l_init, sigma_f_init, refit_every)
+
+        # The heteroscedastic GPs are warm-started from the previous noise function and hyperparameters so that only
+        # num_warm_iters iterations of the most likely heteroscedastic GP algorithm are run per new observation.
+
+        num_warm_iters = 2
+        het_state = HeteroscedasticGPState(het_X_sample, het_Y_sample, noise, l_init, sigma_f_init, l_noise_init,
+                                           sigma_f_noise_init, gp2_noise, num_iters, sample_size, plot_sample,
+                                           num_warm_iters)
+        aug_het_state = HeteroscedasticGPState(aug_het_X_sample, aug_het_Y_sample, noise, l_init, sigma_f_init,
+                                               l_noise_init, sigma_f_noise_init, gp2_noise, num_iters, sample_size,
+                                               plot_sample, num_warm_iters)
+
         homo_best_so_far = 300  # value to beat
         het_best_so_far = 300
         aug_best_so_far = 300
@@ -115,7 +134,7 @@ if __name__ == '__main__':
             # Obtain next sampling point from the acquisition function (expected_improvement)
 
             homo_X_next = my_propose_location(my_expected_improvement, homo_X_sample, homo_Y_sample, noise, l_init, sigma_f_init,
-                                              bounds, plot_sample, n_restarts=3, min_val=300)
+                                              bounds, plot_sample, n_restarts=3, posterior=homo_state.posterior)
 
             homo_collected_x1.append(homo_X_next[:, 0])
             homo_collected_x2.append(homo_X_next[:, 1])
@@ -131,15 +150,16 @@ if __name__ == '__main__':
                 homo_obj_val_list.append(homo_best_so_far)
 
             # Add sample to previous samples
-            homo_X_sample = np.vstack((homo_X_sample, homo_X_next))
-            homo_Y_sample = np.vstack((homo_Y_sample, homo_Y_next))
+            homo_state.add_observations(homo_X_next, homo_Y_next)
+            homo_X_sample, homo_Y_sample = homo_state.X_sample, homo_state.Y_sample
 
             # Obtain next sampling point from the het acquisition function (ANPEI)
 
             het_X_next = heteroscedastic_propose_location(heteroscedastic_expected_improvement, het_X_sample,
                                                           het_Y_sample, noise, l_init, sigma_f_init, l_noise_init,
                                                           sigma_f_noise_init, gp2_noise, num_iters, sample_size, bounds,
-                                                          plot_sample, n_restarts=3, min_val=300)
+                                                          plot_sample, n_restarts=3,
+                                                          posterior=het_state.posterior)
 
             het_collected_x1.append(het_X_next[:, 0])
             het_collected_x2.append(het_X_next[:, 1])
@@ -155,13 +175,13 @@ if __name__ == '__main__':
                 het_obj_val_list.append(het_best_so_far)
 
             # Add sample to previous samples
-            het_X_sample = np.vstack((het_X_sample, het_X_next))
-            het_Y_sample = np.vstack((het_Y_sample, het_Y_next))
+            het_state.add_observations(het_X_next, het_Y_next)
+            het_X_sample, het_Y_sample = het_state.X_sample, het_state.Y_sample
 
             # Obtain next sampling point from the augmented expected improvement (AEI)
 
             aug_X_next = my_propose_location(augmented_expected_improvement, aug_X_sample, aug_Y_sample, noise, l_init, sigma_f_init,
-                                             bounds, plot_sample, n_restarts=3, min_val=300)
+                                             bounds, plot_sample, n_restarts=3, posterior=aug_state.posterior)
 
             aug_collected_x1.append(aug_X_next[:, 0])
             aug_collected_x2.append(aug_X_next[:, 1])
@@ -177,15 +197,16 @@ if __name__ == '__main__':
                 aug_obj_val_list.append(aug_best_so_far)
 
             # Add sample to previous sample
-            aug_X_sample = np.vstack((aug_X_sample, aug_X_next))
-            aug_Y_sample = np.vstack((aug_Y_sample, aug_Y_next))
+            aug_state.add_observations(aug_X_next, aug_Y_next)
+            aug_X_sample, aug_Y_sample = aug_state.X_sample, aug_state.Y_sample
 
             # Obtain next sampling point from the heteroscedastic augmented expected improvement (het-AEI)
 
             aug_het_X_next = heteroscedastic_propose_location(heteroscedastic_augmented_expected_improvement, aug_het_X_sample,
                                                           aug_het_Y_sample, noise, l_init, sigma_f_init, l_noise_init,
                                                           sigma_f_noise_init, gp2_noise, num_iters, sample_size, bounds,
-                                                          plot_sample, n_restarts=3, min_val=300)
+                                                          plot_sample, n_restarts=3,
+                                                          posterior=aug_het_state.posterior)
 
             aug_het_collected_x1.append(aug_het_X_next[:, 0])
             aug_het_collected_x2.append(aug_het_X_next[:, 1])
@@ -201,8 +222,8 @@ if __name__ == '__main__':
                 aug_het_obj_val_list.append(aug_het_best_so_far)
 
             # Add sample to previous sample
-            aug_het_X_sample = np.vstack((aug_het_X_sample, aug_het_X_next))
-            aug_het_Y_sample = np.vstack((aug_het_Y_sample, aug_het_Y_next))
+            aug_het_state.add_observations(aug_het_X_next, aug_het_Y_next)
+            aug_het_X_sample, aug_het_Y_sample = aug_het_state.X_sample, aug_het_state.Y_sample
 
         homo_running_sum += np.array(homo_obj_val_list, dtype=np.float64).flatten()
         homo_squares += np.array(homo_obj_val_list, dtype=np.float64).flatten() ** 2
@@ -73,11 +73,11 @@ if __name__ == '__main__':
             # Obtain next sampling point from the acquisition function (expected_improvement)
 
             X_next = my_propose_location(my_expected_improvement, X_sample, Y_sample, noise, l_init, sigma_f_init, bounds,
-                                         plot_sample, n_restarts=3, min_val=300)
+                                         plot_sample, n_restarts=3)
 
             # X_next = heteroscedastic_propose_location(heteroscedastic_expected_improvement, X_sample, Y_sample, noise, l_init,
             #                                           sigma_f_init, l_noise_init, sigma_f_noise_init, gp2_noise, num_iters,
-            #                                           sample_size, bounds, plot_sample, n_restarts=3, min_val=300)
+            #                                           sample_size, bounds, plot_sample, n_restarts=3)
 
             collected_x1.append(X_next[:, 0])
             collected_x2.append(X_next[:, 1])
@@ -7,13 +7,16 @@ Functions from other open source GP libraries used for test purposes.
 from matplotlib import pyplot as plt
 import numpy as np
 import scipy.stats
-from scipy.linalg import cholesky, inv, solve_triangular
+from scipy.linalg import cho_solve, cholesky, get_lapack_funcs, inv, solve_triangular
+from scipy.spatial.distance import cdist
 
-from kernels import kernel, anisotropic_kernel, scipy_kernel
+from kernels import kernel, anisotropic_kernel, batched_scipy_kernel, kernel_diag, scipy_kernel, \
+    sq_exp_kernel_matrix
 from mean_functions import zero_mean
 
 
-def posterior_predictive(xs, y, xs_star, noise, l, sigma_f, mean_func=zero_mean, kernel=anisotropic_kernel, full_cov=True):
+def posterior_predictive(xs, y, xs_star, noise, l, sigma_f, mean_func=zero_mean, kernel=anisotropic_kernel, full_cov=True,
+                         cache=None):
     """
     Compute the posterior predictive mean and variance of the GP.
 
@@ -25,6 +28,12 @@ def posterior_predictive(xs, y, xs_star, noise, l, sigma_f, mean_func=zero_mean,
     :param sigma_f: signal amplitude
     :param mean_func: prior mean function
     :param kernel: GP covariance function
+    :param full_cov: If True return the full predictive covariance matrix (n x n). If False return only the marginal
+                     variances (n x 1), in which case the n x n test covariance matrix is never allocated.
+    :param cache: optional kernel_cache.KernelCache, e.g. kernel_cache.kernel_cache, from which K and L are taken so
+                  that they are shared with GPPosterior and later calls on the same data and hyperparameters. Each
+                  lookup fingerprints xs and noise, the cached K and L are returned read-only and the entries count
+                  towards the cache's memory bound. If None K and L are computed afresh.
     :return: pred_mean, pred_var, K, L; the GP posterior predictive mean and variance, training covariance matrix and
              the Cholesky decomposition of the covariance matrix.
     """
@@ -33,25 +42,76 @@ def posterior_predictive(xs, y, xs_star, noise, l, sigma_f, mean_func=zero_mean,
 
     m = len(xs)  # number of training points
     mean_vector = mean_func(xs)  # mean function applied to the training inputs
-    K = kernel(xs, xs, l, sigma_f)  # covariance matrix applied to the x-values of the data points
-    L = np.linalg.cholesky(K + noise**2 * np.eye(m))  # We compute the Cholesky factor of the covariance matrix with output noise
-    K_ss = kernel(xs_star, xs_star, l, sigma_f)  # Using Katherine Bailey's notation for the cov matrix at test locations
-    K_s = kernel(xs, xs_star, l, sigma_f)
+    if cache is None:
+        K = kernel(xs, xs, l, sigma_f)  # covariance matrix applied to the x-values of the data points
+        L = np.linalg.cholesky(K + noise**2 * np.eye(m))  # We compute the Cholesky factor of the covariance matrix with output noise
+    else:
+        K = cache.kernel(kernel, xs, l, sigma_f)
+        L = cache.cholesky(kernel, xs, noise, l, sigma_f)
+    training_inputs = xs_star is xs
+    K_s = K if training_inputs else kernel(xs, xs_star, l, sigma_f)
     Lk = np.linalg.solve(L, K_s)
-    pred_mean = np.dot(Lk.T, np.linalg.solve(L, y - mean_vector))
-    pred_var = K_ss - np.dot(Lk.T, Lk)
-
-    assert np.diag(pred_var).all() >= 0
+    pred_mean = np.dot(Lk.T, np.linalg.solve(L, y - mean_vector)) + mean_func(xs_star)
 
     if not full_cov:
-        pred_var = np.diag(pred_var)
+
+        # The marginal variances are diag(K_ss) minus the column sums of Lk squared.
+
+        pred_var = kernel_diag(xs_star, l, sigma_f) - np.sum(np.square(Lk), axis=0)
         pred_var = pred_var.reshape(pred_mean.shape)
 
+        assert pred_var.all() >= 0
+
+        return pred_mean, pred_var + jitter, K, L
+
+    K_ss = K if training_inputs else kernel(xs_star, xs_star, l, sigma_f)  # Using Katherine Bailey's notation for the cov matrix at test locations
+    pred_var = K_ss - np.dot(Lk.T, Lk)
+
+    assert np.diag(pred_var).all() >= 0
+
     pred_var += (jitter * np.eye(pred_var.shape[0]))
 
     return pred_mean, pred_var, K, L
 
 
+def posterior_predictive_chunks(xs, y, xs_star, noise, l, sigma_f, mean_func=zero_mean, kernel=anisotropic_kernel,
+                                chunk_size=4096, cache=None):
+    """
+    Generator version of posterior_predictive for very large test sets. The training covariance matrix is factorised
+    once and the test locations are then processed chunk_size at a time, so that peak memory is O(chunk_size x m)
+    however many test locations there are. Only the marginal variances are computed.
+
+    :param xs: training data input locations (m x d)
+    :param y: training data targets (m x 1)
+    :param xs_star: test data input locations (n x d). May be a memory-mapped array.
+    :param noise: noise level. Either a scalar or a vector of per-point noise levels (m x 1)
+    :param l: kernel lengthscale
+    :param sigma_f: signal amplitude
+    :param mean_func: prior mean function
+    :param kernel: GP covariance function
+    :param chunk_size: number of test locations per chunk
+    :param cache: optional kernel_cache.KernelCache from which the Cholesky factor is taken. See posterior_predictive.
+    :return: generator of (pred_mean, pred_var) blocks of shape (chunk_size x 1) in the order of xs_star
+    """
+
+    jitter = 1e-3
+
+    if cache is None:
+        L = np.linalg.cholesky(kernel(xs, xs, l, sigma_f) + noise**2 * np.eye(len(xs)))
+    else:
+        L = cache.cholesky(kernel, xs, noise, l, sigma_f)
+    alpha = cho_solve((L, True), y - mean_func(xs))
+
+    for i in range(0, len(xs_star), chunk_size):
+        chunk = np.asarray(xs_star[i:i + chunk_size])
+        K_s = kernel(xs, chunk, l, sigma_f)
+        pred_mean = K_s.T.dot(alpha) + mean_func(chunk)
+        Lk = solve_triangular(L, K_s, lower=True)
+        pred_var = kernel_diag(chunk, l, sigma_f) - np.sum(np.square(Lk), axis=0)
+
+        yield pred_mean, pred_var.reshape(pred_mean.shape) + jitter
+
+
 def mvn_sample(mean_vector, K, jitter=1e-8):
     """
     Sample from a multivariate normal distribution. Rasmussen and Williams page 201.
@@ -158,13 +218,16 @@ def neg_log_marg_lik(xs, y, noise, l, sigma_f, kernel=anisotropic_kernel, mean_f
     :return: Value of negative log marginal likelihood
     """
     m = len(xs)
-    K = kernel(xs, xs, l, sigma_f)
-    mean_vector = mean_func(xs)
+    K = kernel(xs, xs, l, sigma_f) + np.diag(np.ravel(noise**2) * np.ones(m))
+    residual = y - mean_func(xs)
+
+    # log|K| = 2 sum(log(diag(L))) avoids the overflow of det(K) and alpha = K^-1 (y - m(x)) takes two triangular
+    # solves with the same factor in place of an explicit inverse.
 
-    log_marg_lik = -m/2*np.log(2*np.pi) - 1/2*np.log(np.linalg.det(K + noise**2 * np.eye(m))) - \
-                    1/2*(y - mean_vector).T@np.linalg.inv(K + noise**2 * np.eye(m))@(y - mean_vector)
+    L = cholesky(K, lower=True, overwrite_a=True)
+    alpha = cho_solve((L, True), residual)
 
-    neg_log_marg_lik = - log_marg_lik
+    neg_log_marg_lik = np.sum(np.log(np.diagonal(L))) + 1/2*residual.T@alpha + m/2*np.log(2*np.pi)
 
     return neg_log_marg_lik
 
@@ -209,6 +272,90 @@ def my_nll_fn(xs, y, noise, kernel_function, mean_function):
     return step
 
 
+def nll_workspace(X_train, Y_train, dist_cache=None):
+    """
+    :param X_train: training inputs locations (m x d)
+    :param Y_train: training targets (m x 1)
+    :param dist_cache: optional kernels.SqDistCache built on X_train whose squared differences are reused
+    :return: function evaluating the negative log marginal likelihood of the squared exponential GP and optionally its
+             gradient
+
+    Negative log marginal likelihood evaluator that owns preallocated m x m workspaces. Each evaluation writes the
+    kernel matrix (and its derivatives) into the workspaces, adds the noise to the diagonal in place and factorises it
+    in place with LAPACK potrf. K^-1 y comes from potrs, log|K| from the diagonal of the factor and the trace terms of
+    the gradient from the lower triangle of K^-1, which potri computes in place, so no m x m array is allocated per
+    evaluation. The kernel workspace is Fortran-ordered so that LAPACK can overwrite it without a copy.
+    """
+
+    m = len(X_train)
+    xs = X_train  # the caller's array, which dist_cache recognises by identity
+    X_train = np.reshape(X_train, (m, -1))
+    Y_train = np.reshape(Y_train, (-1, 1)).astype(np.float64)
+    K = np.empty((m, m), order='F')
+    y = np.empty((m, 1), order='F')
+    workspace = {}  # derivative buffer (p + 1 x m x m), allocated on the first gradient evaluation
+    potrf, potrs, potri = get_lapack_funcs(('potrf', 'potrs', 'potri'), (K,))
+
+    def evaluate(l, sigma_f, noise_var, return_grad=False):
+        """
+        :param l: lengthscale(s)
+        :param sigma_f: signal amplitude
+        :param noise_var: noise variance. Either a scalar or a vector of per-point noise variances (m x 1)
+        :param return_grad: whether to also return the gradient
+        :return: the negative log marginal likelihood, or if return_grad the negative log marginal likelihood, its
+                 gradient with respect to [lengthscale(s), sigma_f] and its derivative with respect to a scalar noise
+                 variance
+        """
+        l = np.array(l, dtype=np.float64).reshape(-1)
+        cached = None if dist_cache is None else dist_cache.sq_diffs(xs, xs)
+        K_c = K.T  # K is symmetric so its C-ordered transpose is K
+
+        if cached is None:
+            sq_exp_kernel_matrix(X_train, None, l, sigma_f, out=K_c)
+        else:
+            if len(l) == 1:
+                np.multiply(cached[1], -0.5 / l[0]**2, out=K_c)
+            else:
+                np.einsum('p,pmn->mn', -0.5 / l**2, cached[0], out=K_c)
+            np.exp(K_c, out=K_c)
+            K_c *= sigma_f**2
+
+        if return_grad:
+            if workspace.get('dK') is None or len(workspace['dK']) != len(l) + 1:
+                workspace['dK'] = np.empty((len(l) + 1, m, m))
+            dK = workspace['dK']
+            for i in range(len(l)):
+                if cached is not None:
+                    dK[i] = cached[1] if len(l) == 1 else cached[0][i]
+                elif len(l) == 1:  # a single lengthscale is shared by every dimension
+                    cdist(X_train, X_train, 'sqeuclidean', out=dK[i])
+                else:
+                    cdist(X_train[:, i:i + 1], X_train[:, i:i + 1], 'sqeuclidean', out=dK[i])
+                dK[i] *= K_c
+                dK[i] /= l[i]**3
+            np.multiply(K_c, 2 / sigma_f, out=dK[-1])
+
+        K.flat[::m + 1] += np.ravel(noise_var)  # add the noise to the diagonal in place
+        L, info = potrf(K, lower=True, overwrite_a=True, clean=return_grad)
+        if info > 0:
+            raise np.linalg.LinAlgError('The covariance matrix is not positive definite.')
+        y[:] = Y_train
+        alpha, _ = potrs(L, y, lower=True, overwrite_b=True)  # K^-1 y
+        nll = np.sum(np.log(np.diagonal(L))) + 0.5 * Y_train.T.dot(alpha).item() + 0.5 * m * np.log(2*np.pi)
+
+        if not return_grad:
+            return nll
+
+        alpha = np.ravel(alpha)
+        K_inv, _ = potri(L, lower=True, overwrite_c=True)  # lower triangle of K^-1, zeros above
+        grad = 0.5 * (lower_trace_products(K_inv, dK) - dK.dot(alpha).dot(alpha))
+        grad_noise_var = 0.5 * (np.trace(K_inv) - alpha.dot(alpha))
+
+        return nll, grad, grad_noise_var
+
+    return evaluate
+
+
 def nll_fn(X_train, Y_train):
     """
     :param X_train: training inputs locations
@@ -223,12 +370,10 @@ def nll_fn(X_train, Y_train):
     """
 
     jitter = 1e-3  # additive jitter term to prevent numerical instability
+    nll = nll_workspace(X_train, Y_train)  # preallocated buffers reused by every step
 
     def step(theta):
-        K = scipy_kernel(X_train, X_train, l=theta[0:len(theta) - 2], sigma_f=theta[-2]) + theta[-1]**2 + jitter * np.eye(len(X_train))
-        # Compute determinant via Cholesky decomposition
-        return np.sum(np.log(np.diagonal(cholesky(K)))) + 0.5 * Y_train.T.dot(inv(K).dot(Y_train)) + \
-               0.5 * len(X_train) * np.log(2*np.pi)
+        return nll(theta[0:len(theta) - 2], theta[-2], theta[-1]**2 + jitter)
     return step
 
 
@@ -247,14 +392,190 @@ def nll_fn_het(X_train, Y_train, noise):
     works better this way.
     """
 
+    nll = nll_workspace(X_train, Y_train)  # preallocated buffers reused by every step
+
+    def step(theta):
+        return nll(theta[0:len(theta) - 1], theta[-1], np.square(noise))
+    return step
+
+
+def lower_trace_products(A_lower, B):
+    """
+    tr(A B_k) for a symmetric matrix A of which only the lower triangle is stored and each symmetric matrix B_k, as
+    2 sum(tril(A) * B_k) - sum(diag(A) * diag(B_k)).
+
+    :param A_lower: lower triangle of A with zeros above the diagonal (m x m), e.g. the output of LAPACK potri
+    :param B: stack of symmetric matrices (p x m x m)
+    :return: array of traces (p, )
+    """
+    return 2 * np.einsum('ij,kij->k', A_lower, B) - np.einsum('i,kii->k', np.diagonal(A_lower), B)
+
+
+def nll_fn_grad(X_train, Y_train):
+    """
+    :param X_train: training inputs locations
+    :param Y_train: training targets
+    :return: optimisation step
+
+    Fused version of nll_fn that returns the negative log marginal likelihood together with its exact gradient with
+    respect to the lengthscale(s), the signal amplitude and the noise. Intended to be used with
+    minimize(..., jac=True) so that L-BFGS-B doesn't have to finite-difference the objective. The hyperparameter vector
+    theta is [lengthscale(s), sigma_f, noise].
+    """
+
+    jitter = 1e-3  # additive jitter term to prevent numerical instability
+    nll = nll_workspace(X_train, Y_train)  # preallocated buffers reused by every step
+
+    def step(theta):
+        value, grad, grad_noise_var = nll(theta[0:len(theta) - 2], theta[-2], theta[-1]**2 + jitter, return_grad=True)
+        return value, np.append(grad, 2 * theta[-1] * grad_noise_var)
+    return step
+
+
+def nll_fn_het_grad(X_train, Y_train, noise, dist_cache=None):
+    """
+    :param X_train: training inputs locations
+    :param Y_train: training targets
+    :param noise: fixed noise parameter of y_train. Either a scalar or a vector of per-point noise levels (m x 1).
+    :param dist_cache: optional kernels.SqDistCache built on X_train, which may be shared with other GPs on X_train.
+    :return: optimisation step
+
+    Fused version of nll_fn_het that returns the negative log marginal likelihood together with its exact gradient
+    with respect to the lengthscale(s) and the signal amplitude. Intended to be used with minimize(..., jac=True). As in
+    nll_fn_het the noise is held fixed.
+    """
+
+    nll = nll_workspace(X_train, Y_train, dist_cache)  # preallocated buffers reused by every step
+
     def step(theta):
-        K = scipy_kernel(X_train, X_train, l=theta[0:len(theta) - 1], sigma_f=theta[-1]) + noise**2 * np.eye(len(X_train))
-        # Compute determinant via Cholesky decomposition
-        return np.sum(np.log(np.diagonal(cholesky(K)))) + 0.5 * Y_train.T.dot(inv(K).dot(Y_train)) + \
-               0.5 * len(X_train) * np.log(2*np.pi)
+        value, grad, _ = nll(theta[0:len(theta) - 1], theta[-1], np.square(noise), return_grad=True)
+        return value, grad
+    return step
+
+
+def batched_nll(K, Y_train):
+    """
+    Computes the negative log marginal likelihood for a stack of covariance matrices with a single batched Cholesky
+    decomposition. Settings whose covariance matrix is not numerically positive definite are given an infinite value.
+
+    :param K: covariance matrices of the training targets including the noise (B x m x m)
+    :param Y_train: training targets (m x 1)
+    :return: negative log marginal likelihood of each setting (B, )
+    """
+
+    Y_train = np.reshape(Y_train, (-1, 1))
+    m = len(Y_train)
+
+    try:
+        L = np.linalg.cholesky(K)
+    except np.linalg.LinAlgError:  # fall back to factorising the settings one at a time
+        if len(K) == 1:
+            return np.array([np.inf])
+        return np.concatenate([batched_nll(K[b:b + 1], Y_train) for b in range(len(K))])
+
+    z = np.linalg.solve(L, np.broadcast_to(Y_train, (len(K), m, 1)))  # L^-1 y so that y^T K^-1 y = z^T z
+
+    return np.sum(np.log(np.diagonal(L, axis1=1, axis2=2)), axis=1) + 0.5 * np.sum(z**2, axis=(1, 2)) + \
+        0.5 * m * np.log(2*np.pi)
+
+
+def nll_fn_batch(X_train, Y_train):
+    """
+    :param X_train: training inputs locations
+    :param Y_train: training targets
+    :return: batched objective
+
+    Batched version of nll_fn_grad without the gradient. The returned function takes a batch of hyperparameter vectors
+    thetas (B x p) with rows [lengthscale(s), sigma_f, noise] and returns the negative log marginal likelihood of each
+    (B, ). Used to screen starting points for the optimiser.
+    """
+
+    jitter = 1e-3  # additive jitter term to prevent numerical instability
+
+    def step(thetas):
+        thetas = np.atleast_2d(thetas)
+        K = batched_scipy_kernel(X_train, X_train, thetas[:, :-2], thetas[:, -2])
+        K += (thetas[:, -1]**2 + jitter)[:, np.newaxis, np.newaxis] * np.eye(len(X_train))
+        return batched_nll(K, Y_train)
     return step
 
 
+def nll_fn_het_batch(X_train, Y_train, noise, dist_cache=None):
+    """
+    :param X_train: training inputs locations
+    :param Y_train: training targets
+    :param noise: fixed noise parameter of y_train. Either a scalar or a vector of per-point noise levels (m x 1).
+    :param dist_cache: optional kernels.SqDistCache built on X_train.
+    :return: batched objective
+
+    Batched version of nll_fn_het. The returned function takes a batch of hyperparameter vectors thetas (B x p) with
+    rows [lengthscale(s), sigma_f] and returns the negative log marginal likelihood of each (B, ).
+    """
+
+    batched_kernel = batched_scipy_kernel if dist_cache is None else dist_cache.batched
+
+    def step(thetas):
+        thetas = np.atleast_2d(thetas)
+        K = batched_kernel(X_train, X_train, thetas[:, :-1], thetas[:, -1])
+        K += noise**2 * np.eye(len(X_train))
+        return batched_nll(K, Y_train)
+    return step
+
+
+def most_likely_variance_estimator(ys, pred_mean, pred_var, sample_size, estimator='cholesky'):
+    """
+    Computes the most likely heteroscedastic GP noise estimator given in section 4 of Kersting et al.
+    z_i = 0.5/s * sum_j (y_i - t_ij)^2 where t_ij is the ith element of the jth of s samples from the GP1 posterior.
+
+    :param ys: targets (m x 1)
+    :param pred_mean: GP1 posterior predictive mean at the target locations (m x 1)
+    :param pred_var: GP1 posterior predictive covariance at the target locations (m x m) or the marginal variances
+                     (m x 1). Each z_i depends on the samples only through their ith element so sampling from the
+                     marginals gives the same estimator as sampling from the joint, without the O(m^3) factorisation.
+    :param sample_size: the number of samples s
+    :param estimator: 'sample' draws each sample with np.random.multivariate_normal, which computes an SVD of pred_var
+                      per draw. 'cholesky' factorises pred_var once and draws all samples as a single matrix product.
+                      'exact' uses the expectation E[(y - t)^2] = (y - mu)^2 + diag(pred_var) and doesn't sample.
+    :return: variance estimator at each target location (m, )
+    """
+
+    m = len(ys)
+    ys = np.reshape(ys, (m, 1))
+    pred_mean = np.reshape(pred_mean, (m, 1))
+
+    if np.shape(pred_var) != (m, m) and estimator in ['sample', 'cholesky']:
+        sample_matrix = pred_mean + np.sqrt(np.reshape(pred_var, (m, 1))) * np.random.randn(m, sample_size)
+    elif estimator == 'sample':
+        sample_matrix = np.zeros((m, sample_size))
+        for j in range(0, sample_size):
+            sample_matrix[:, j] = np.random.multivariate_normal(pred_mean.reshape(m), pred_var)
+    elif estimator == 'cholesky':
+        L = np.linalg.cholesky(pred_var)  # the predictive variance already contains jitter
+        sample_matrix = pred_mean + L@np.random.randn(m, sample_size)
+    elif estimator == 'exact':
+        marginal_var = np.diag(pred_var) if np.shape(pred_var) == (m, m) else np.reshape(pred_var, m)
+        return 0.5 * (np.square(ys - pred_mean).reshape(m) + marginal_var)
+    else:
+        raise ValueError('Unknown variance estimator: {}'.format(estimator))
+
+    return (0.5 / sample_size) * np.sum((ys - sample_matrix) ** 2, axis=1)
+
+
+def relative_change(new, old):
+    """
+    Relative change between successive iterates of the most likely heteroscedastic GP algorithm. Used as the stopping
+    criterion for the noise function and the GP1 negative log marginal likelihood.
+
+    :param new: current iterate. Either a scalar or an array
+    :param old: previous iterate. Either a scalar or an array broadcastable to the shape of new
+    :return: ||new - old|| / ||old||
+    """
+    new = np.ravel(new)
+    old = np.ravel(old) * np.ones_like(new)
+
+    return np.linalg.norm(new - old) / np.linalg.norm(old)
+
+
 def nlpd(pred_mean_vec, pred_var_vec, targets):
     """
     Computes the negative log predictive density for a set of targets assuming a Gaussian noise model.
@@ -299,9 +620,9 @@ def plot_het_gp1(xs, ys, xs_star, gp1_noise, gp1_l, gp1_sigma_f):
     """
 
     gp1_pred_mean, gp1_pred_var, _, _ = posterior_predictive(xs, ys, xs_star, gp1_noise, gp1_l, gp1_sigma_f,
-                                                             mean_func=zero_mean, kernel=scipy_kernel)
+                                                             mean_func=zero_mean, kernel=scipy_kernel, full_cov=False)
 
-    gp1_plot_pred_var = np.diag(gp1_pred_var).reshape(-1, 1)  # Take the diagonal of the covariance matrix for plotting purposes
+    gp1_plot_pred_var = gp1_pred_var.reshape(-1, 1)
     # TODO: ADD ALEATORIC NOISE
     gp1_plot_pred_var = gp1_plot_pred_var # + np.square(gp1_noise) - commented out because it causes computational error. need a workaround
     print(np.square(gp1_noise))
@@ -335,9 +656,9 @@ def plot_het_gp2(xs, variance_estimator, xs_star, gp2_noise, gp2_l, gp2_sigma_f)
     """
 
     gp2_pred_mean, gp2_pred_var, _, _ = posterior_predictive(xs, variance_estimator, xs_star, gp2_noise, gp2_l, gp2_sigma_f,
-                                                             mean_func=zero_mean, kernel=scipy_kernel)
+                                                             mean_func=zero_mean, kernel=scipy_kernel, full_cov=False)
 
-    gp2_plot_pred_var = np.diag(gp2_pred_var).reshape(-1, 1)  # Take the diagonal of the covariance matrix for plotting purposes
+    gp2_plot_pred_var = gp2_pred_var.reshape(-1, 1)
     plt.plot(xs, variance_estimator, '+', color='green', markersize='12', linewidth='8')
     plt.plot(xs_star, gp2_pred_mean, '-', color='red')
     upper = gp2_pred_mean + 2 * np.sqrt(gp2_plot_pred_var)